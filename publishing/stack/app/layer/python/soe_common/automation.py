@@ -0,0 +1,435 @@
+'''
+
+This module holds the SSM automation helpers shared by the trigger, check and notify functions through the SOE common layer.
+
+'''
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+
+import boto3
+import botocore
+from botocore.config import Config
+
+
+### Environment variables ###
+# General
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+min_poll_seconds = int(os.environ.get('MinPollSeconds', '15'))
+max_poll_seconds = int(os.environ.get('MaxPollSeconds', '600'))
+solution_naming = os.environ.get('SolutionNaming', '')
+shared_status_max_age = int(os.environ.get('SharedStatusMaxAge', '180'))
+step_overrun_factor = float(os.environ.get('StepOverrunFactor', '3'))
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
+
+# Poll interval when no step durations are recorded for the build document
+POLL_SECONDS = 60
+
+# Automation statuses by check state, mirrored by the status choices of the build state machine
+RUNNING_STATUSES = ['Pending', 'InProgress', 'Waiting']
+SUCCEEDED_STATUSES = ['Success']
+FAILED_STATUSES = ['Cancelling', 'Failed', 'Cancelled', 'TimedOut']
+
+# Namespace of the step progress metrics, shared with the step overrun alarm
+METRIC_NAMESPACE = 'SOE/Automation'
+
+# Same format as the other SSM records of the solution
+RECORD_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Clients per service and region, shared by the polling threads
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+# Automation executions fetched during the current invocation by region and execution id, cleared by every handler
+SNAPSHOTS = {}
+SNAPSHOTS_LOCK = threading.Lock()
+
+
+def get_client(service_name, client_region):
+
+    '''
+        Get a client for the service in the region, creating it once
+    '''
+
+    with CLIENTS_LOCK:
+        if (service_name, client_region) not in CLIENTS:
+            CLIENTS[(service_name, client_region)] = boto3.client(service_name, region_name=client_region, config=CLIENT_CONFIG)
+        return CLIENTS[(service_name, client_region)]
+
+
+def get_client_token(event, step, step_region):
+
+    '''
+        Derive the idempotency token of a launch from the state machine execution
+    '''
+
+    execution_id = event.get('Execution', {}).get('Id')
+    if not execution_id:
+        print("No state machine execution in the event. '%s' launch in '%s' is not idempotent" % (step, step_region))
+        return None
+
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join([execution_id, step, step_region])))
+
+
+def get_execution_snapshot(region, automation_execution_id):
+
+    '''
+        Get the SSM automation execution, fetching it once per invocation
+    '''
+
+    with SNAPSHOTS_LOCK:
+        if (region, automation_execution_id) in SNAPSHOTS:
+            return SNAPSHOTS[(region, automation_execution_id)]
+
+    client = get_client('ssm', region)
+
+    try:
+        ssm_response = client.get_automation_execution(
+            AutomationExecutionId=automation_execution_id
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    snapshot = ExecutionSnapshot(ssm_response['AutomationExecution'])
+    with SNAPSHOTS_LOCK:
+        SNAPSHOTS[(region, automation_execution_id)] = snapshot
+
+    return snapshot
+
+
+def start_test_automation(region, event, ami_id, test_document, spot_test_document, use_spot_test):
+
+    '''
+        Start the test SSM automation of the image and return its document
+    '''
+
+    # Launch on spot capacity unless it was unavailable on a previous attempt
+    if 'TestCapacity' not in event:
+        event['TestCapacity'] = 'spot' if use_spot_test == 'true' and spot_test_document else 'on-demand'
+    if event['TestCapacity'] == 'spot':
+        test_document = spot_test_document
+    print("TestCapacity: " + event['TestCapacity'])
+
+    test_parameters = {'sourceAMIid': [ami_id]}
+    if event.get('TestInstanceType'):
+        test_parameters['InstanceType'] = [event['TestInstanceType']]
+
+    client = get_client('ssm', region)
+
+    # A replayed step with the same ClientToken gets back the original execution
+    client_token = get_client_token(event, 'test-' + event['TestCapacity'], region)
+    launch_args = {'ClientToken': client_token} if client_token else {}
+
+    try:
+        ssm_response = client.start_automation_execution(
+            DocumentName=test_document,
+            Parameters=test_parameters,
+            **launch_args
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    event['TestAutomationExecutionId'] = ssm_response['AutomationExecutionId']
+    return test_document
+
+
+def classify_status(automation_status):
+
+    '''
+        Map an SSM automation status to the state of the check, the build state machine maps it the same way
+    '''
+
+    if automation_status in RUNNING_STATUSES:
+        return 'running'
+    if automation_status in SUCCEEDED_STATUSES:
+        return 'succeeded'
+    if automation_status in FAILED_STATUSES:
+        return 'failed'
+
+    print("State Unknown")
+    return 'unknown'
+
+
+def get_next_poll_seconds(step_durations, automation_execution):
+
+    '''
+        Get the seconds until the automation is expected to finish from the recorded step durations
+    '''
+
+    expected_steps = step_durations.get(automation_execution.document_name, {}).get('Steps', {})
+    if not expected_steps:
+        return POLL_SECONDS
+
+    remaining_seconds = get_remaining_seconds(expected_steps, automation_execution)
+
+    return int(round(min(max(remaining_seconds, min_poll_seconds), max_poll_seconds)))
+
+
+def get_remaining_seconds(expected_steps, automation_execution):
+
+    '''
+        Get the seconds the automation still needs from the recorded step durations
+    '''
+
+    remaining_seconds = 0
+    started_steps = set()
+    for step in automation_execution.step_executions:
+        if step['StepStatus'] == 'Pending':
+            continue
+        started_steps.add(step['StepName'])
+        if step['StepStatus'] == 'InProgress' and 'ExecutionStartTime' in step:
+            remaining_seconds += max(expected_steps.get(step['StepName'], 0) - get_elapsed_seconds(step['ExecutionStartTime']), 0)
+        elif step['StepStatus'] == 'InProgress':
+            remaining_seconds += expected_steps.get(step['StepName'], 0)
+    remaining_seconds += sum(seconds for step_name, seconds in expected_steps.items() if step_name not in started_steps)
+
+    return remaining_seconds
+
+
+def get_elapsed_seconds(start_time):
+
+    '''
+        Get the seconds since a step execution time
+    '''
+
+    return (datetime.now(start_time.tzinfo) - start_time).total_seconds()
+
+
+def get_progress(step_durations, automation_execution):
+
+    '''
+        Get the current step, elapsed time and ETA of a running automation
+    '''
+
+    expected_steps = step_durations.get(automation_execution.document_name, {}).get('Steps', {})
+    progress = {
+        'CurrentStep': '',
+        'StepsCompleted': 0,
+        'StepsTotal': max(len(automation_execution.step_executions), len(expected_steps)),
+        'ElapsedSeconds': 0,
+        'StepElapsedSeconds': 0,
+    }
+
+    start_times = []
+    for step in automation_execution.step_executions:
+        if 'ExecutionStartTime' in step:
+            start_times.append(step['ExecutionStartTime'])
+        if step['StepStatus'] in ['InProgress', 'Waiting']:
+            progress['CurrentStep'] = step['StepName']
+            if 'ExecutionStartTime' in step:
+                progress['StepElapsedSeconds'] = int(get_elapsed_seconds(step['ExecutionStartTime']))
+        elif step['StepStatus'] != 'Pending':
+            progress['StepsCompleted'] += 1
+    if start_times:
+        progress['ElapsedSeconds'] = int(get_elapsed_seconds(min(start_times)))
+
+    # Without recorded durations there is nothing to estimate against
+    if expected_steps:
+        progress['EtaSeconds'] = int(round(get_remaining_seconds(expected_steps, automation_execution)))
+        if progress['CurrentStep'] in expected_steps:
+            progress['StepExpectedSeconds'] = expected_steps[progress['CurrentStep']]
+            progress['Overrun'] = progress['StepElapsedSeconds'] > expected_steps[progress['CurrentStep']] * step_overrun_factor
+
+    return progress
+
+
+def put_progress_metrics(stage, progress):
+
+    '''
+        Publish the progress of a running automation as CloudWatch embedded metrics
+    '''
+
+    metrics = {'StepElapsedSeconds': progress['StepElapsedSeconds']}
+    if 'EtaSeconds' in progress:
+        metrics['EtaSeconds'] = progress['EtaSeconds']
+    if 'Overrun' in progress:
+        metrics['StepOverrun'] = 1 if progress['Overrun'] else 0
+
+    put_metrics(stage, progress['CurrentStep'], metrics)
+
+
+def put_step_metrics(stage, step_seconds):
+
+    '''
+        Publish the duration of every step of a finished automation as CloudWatch embedded metrics
+    '''
+
+    for steps in step_seconds.values():
+        for step_name, seconds in steps.items():
+            put_metrics(stage, step_name, {'StepSeconds': seconds})
+
+
+def put_metrics(stage, step_name, metrics):
+
+    '''
+        Print metrics in the CloudWatch embedded metric format, no API call is made
+    '''
+
+    print(json.dumps(dict({
+        '_aws': {
+            'Timestamp': int(datetime.now().timestamp() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [['Solution', 'Stage'], ['Solution', 'Stage', 'Step']],
+                'Metrics': [
+                    {'Name': name, 'Unit': 'Count' if name == 'StepOverrun' else 'Seconds'}
+                    for name in metrics
+                ],
+            }],
+        },
+        'Solution': solution_naming,
+        'Stage': stage,
+        'Step': step_name,
+    }, **metrics)))
+
+
+def get_step_seconds(automation_execution):
+
+    '''
+        Get the duration of every successful step of the automation by document
+    '''
+
+    step_seconds = {}
+    for step in automation_execution.step_executions:
+        if step['StepStatus'] == 'Success' and 'ExecutionStartTime' in step and 'ExecutionEndTime' in step:
+            step_seconds[step['StepName']] = int((step['ExecutionEndTime'] - step['ExecutionStartTime']).total_seconds())
+
+    if not step_seconds or not automation_execution.document_name:
+        return {}
+
+    return {automation_execution.document_name: step_seconds}
+
+
+def get_shared_executions(region):
+
+    '''
+        Get the automation executions published by the shared poller, empty if they are out of date
+    '''
+
+    client = get_client('ssm', region)
+    status_param = '/' + solution_naming + '/automationStatus'
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=status_param,
+        )
+        record = json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + status_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            print("Parameter '" + status_param + "' does not exist. Polling the automation")
+            return {}
+        print(exc)
+        raise exc
+
+    age_seconds = (datetime.utcnow() - datetime.strptime(record['UpdatedAt'], RECORD_DATE_FORMAT)).total_seconds()
+    if age_seconds > shared_status_max_age:
+        print("Shared automation status is %s seconds old. Polling the automation" % int(age_seconds))
+        return {}
+
+    return record['Executions']
+
+
+def get_shared_execution(shared_execution, step_durations):
+
+    '''
+        Rebuild the step progress of a running automation from its shared status
+    '''
+
+    automation_status, document_name, current_step_name = shared_execution[:3]
+    step_executions = []
+    for step_name in step_durations.get(document_name, {}).get('Steps', {}):
+        if step_name == current_step_name:
+            step_executions.append({'StepName': step_name, 'StepStatus': 'InProgress'})
+            break
+        step_executions.append({'StepName': step_name, 'StepStatus': 'Success'})
+    else:
+        # The current step has no recorded duration
+        step_executions = []
+
+    # e.g. ['InProgress', 'BuildDoc', 'updateOS', execution start, current step start]
+    if step_executions and len(shared_execution) == 5:
+        step_executions[0]['ExecutionStartTime'] = get_record_time(shared_execution[3])
+        step_executions[-1]['ExecutionStartTime'] = get_record_time(shared_execution[4])
+
+    return ExecutionSnapshot({'AutomationExecutionStatus': automation_status, 'DocumentName': document_name, 'StepExecutions': step_executions})
+
+
+def get_record_time(record_time):
+
+    '''
+        Get a time of the shared status as a UTC datetime
+    '''
+
+    return datetime.strptime(record_time, RECORD_DATE_FORMAT).replace(tzinfo=timezone.utc)
+
+
+class ExecutionSnapshot(object):
+
+    '''
+        SSM automation execution fetched once per invocation and shared by every check
+    '''
+
+    def __init__(self, automation_execution):
+        self.execution_id = automation_execution.get('AutomationExecutionId', '')
+        self.status = automation_execution.get('AutomationExecutionStatus', '')
+        self.document_name = automation_execution.get('DocumentName', '')
+        self.parameters = automation_execution.get('Parameters', {})
+        self.outputs = automation_execution.get('Outputs', {})
+        self.step_executions = automation_execution.get('StepExecutions', [])
+
+    @property
+    def instance_id(self):
+
+        '''
+            Instance launched by the automation
+        '''
+
+        return get_output_value(self.outputs['startInstances.InstanceIds'])
+
+    @property
+    def image_id(self):
+
+        '''
+            Image created by the automation
+        '''
+
+        return get_output_value(self.outputs['createImage.ImageId'])
+
+    @property
+    def source_ami(self):
+
+        '''
+            Image the automation started from
+        '''
+
+        return self.parameters['sourceAMIid'][0]
+
+    @property
+    def inspector_run_arn(self):
+
+        '''
+            Inspector assessment run started by the automation
+        '''
+
+        return get_output_value(self.outputs['runVulnerabilityScan.Output'])
+
+
+def get_output_value(output):
+
+    '''
+        Get the value of an automation output e.g. '  "i-12345678"  '
+    '''
+
+    return output[0].strip().strip('"')
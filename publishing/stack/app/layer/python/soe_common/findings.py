@@ -0,0 +1,197 @@
+'''
+
+This module holds the vulnerability finding rules shared by the check and notify functions through the SOE common layer.
+
+'''
+from datetime import datetime
+
+import botocore
+
+from soe_common.automation import get_client
+
+
+# Severities of the findings that fail the test
+BREAKING_SEVERITIES = {'High'}
+
+# Part of an Inspector rules package ARN, excepting every finding of the package
+RULES_PACKAGE_MARKER = ':rulespackage/'
+
+# Marks the end of a wildcard exception prefix in the trie
+TRIE_END = ''
+
+# Expiry of a vulnerability exception e.g. CVE-2019-1234@2021-12-31
+EXPIRY_DATE_FORMAT = '%Y-%m-%d'
+
+# Exceptions file downloaded from S3 and its ETag, kept while the Lambda is warm
+S3_EXCEPTIONS = {}
+
+# Finding rules compiled by exceptions and day
+COMPILED_RULES = {}
+
+
+def get_finding_rules(exceptions, exceptions_region, exceptions_bucket, exceptions_key):
+
+    '''
+        Get the finding rules of the exceptions and of the S3 exceptions file, compiled once per content
+    '''
+
+    entries = split_exceptions(exceptions) + get_s3_exceptions(exceptions_region, exceptions_bucket, exceptions_key)
+    rules_key = (tuple(entries), datetime.utcnow().strftime('%Y-%m-%d'))
+    if rules_key not in COMPILED_RULES:
+        COMPILED_RULES.clear()
+        COMPILED_RULES[rules_key] = FindingRules(entries, rules_key[1])
+
+    return COMPILED_RULES[rules_key]
+
+
+def get_s3_exceptions(exceptions_region, exceptions_bucket, exceptions_key):
+
+    '''
+        Get the entries of the S3 exceptions file, only downloaded again once its ETag changes
+    '''
+
+    if not exceptions_bucket:
+        return []
+
+    client = get_client('s3', exceptions_region)
+
+    request_args = {'IfNoneMatch': S3_EXCEPTIONS['ETag']} if S3_EXCEPTIONS.get('ETag') else {}
+
+    try:
+        response = client.get_object(
+            Bucket=exceptions_bucket,
+            Key=exceptions_key,
+            **request_args
+        )
+        S3_EXCEPTIONS['Entries'] = split_exceptions(response['Body'].read().decode('utf-8'))
+        S3_EXCEPTIONS['ETag'] = response['ETag']
+        print("Retrieved exceptions 's3://%s/%s' version '%s'" % (exceptions_bucket, exceptions_key, response['ETag']))
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] not in ['304', 'NotModified']:
+            print(exc)
+            raise exc
+        print("Exceptions 's3://%s/%s' not modified" % (exceptions_bucket, exceptions_key))
+
+    return S3_EXCEPTIONS['Entries']
+
+
+class FindingRules(object):
+
+    '''
+        Vulnerability exception, CIS and severity rules compiled once and applied to every finding
+    '''
+
+    def __init__(self, exception_entries, today=None):
+        today = get_expiry_date(today or datetime.utcnow().strftime(EXPIRY_DATE_FORMAT))
+        self.exact_ids = set()
+        self.rules_packages = set()
+        self.id_prefixes = {}
+        for entry in exception_entries:
+            # e.g. CVE-2019-1234, CVE-2019-*, arn:aws:inspector:...:rulespackage/0-ab/* or CVE-2019-1234@2021-12-31
+            pattern, _, expires = entry.partition('@')
+            expiry_date = get_expiry_date(expires) if expires else None
+            if expires and not expiry_date:
+                # An exception that can not be dated would never expire
+                print("Vulnerability exception '%s' has an invalid expiry '%s', expected YYYY-MM-DD. Ignoring" % (pattern, expires))
+            elif expiry_date and expiry_date < today:
+                print("Vulnerability exception '%s' expired on %s. Ignoring" % (pattern, expires))
+            elif RULES_PACKAGE_MARKER in pattern:
+                self.rules_packages.add(pattern.rstrip('*').rstrip('/'))
+            elif pattern.endswith('*'):
+                add_prefix(self.id_prefixes, pattern.rstrip('*'))
+            else:
+                self.exact_ids.add(pattern)
+
+    def ignore_reason(self, findings_detail):
+
+        '''
+            Get the rule ignoring the finding, None for a breaking finding
+        '''
+
+        # Ignore user exceptions list
+        if self.is_excepted(findings_detail):
+            return 'ExceptionList'
+
+        # Ignore Level 2 as we are currently using CIS Hardened AMI to Level 1 only
+        for attr in findings_detail['attributes']:
+            if attr['key'] == 'CIS_BENCHMARK_PROFILE':
+                if 'Level 2' in attr['value']:
+                    return 'CIS_Level_2'
+                break
+
+        # Ignore non High severity
+        if 'severity' in findings_detail and findings_detail['severity'] not in BREAKING_SEVERITIES:
+            return findings_detail['severity']
+
+        return None
+
+    def is_excepted(self, findings_detail):
+
+        '''
+            Check the finding against the exact, rules package and wildcard exceptions
+        '''
+
+        if findings_detail['id'] in self.exact_ids:
+            return True
+        if findings_detail.get('serviceAttributes', {}).get('rulesPackageArn') in self.rules_packages:
+            return True
+
+        return has_prefix(self.id_prefixes, findings_detail['id'])
+
+
+def get_expiry_date(expires):
+
+    '''
+        Get the date of an exception expiry, None when it is not a YYYY-MM-DD date
+    '''
+
+    try:
+        return datetime.strptime(expires, EXPIRY_DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+def add_prefix(trie, prefix):
+
+    '''
+        Add a wildcard exception prefix to the trie
+    '''
+
+    node = trie
+    for char in prefix:
+        node = node.setdefault(char, {})
+    node[TRIE_END] = True
+
+
+def has_prefix(trie, finding_id):
+
+    '''
+        Check if a wildcard exception prefix of the trie starts the finding id
+    '''
+
+    node = trie
+    for char in finding_id:
+        if TRIE_END in node:
+            return True
+        node = node.get(char)
+        if node is None:
+            return False
+
+    return TRIE_END in node
+
+
+def split_exceptions(exceptions):
+
+    '''
+        Get the exception entries of a comma or line separated list, # starts a comment
+    '''
+
+    if isinstance(exceptions, list):
+        return [str(entry).strip() for entry in exceptions if str(entry).strip()]
+
+    entries = []
+    for line in (exceptions or '').splitlines():
+        entries += [entry.strip() for entry in line.split('#', 1)[0].split(',') if entry.strip()]
+
+    return entries
@@ -0,0 +1,293 @@
+'''
+
+This module resumes the build state machine as soon as the SSM automation it waits for finishes, instead of polling.
+
+'''
+import json
+import os
+from datetime import datetime
+
+import boto3
+import botocore
+from botocore.config import Config
+
+
+print('Loading function ' + datetime.now().time().isoformat())
+
+### Environment variables ###
+# General
+solution_naming = os.environ['SolutionNaming']
+region = os.environ['Region']
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+token_store = os.environ.get('TokenStore', 'ssm')
+token_dir = os.environ.get('TokenDir', '/tmp/soe-task-tokens')
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
+
+# Automation statuses that end an execution
+FINAL_STATUSES = ['Success', 'Failed', 'Cancelling', 'Cancelled', 'TimedOut']
+
+# Errors of a task token whose state machine task is no longer waiting
+STALE_TOKEN_ERRORS = ['TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken']
+
+def lambda_handler(event, context):
+
+    '''
+        Run function and return output.
+    '''
+
+    print("Event: " + json.dumps(event))
+
+    try:
+        if 'TaskToken' in event:
+            return register_task_token(event)
+
+        return resume_execution(event)
+
+    except BaseException as exc:
+        print(exc)
+        raise exc
+
+
+def register_task_token(event):
+
+    '''
+        Store the task token of the waiting state against every automation it still waits for
+    '''
+
+    # Step 1
+    execution_ids = get_awaited_executions(event['Stage'], event['Input'])
+    print("Awaited executions: " + json.dumps(execution_ids))
+    if not execution_ids:
+        raise ValueError("No automation execution to wait for in the '%s' stage" % event['Stage'])
+
+    # Step 2 - Resume straight away once the stage can be decided, else only wait for the automations still running
+    statuses = {execution_id: get_automation_status(execution_region, execution_id) for execution_id, execution_region in execution_ids.items()}
+    running_ids = sorted(execution_id for execution_id, status in statuses.items() if status not in FINAL_STATUSES)
+    token_record = {
+        'TaskToken': event['TaskToken'],
+        'Stage': event['Stage'],
+        'AutomationExecutionIds': running_ids
+    }
+    failed_ids = sorted(execution_id for execution_id, status in statuses.items() if status in FINAL_STATUSES and status != 'Success')
+    if failed_ids or not running_ids:
+        execution_id = (failed_ids or sorted(execution_ids))[0]
+        print("Automation '%s' already finished with status '%s'" % (execution_id, statuses[execution_id]))
+        send_task_success(token_record, execution_id, statuses[execution_id])
+        return {'AutomationExecutionIds': []}
+
+    # The status change events are only received from this region
+    remote_ids = [execution_id for execution_id in running_ids if execution_ids[execution_id] != region]
+    if remote_ids:
+        raise ValueError("Automations %s do not run in '%s' and can not be awaited" % (json.dumps(remote_ids), region))
+
+    for execution_id in running_ids:
+        put_token_record(get_token_param(execution_id), token_record)
+
+    # Step 3 - An automation that finished before the token was stored sends no further event
+    for execution_id in running_ids:
+        status = get_automation_status(region, execution_id)
+        if status in FINAL_STATUSES:
+            print("Automation '%s' already finished with status '%s'" % (execution_id, status))
+            send_task_success(token_record, execution_id, status)
+            break
+
+    return {'AutomationExecutionIds': running_ids}
+
+
+def resume_execution(event):
+
+    '''
+        Resume the state machine waiting for the automation of a status change event
+    '''
+
+    # Step 1
+    execution_id = event['detail']['ExecutionId']
+    status = event['detail']['Status']
+    if status not in FINAL_STATUSES:
+        print("Automation '%s' is '%s'. Nothing to resume" % (execution_id, status))
+        return {'Resumed': False}
+
+    # Step 2
+    token_record = get_token_record(get_token_param(execution_id))
+    if not token_record:
+        print("No state machine is waiting for automation '%s'" % execution_id)
+        return {'Resumed': False}
+
+    # Step 3
+    resumed = send_task_success(token_record, execution_id, status)
+    return {'Resumed': resumed, 'Stage': token_record['Stage']}
+
+
+def get_awaited_executions(stage, state):
+
+    '''
+        Get the region of every running automation of the stage by execution id
+    '''
+
+    if stage == 'test':
+        return {state['TestAutomationExecutionId']: region}
+
+    if state.get('BuildStage') == 'variants':
+        return {execution_id: region for execution_id in state['VariantAutomationExecutionIds'].values()}
+
+    execution_ids = {
+        execution_id: build_region
+        for build_region, execution_id in state.get('BuildAutomationExecutionIds', {}).items()
+    }
+    if 'BuildAutomationExecutionId' in state:
+        execution_ids[state['BuildAutomationExecutionId']] = region
+
+    return execution_ids
+
+
+def send_task_success(token_record, execution_id, status):
+
+    '''
+        Resume the waiting state and remove its token records
+    '''
+
+    client = boto3.client('stepfunctions', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        client.send_task_success(
+            taskToken=token_record['TaskToken'],
+            output=json.dumps({'AutomationExecutionId': execution_id, 'Status': status})
+        )
+        print("Resumed the '%s' stage waiting for automation '%s'" % (token_record['Stage'], execution_id))
+        resumed = True
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] not in STALE_TOKEN_ERRORS:
+            print(exc)
+            raise exc
+        print("The '%s' stage is no longer waiting. %s" % (token_record['Stage'], exc.response['Error']['Code']))
+        resumed = False
+
+    for awaited_execution_id in token_record['AutomationExecutionIds']:
+        delete_token_record(get_token_param(awaited_execution_id))
+
+    return resumed
+
+
+def get_automation_status(execution_region, execution_id):
+
+    '''
+        Get the status of the SSM automation
+    '''
+
+    client = boto3.client('ssm', region_name=execution_region, config=CLIENT_CONFIG)
+
+    try:
+        ssm_response = client.get_automation_execution(
+            AutomationExecutionId=execution_id
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return ssm_response['AutomationExecution']['AutomationExecutionStatus']
+
+
+def get_token_param(execution_id):
+
+    '''
+        Get the parameter holding the task token waiting for the automation
+    '''
+
+    return '/' + solution_naming + '/taskTokens/' + execution_id
+
+
+def get_token_path(token_param):
+
+    '''
+        Get the local stand-in file of a token record
+    '''
+
+    return os.path.join(token_dir, token_param.strip('/').replace('/', '_') + '.json')
+
+
+def get_token_record(token_param):
+
+    '''
+        Get the token record, empty if there is none
+    '''
+
+    if token_store == 'local':
+        try:
+            with open(get_token_path(token_param), 'r') as token_file:
+                return json.load(token_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=token_param,
+        )
+        return json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + token_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            return {}
+        print(exc)
+        raise exc
+
+
+def put_token_record(token_param, token_record):
+
+    '''
+        Store the token record
+    '''
+
+    if token_store == 'local':
+        os.makedirs(token_dir, exist_ok=True)
+        with open(get_token_path(token_param), 'w') as token_file:
+            json.dump(token_record, token_file)
+        return
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        client.put_parameter(
+            Name=token_param,
+            Value=json.dumps(token_record),
+            Type='String',
+            Overwrite=True
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def delete_token_record(token_param):
+
+    '''
+        Delete the token record if it exists
+    '''
+
+    if token_store == 'local':
+        try:
+            os.remove(get_token_path(token_param))
+        except FileNotFoundError:
+            pass
+        return
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        client.delete_parameter(
+            Name=token_param
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] != "ParameterNotFound":
+            print(exc)
+            raise exc
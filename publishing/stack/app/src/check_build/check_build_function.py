@@ -5,17 +5,33 @@ This module checks the status of a ssm automation execution and takes actions ba
 '''
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import boto3
 import botocore
 
+from soe_common.automation import (
+    SNAPSHOTS, ExecutionSnapshot, classify_status, get_client, get_client_token, get_execution_snapshot, get_next_poll_seconds,
+    get_progress, get_shared_execution, get_shared_executions, get_step_seconds, put_progress_metrics, put_step_metrics,
+    start_test_automation
+)
+
 
 print('Loading function ' + datetime.now().time().isoformat())
 
 ### Environment variables ###
 # General
 region = os.environ['Region']
+max_region_workers = int(os.environ.get('MaxRegionWorkers', '4'))
+variant_ssm_document = os.environ.get('VariantSSMDocument', '')
+shared_status = os.environ.get('SharedStatus', 'false')
+fused_advance = os.environ.get('FusedAdvance', 'false')
+test_ssm_document = os.environ.get('TestSSMDocument', '')
+spot_test_ssm_document = os.environ.get('SpotTestSSMDocument', '')
+use_spot_test = os.environ.get('UseSpotTest', 'false')
+
+# Printed by the updateOS command when no package was changed
+NO_UPDATES_MARKER = 'SOE_NO_UPDATES_APPLIED'
 
 def lambda_handler(event, context):
 
@@ -25,17 +41,101 @@ def lambda_handler(event, context):
 
     print("Event: " + json.dumps(event))
 
-    build_automation_execution_id = event['BuildAutomationExecutionId']
-
     try:
-        # Step 1
-        state = check_ssm(region, build_automation_execution_id)
+        SNAPSHOTS.clear()
+        event.pop('NextPollSeconds', None)
+        event.pop('BuildProgress', None)
+        event.pop('Advanced', None)
+        # Step 0 - Read the status published by the shared poller first
+        shared_executions = get_shared_executions(region) if shared_status == 'true' else {}
+
+        if 'BuildAutomationExecutionIds' in event:
+            # Step 1 - Poll the build in every region at once
+            regional_states = check_regional_ssm(event['BuildAutomationExecutionIds'], shared_executions)
+            print("Regional States: " + json.dumps(regional_states))
+            event["RegionalBuildStatus"] = regional_states
+            state = aggregate_states(regional_states, 'BuildAutomationExecutionId' in event)
+        elif 'VariantAutomationExecutionIds' in event:
+            # Step 1 - Poll every variant build at once
+            variant_states = check_variant_ssm(region, event['VariantAutomationExecutionIds'], shared_executions)
+            print("Variant States: " + json.dumps(variant_states))
+            event["VariantBuildStatus"] = variant_states
+            state = aggregate_states(variant_states, True)
+        else:
+            # Step 1
+            state = check_ssm(region, event['BuildAutomationExecutionId'], shared_executions)
         print("State: " + state)
+
         # Step 2
-        instance_id = get_instance_id(region, build_automation_execution_id)
-        print("Instance ID: " + instance_id)
+        if 'BuildAutomationExecutionId' in event:
+            if state == 'running' and event['BuildAutomationExecutionId'] in shared_executions:
+                # The outputs of a running build are only read once it has finished
+                build_execution = get_shared_execution(shared_executions[event['BuildAutomationExecutionId']], event.get('StepDurations', {}))
+            else:
+                build_execution = get_execution_snapshot(region, event['BuildAutomationExecutionId'])
+                instance_id = build_execution.instance_id
+                print("Instance ID: " + instance_id)
+                event["InstanceID"] = instance_id
+
+            # Step 3 - Nothing to test or publish when the build applied no updates and created no image
+            if state == 'succeeded' and is_no_update_build(build_execution.outputs):
+                print("No updates applied by '%s'. No image created" % event['BuildAutomationExecutionId'])
+                state = 'no-op'
+
+            # Step 4 - Finish every variant from the shared base image, the first variant is tested and published
+            if state == 'succeeded' and event.get('BuildStage') == 'base':
+                event['BaseImageId'] = build_execution.image_id
+                event['BaseAutomationExecutionId'] = event['BuildAutomationExecutionId']
+                base_step_seconds = get_step_seconds(build_execution)
+                event.setdefault('StepSeconds', {}).update(base_step_seconds)
+                put_step_metrics('build', base_step_seconds)
+                event['VariantAutomationExecutionIds'] = start_variant_builds(region, event)
+                print("VariantAutomationExecutionIds: " + json.dumps(event['VariantAutomationExecutionIds']))
+                event['BuildAutomationExecutionId'] = event['VariantAutomationExecutionIds'][event['BuildVariants'][0]['Name']]
+                build_execution = ExecutionSnapshot({'DocumentName': variant_ssm_document})
+                event['BuildStage'] = 'variants'
+                state = 'running'
+
+            # Step 5 - Record the variant images and remove the base image once every variant is done
+            elif state in ['succeeded', 'failed'] and event.get('BuildStage') == 'variants':
+                if state == 'succeeded':
+                    event['VariantAMIs'] = {
+                        name: get_execution_snapshot(region, execution_id).image_id
+                        for name, execution_id in event['VariantAutomationExecutionIds'].items()
+                    }
+                    print("VariantAMIs: " + json.dumps(event['VariantAMIs']))
+                else:
+                    # The variants are released together, the images of the variants that succeeded are not kept
+                    for name, variant_state in event['VariantBuildStatus'].items():
+                        if variant_state == 'succeeded':
+                            delete_image(region, get_execution_snapshot(region, event['VariantAutomationExecutionIds'][name]).image_id)
+                delete_image(region, event['BaseImageId'])
+                event['BuildStage'] = 'done'
+
+            # Step 6 - Sleep until the build is expected to finish, then poll tightly
+            if state == 'running':
+                event['NextPollSeconds'] = get_next_poll_seconds(event.get('StepDurations', {}), build_execution)
+                print("NextPollSeconds: %s" % event['NextPollSeconds'])
+                event['BuildProgress'] = get_progress(event.get('StepDurations', {}), build_execution)
+                print("BuildProgress: " + json.dumps(event['BuildProgress']))
+                put_progress_metrics('build', event['BuildProgress'])
+
+            # Step 7 - The step durations of the build are recorded once the SOE is released
+            elif state == 'succeeded':
+                step_seconds = get_step_seconds(build_execution)
+                event.setdefault('StepSeconds', {}).update(step_seconds)
+                put_step_metrics('build', step_seconds)
+
+                # Step 8 - Start the test in the same invocation instead of returning to the state machine first
+                if fused_advance == 'true':
+                    event['BuildInstanceID'] = event['InstanceID']
+                    event['AMI'] = build_execution.image_id
+                    test_document = start_test_automation(region, event, event['AMI'], test_ssm_document, spot_test_ssm_document, use_spot_test)
+                    print("TestAutomationExecutionId: " + event['TestAutomationExecutionId'])
+                    event['NextPollSeconds'] = get_next_poll_seconds(event.get('StepDurations', {}), ExecutionSnapshot({'DocumentName': test_document}))
+                    event['Advanced'] = 'test'
+
         event["BuildStatus"] = state
-        event["InstanceID"] = instance_id
         event["CheckType"] = "ssm_build"
         return event
 
@@ -44,80 +144,151 @@ def lambda_handler(event, context):
         raise exc
 
 
-def check_ssm(region, build_automation_execution_id):
+def check_regional_ssm(build_automation_execution_ids, shared_executions=None):
 
     '''
-        Check Build SSM automation
+        Check the Build SSM automation in every region concurrently
+    '''
+
+    workers = min(max_region_workers, len(build_automation_execution_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            build_region: executor.submit(check_ssm, build_region, build_automation_execution_id, shared_executions)
+            for build_region, build_automation_execution_id in build_automation_execution_ids.items()
+        }
+
+    return {build_region: future.result() for build_region, future in futures.items()}
+
+
+def check_variant_ssm(region, variant_automation_execution_ids, shared_executions=None):
+
+    '''
+        Check the variant Build SSM automations concurrently
+    '''
+
+    workers = min(max_region_workers, len(variant_automation_execution_ids))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(check_ssm, region, variant_automation_execution_id, shared_executions)
+            for name, variant_automation_execution_id in variant_automation_execution_ids.items()
+        }
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+def start_variant_builds(region, event):
+
+    '''
+        Start the build of every variant from the base image concurrently
     '''
 
-    client = boto3.client('ssm', region_name=region)
+    primary_variant = event['BuildVariants'][0]['Name']
+    workers = min(max_region_workers, len(event['BuildVariants']))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for build_variant in event['BuildVariants']:
+            variant_parameters = dict(event['VariantParameters'])
+            variant_parameters['sourceAMIid'] = [event['BaseImageId']]
+            variant_parameters['Variant'] = [build_variant['Name']]
+            for component in ['codedeploy', 'corretto']:
+                variant_parameters['Install' + component.capitalize()] = ['true' if component in build_variant['Components'] else 'false']
+            # Only the first variant is found again by the build fingerprint
+            if build_variant['Name'] != primary_variant:
+                variant_parameters['BuildFingerprint'] = ['none']
+            futures[build_variant['Name']] = executor.submit(
+                start_variant_build, region, variant_parameters, get_client_token(event, 'variant-' + build_variant['Name'], region)
+            )
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+def start_variant_build(region, variant_parameters, client_token):
+
+    '''
+        Start the variant Build SSM automation
+    '''
+
+    client = get_client('ssm', region)
+
+    # A replayed step with the same ClientToken gets back the original execution
+    launch_args = {'ClientToken': client_token} if client_token else {}
 
     try:
-        ssm_response = client.get_automation_execution(
-            AutomationExecutionId=build_automation_execution_id
+        ssm_response = client.start_automation_execution(
+            DocumentName=variant_ssm_document,
+            Parameters=variant_parameters,
+            **launch_args
         )
-        state_pending = False
-        state_in_progress = False
-        state_waiting = False
-        state_success = False
-        state_cancelling = False
-        state_failed = False
-        state_cancelled = False
-        state_timed_out = False
-
-        if ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Pending':
-            state_pending = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'InProgress':
-            state_in_progress = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Waiting':
-            state_waiting = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Success':
-            state_success = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Cancelling':
-            state_cancelling = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Failed':
-            state_failed = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Cancelled':
-            state_cancelled = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'TimedOut':
-            state_timed_out = True
-        else:
-            print("State Unknown")
-
-        if state_pending or state_in_progress or state_waiting:
-            state = 'running'
-        elif state_success:
-            state = 'succeeded'
-        elif state_cancelling or state_failed or state_cancelled or state_timed_out:
-            state = 'failed'
-        else:
-            state = 'unknown'
 
     except botocore.exceptions.ClientError as exc:
         print(exc)
         raise exc
 
-    return state
+    return ssm_response['AutomationExecutionId']
+
 
-def get_instance_id(region, build_automation_execution_id):
+def delete_image(region, image_id):
 
     '''
-        Get instance ID for build instance
+        Deregister the image and delete its snapshots
     '''
 
-    client = boto3.client('ssm', region_name=region)
+    client = get_client('ec2', region)
 
     try:
-        ssm_response = client.get_automation_execution(
-            AutomationExecutionId=build_automation_execution_id
-        )
-
-        scan_output = ssm_response['AutomationExecution']['Outputs']['startInstances.InstanceIds'][0]
-        scan_output_format = scan_output.strip()
-        instance_id = scan_output_format.strip('"')
+        images = client.describe_images(ImageIds=[image_id])['Images']
+        client.deregister_image(ImageId=image_id)
+        for block_device in images[0].get('BlockDeviceMappings', []) if images else []:
+            if 'Ebs' in block_device:
+                client.delete_snapshot(SnapshotId=block_device['Ebs']['SnapshotId'])
+        print("Deleted image '%s'" % image_id)
 
     except botocore.exceptions.ClientError as exc:
         print(exc)
         raise exc
 
-    return instance_id
+
+def aggregate_states(regional_states, local_build):
+
+    '''
+        Combine the regional build states into one build state
+    '''
+
+    states = regional_states.values()
+    if 'failed' in states:
+        state = 'failed'
+    elif 'unknown' in states:
+        state = 'unknown'
+    elif 'running' in states:
+        state = 'running'
+    elif local_build:
+        state = 'succeeded'
+    else:
+        # The local region reused an existing image, only the other regions were built
+        state = 'skipped'
+
+    return state
+
+
+def check_ssm(region, build_automation_execution_id, shared_executions=None):
+
+    '''
+        Check Build SSM automation
+    '''
+
+    # The status published by the shared poller saves the API call
+    if shared_executions and build_automation_execution_id in shared_executions:
+        automation_status = shared_executions[build_automation_execution_id][0]
+    else:
+        automation_status = get_execution_snapshot(region, build_automation_execution_id).status
+
+    return classify_status(automation_status)
+
+
+def is_no_update_build(build_outputs):
+
+    '''
+        Check if the build skipped the image creation because no updates were applied
+    '''
+
+    return any(NO_UPDATES_MARKER in output for output in build_outputs.get('checkUpdatesApplied.Output', []))
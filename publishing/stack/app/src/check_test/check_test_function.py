@@ -6,12 +6,17 @@ This module checks the status on the test ssm autoamtion run vulenerability scan
 import json
 import logging
 import os
-from datetime import datetime
-import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
 
-import boto3
 import botocore
 
+from soe_common.automation import (
+    RECORD_DATE_FORMAT, SNAPSHOTS, classify_status, get_client, get_execution_snapshot, get_next_poll_seconds, get_progress,
+    get_shared_execution, get_shared_executions, get_step_seconds, put_progress_metrics, put_step_metrics
+)
+from soe_common.findings import get_finding_rules
+
 
 print('Loading function ' + datetime.now().time().isoformat())
 
@@ -19,6 +24,24 @@ print('Loading function ' + datetime.now().time().isoformat())
 # General
 region = os.environ['Region']
 exception_list = os.environ['VulnerabilityExceptionsList']
+exceptions_bucket = os.environ.get('VulnerabilityExceptionsBucket', '')
+exceptions_key = os.environ.get('VulnerabilityExceptionsKey', '')
+shared_status = os.environ.get('SharedStatus', 'false')
+fused_advance = os.environ.get('FusedAdvance', 'false')
+inspec_report_timeout = int(os.environ.get('InSpecReportTimeout', '900'))
+max_findings_workers = int(os.environ.get('MaxFindingsWorkers', '4'))
+findings_fail_fast = os.environ.get('FindingsFailFast', 'false')
+
+# Launch failures of the spot test instance that are retried on demand
+CAPACITY_ERRORS = [
+    'InsufficientInstanceCapacity',
+    'SpotMaxPriceTooLow',
+    'MaxSpotInstanceCountExceeded',
+    'capacity-not-available',
+]
+
+# Most finding ARNs describe_findings accepts in one call
+DESCRIBE_FINDINGS_LIMIT = 100
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -30,63 +53,114 @@ def lambda_handler(event, context):
     '''
 
     print("Event: " + json.dumps(event))
+    SNAPSHOTS.clear()
 
-    global exception_list
-    exception_list = event['IgnoreFindings'] if 'IgnoreFindings' in event else None
     ignore_failure = event['IgnoreTestFailure'] == 'True' if 'IgnoreTestFailure' in event else False
 
     test_automation_execution_id = event['TestAutomationExecutionId']
 
     try:
-        # Step 1
-        ssm_state = check_ssm(region, test_automation_execution_id)
+        # Step 1 - A running test is read from the shared poller, otherwise one snapshot serves every check below
+        event.pop('NextPollSeconds', None)
+        event.pop('TestProgress', None)
+        event.pop('Advanced', None)
+        shared_executions = get_shared_executions(region) if shared_status == 'true' else {}
+        test_execution = None
+        if test_automation_execution_id in shared_executions:
+            test_execution = get_shared_execution(shared_executions[test_automation_execution_id], event.get('StepDurations', {}))
+        if not test_execution or classify_status(test_execution.status) != 'running':
+            test_execution = get_execution_snapshot(region, test_automation_execution_id)
+        ssm_state = classify_status(test_execution.status)
         print("SSM Automation State: " + ssm_state)
-        # Step 2
-        instance_id = get_instance_id(region, test_automation_execution_id)
-        print("Instance ID: " + instance_id)
-        event["InstanceID"] = instance_id
+
+        # Step 1a - Fall back to on-demand when there was no spot capacity for the test instance
+        if ssm_state == 'failed' and event.get('TestCapacity') == 'spot' and is_capacity_failure(test_execution):
+            print("Spot capacity unavailable for the test instance. Retrying on demand")
+            event['TestCapacity'] = 'on-demand'
+            event['TestStatus'] = 'retry'
+            return event
+
+        # Step 2 - The outputs of a running test from the shared poller are only read once it has finished
+        if test_execution.outputs:
+            instance_id = test_execution.instance_id
+            print("Instance ID: " + instance_id)
+            event["InstanceID"] = instance_id
 
         if ssm_state == 'succeeded':
 
-            # Step 3
-            inspector_state = vulnerability_status(region, test_automation_execution_id)
+            # Step 3 - Read the Inspector and InSpec tracks at once
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                inspector_future = executor.submit(vulnerability_status, test_execution)
+                inspec_future = executor.submit(get_inspec_test_result, region, instance_id)
+            inspector_state = inspector_future.result()
+            inspec_test_output = inspec_future.result()
             print("Inspector Scan State: " + inspector_state)
-            if inspector_state == 'succeeded':
-
-                # Step 4
-                inspec_test_output = get_inspec_test_result(region, instance_id)
-                print("InSpec Status: " + inspec_test_output)
+            print("InSpec Status: %s" % inspec_test_output)
+
+            # The compliance is expected within InSpecReportTimeout of the first check of a finished test
+            inspec_expired = False
+            if not inspec_test_output:
+                event.setdefault('InSpecDeadline', (datetime.utcnow() + timedelta(seconds=inspec_report_timeout)).strftime(RECORD_DATE_FORMAT))
+                inspec_expired = datetime.utcnow() > datetime.strptime(event['InSpecDeadline'], RECORD_DATE_FORMAT)
+
+            # Step 4 - A non compliant or missing InSpec result fails the test without waiting out the Inspector assessment
+            if inspec_test_output == 'NON_COMPLIANT' or (not inspec_test_output and inspec_expired):
+                if inspector_state == 'running':
+                    stop_vulnerability_scan(test_execution)
+                event["TestStatus"] = 'failed'
+                event["CheckType"] = "inspec" if inspec_test_output else "inspec_not_reported"
+
+            elif inspector_state != 'succeeded':
+                event["TestStatus"] = inspector_state
+                event["CheckType"] = "inspector"
 
-                if inspec_test_output == 'COMPLIANT':
+            elif not inspec_test_output:
+                print("InSpec compliance not reported yet. Checking again until " + event['InSpecDeadline'])
+                event["TestStatus"] = 'running'
+                event["CheckType"] = "inspec"
 
-                    # Step 5
-                    vulnerability_result_output, vulnerability_result_stats = vulnerability_result(region, test_automation_execution_id)
-                    print("Vulnerability Status: " + vulnerability_result_output)
-                    print("Vulnerability Stats: %s" % vulnerability_result_stats)
+            else:
 
-                    event["VulnerabilityFindingsStats"] = vulnerability_result_stats
-                    if vulnerability_result_output == 'Passed':
-                        event["TestStatus"] = 'succeeded'
-                    else:
-                        event["TestStatus"] = 'failed'
-                        event["CheckType"] = "vulnerability"
+                # Step 5
+                finding_rules = get_finding_rules(event['IgnoreFindings'] if 'IgnoreFindings' in event else exception_list, region, exceptions_bucket, exceptions_key)
+                vulnerability_result_output, vulnerability_result_stats = vulnerability_result(test_execution, finding_rules)
+                print("Vulnerability Status: " + vulnerability_result_output)
+                print("Vulnerability Stats: %s" % vulnerability_result_stats)
 
+                event["VulnerabilityFindingsStats"] = vulnerability_result_stats
+                if vulnerability_result_output == 'Passed':
+                    event["TestStatus"] = 'succeeded'
                 else:
                     event["TestStatus"] = 'failed'
-                    event["CheckType"] = "inspec"
-
-            else:
-                event["TestStatus"] = inspector_state
-                event["CheckType"] = "inspector"
+                    event["CheckType"] = "vulnerability"
 
         else:
             event["TestStatus"] = ssm_state
             event["CheckType"] = "ssm_test"
 
+        # Step 6 - Sleep until the test automation is expected to finish, then poll tightly
+        if ssm_state == 'running':
+            event['NextPollSeconds'] = get_next_poll_seconds(event.get('StepDurations', {}), test_execution)
+            print("NextPollSeconds: %s" % event['NextPollSeconds'])
+            event['TestProgress'] = get_progress(event.get('StepDurations', {}), test_execution)
+            print("TestProgress: " + json.dumps(event['TestProgress']))
+            put_progress_metrics('test', event['TestProgress'])
+
+        # Step 7 - The step durations of the test are recorded once the SOE is released
+        elif ssm_state == 'succeeded':
+            step_seconds = get_step_seconds(test_execution)
+            event.setdefault('StepSeconds', {}).update(step_seconds)
+            put_step_metrics('test', step_seconds)
+
         if event["TestStatus"] in ['failed', 'unknown'] and ignore_failure:
             print("Check Type '%s' has Status '%s' but IgnoreTestFailure has been set. Setting Status to 'skipped'" % (event["CheckType"], event["TestStatus"]))
             event["TestStatus"] = 'skipped'
 
+        # Step 8 - Terminate the test instance in the same invocation instead of returning to the state machine first
+        if fused_advance == 'true' and event["TestStatus"] in ['succeeded', 'skipped']:
+            terminate_test_instance(region, event)
+            event['Advanced'] = 'terminate'
+
         return event
 
     except BaseException as exc:
@@ -94,80 +168,31 @@ def lambda_handler(event, context):
         raise exc
 
 
-def check_ssm(region, test_automation_execution_id):
+def is_capacity_failure(test_execution):
 
     '''
-        Check Build SSM automation status
+        Check if the test instance launch failed for lack of capacity
     '''
 
-    client = boto3.client('ssm', region_name=region)
-
-    try:
-        ssm_response = client.get_automation_execution(
-            AutomationExecutionId=test_automation_execution_id
-        )
-        state_pending = False
-        state_in_progress = False
-        state_waiting = False
-        state_success = False
-        state_cancelling = False
-        state_failed = False
-        state_cancelled = False
-        state_timed_out = False
-
-        if ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Pending':
-            state_pending = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'InProgress':
-            state_in_progress = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Waiting':
-            state_waiting = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Success':
-            state_success = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Cancelling':
-            state_cancelling = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Failed':
-            state_failed = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'Cancelled':
-            state_cancelled = True
-        elif ssm_response['AutomationExecution']['AutomationExecutionStatus'] == 'TimedOut':
-            state_timed_out = True
-        else:
-            print("State Unknown")
-
-        if state_pending or state_in_progress or state_waiting:
-            state = 'running'
-        elif state_success:
-            state = 'succeeded'
-        elif state_cancelling or state_failed or state_cancelled or state_timed_out:
-            state = 'failed'
-        else:
-            state = 'unknown'
+    for step in test_execution.step_executions:
+        if step['StepName'] == 'startInstances' and step['StepStatus'] == 'Failed':
+            failure_message = step.get('FailureMessage', '')
+            print("Test instance launch failed: " + failure_message)
+            return any(error in failure_message for error in CAPACITY_ERRORS)
 
-    except botocore.exceptions.ClientError as exc:
-        print(exc)
-        raise exc
-
-    return state
+    return False
 
 
-def vulnerability_status(region, test_automation_execution_id):
+def vulnerability_status(test_execution):
 
     '''
         Get vulnerability run status
     '''
 
-    ssm_client = boto3.client('ssm', region_name=region)
-    inspector_client = boto3.client('inspector')
+    inspector_client = get_client('inspector', region)
 
     try:
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=test_automation_execution_id
-        )
-
-        scan_output = ssm_response['AutomationExecution']['Outputs']['runVulnerabilityScan.Output'][0]
-        scan_output_format = scan_output.strip()
-        inspector_assessment_run_arn = scan_output_format.strip('"')
-        #print("SSM Vulnerability Output: " + inspector_assessment_run_arn)
+        inspector_assessment_run_arn = test_execution.inspector_run_arn
 
         assesment_run_response = inspector_client.describe_assessment_runs(
             assessmentRunArns=[
@@ -236,39 +261,35 @@ def vulnerability_status(region, test_automation_execution_id):
     return state
 
 
-def is_breaking_finding(findings_detail, stats):
+def stop_vulnerability_scan(test_execution):
+
+    '''
+        Stop the Inspector assessment run of a test that already failed
+    '''
+
+    inspector_client = get_client('inspector', region)
+
+    try:
+        inspector_client.stop_assessment_run(
+            assessmentRunArn=test_execution.inspector_run_arn,
+            stopAction='SKIP_EVALUATION'
+        )
+        print("Stopped Inspector assessment run " + test_execution.inspector_run_arn)
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def is_breaking_finding(findings_detail, stats, finding_rules):
     """
         Determine if a finding is a breaking failure.
     """
-    # Ignore user exceptions list
-    if exception_list and findings_detail['id'] in exception_list:
-        if 'ExceptionList' in stats:
-            stats['ExceptionList'] += 1
-        else:
-            stats['ExceptionList'] = 1
-        logger.debug("Finding '%s' is in VulnerabilityExceptionsList, ignoring.", findings_detail['id'])
-        return False
-
-    # Ignore CIS Level 2
-    for attr in findings_detail['attributes']:
-        if attr['key'] == "CIS_BENCHMARK_PROFILE":
-            # Ignore Level 2 as we are currently using CIS Hardened AMI to Level 1 only
-            if "Level 2" in attr['value']:
-                if 'CIS_Level_2' in stats:
-                    stats['CIS_Level_2'] += 1
-                else:
-                    stats['CIS_Level_2'] = 1
-                logger.debug("Finding '%s' has CIS Profile '%s', ignoring.", findings_detail['id'], attr['value'])
-                return False
-
-    # Ignore non High severity
-    if 'severity' in findings_detail and findings_detail['severity'] != 'High':
-        # Update stats about the severity of findings found
-        if findings_detail['severity'] in stats:
-            stats[findings_detail['severity']] += 1
-        else:
-            stats[findings_detail['severity']] = 1
-        logger.debug("Finding '%s' has Severity '%s', ignoring.", findings_detail['id'], findings_detail['severity'])
+    ignore_reason = finding_rules.ignore_reason(findings_detail)
+    if ignore_reason:
+        # Update stats about the rules ignoring findings
+        stats[ignore_reason] = stats.get(ignore_reason, 0) + 1
+        logger.debug("Finding '%s' ignored by the '%s' rule.", findings_detail['id'], ignore_reason)
         return False
 
     # Every other findings are a breaking failure
@@ -276,61 +297,58 @@ def is_breaking_finding(findings_detail, stats):
     return True
 
 
-def vulnerability_result(region, test_automation_execution_id):
+def vulnerability_result(test_execution, finding_rules):
 
     '''
         Get vulnerability scan results
     '''
 
-    ssm_client = boto3.client('ssm', region_name=region)
-    inspector_client = boto3.client('inspector')
+    inspector_client = get_client('inspector', region)
     stats = {}
+    ignored_findings = []
+    breaking_findings = []
+
+    def classify_findings(findings_future):
+        # For each finding, filter down to breaking findings only
+        for findings_detail in findings_future.result()['findings']:
+            if is_breaking_finding(findings_detail, stats, finding_rules):
+                breaking_findings.append(findings_detail['id'])
+            else:
+                ignored_findings.append(findings_detail['id'])
 
     try:
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=test_automation_execution_id
-        )
-
-        scan_output = ssm_response['AutomationExecution']['Outputs']['runVulnerabilityScan.Output'][0]
-        scan_output_format = scan_output.strip()
-        inspector_assessment_run_arn = scan_output_format.strip('"')
+        inspector_assessment_run_arn = test_execution.inspector_run_arn
 
-        # Do while has nextToken (true the first time)
-        has_next_token = True
-        all_findings_arns = []
-        findings_response = {}
+        # Each page of findings is described by the pool while the next page is listed
         next_token_kwargs = {}
-        while has_next_token:
-            findings_response = inspector_client.list_findings(
-                assessmentRunArns=[inspector_assessment_run_arn], **next_token_kwargs
-            )
-            all_findings_arns += findings_response['findingArns']
-            if 'nextToken' in findings_response and findings_response['nextToken']:
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max_findings_workers) as executor:
+            while True:
+                findings_response = inspector_client.list_findings(
+                    assessmentRunArns=[inspector_assessment_run_arn], maxResults=DESCRIBE_FINDINGS_LIMIT, **next_token_kwargs
+                )
+                if findings_response['findingArns']:
+                    pending.add(executor.submit(describe_findings, findings_response['findingArns']))
+
+                # Classify the pages already described, with at most one page per worker in flight
+                done, pending = wait(pending, timeout=None if len(pending) >= max_findings_workers else 0, return_when=FIRST_COMPLETED)
+                for findings_future in done:
+                    classify_findings(findings_future)
+
+                if breaking_findings and findings_fail_fast == 'true':
+                    print("Breaking finding found. Skipping the remaining findings")
+                    for findings_future in pending:
+                        findings_future.cancel()
+                    break
+                if not findings_response.get('nextToken'):
+                    for findings_future in as_completed(pending):
+                        classify_findings(findings_future)
+                    break
                 next_token_kwargs = {'nextToken': findings_response['nextToken']}
-            else:
-                has_next_token = False
-
-        # Using List comprehension to break the list in the chunks of 100 as describe_findings 
-        # call can only accept 100 findings ARNs only at max
-        n = 100
-        findings_arns_chunks = [all_findings_arns[i * n:(i + 1) * n] for i in range((len(all_findings_arns) + n - 1) // n )]
-        ignored_findings = []
-        breaking_findings = []
-        for finding_arns in findings_arns_chunks:   
-            findings_details = inspector_client.describe_findings(
-                findingArns=finding_arns
-            )
-
-            # For each finding, filter down to breaking findings only
-            for findings_detail in findings_details['findings']:
-                if is_breaking_finding(findings_detail, stats):
-                    breaking_findings.append(findings_detail['id'])
-                else:
-                    ignored_findings.append(findings_detail['id'])
 
         print("%s High Vulnerabilities Found With No Exception" % len(breaking_findings))
         print("%s Vulnerabilities Ignored" % len(ignored_findings))
-        
+
         if breaking_findings:
             result = 'Failed'
         else:
@@ -343,80 +361,86 @@ def vulnerability_result(region, test_automation_execution_id):
     return result, stats
 
 
+def describe_findings(finding_arns):
+
+    '''
+        Describe one page of findings
+    '''
+
+    inspector_client = get_client('inspector', region)
+
+    return inspector_client.describe_findings(
+        findingArns=finding_arns
+    )
+
+
 def get_inspec_test_result(region, instance_id):
 
     '''
-        Gets the compliance result of the InSpec test
+        Gets the compliance result of the InSpec test, None until the instance reports it
     '''
 
-    ssm_client = boto3.client('ssm', region_name=region)
+    ssm_client = get_client('ssm', region)
 
     try:
-        # run a loop to check SSM Compliance API whether instance is compliant or not
-        while True:
-            lrcs_response = ssm_client.list_resource_compliance_summaries(
-                Filters=[
-                    {
-                        'Key': 'ComplianceType',
-                        'Values': [
-                            'Custom:Inspec',
-                        ]
-                    },
-                    {
-                        'Key': 'InstanceId',
-                        'Values': [
-                            instance_id
-                        ]
-                    }
-                ]
-            )
-
-            # set compliance status to None
-            instance_compliance = None
-
-            for c_items in lrcs_response['ResourceComplianceSummaryItems']:
-                if c_items['ResourceId'] == instance_id:
-                    print(c_items['ResourceId'])
-                    print(c_items['Status'])
-                    if c_items['Status'] == 'COMPLIANT':
-                        print("Passed")
-                        instance_compliance = 'COMPLIANT'
-                    elif c_items['Status'] == 'NON_COMPLIANT':
-                        print("Failed")
-                        instance_compliance = 'NON_COMPLIANT'
-            if instance_compliance == 'COMPLIANT':
-                break
-            elif instance_compliance == 'NON_COMPLIANT':
-                break
-            else:
-                print("Retrying after 5 seconds...")
-                time.sleep(5)
+        # A single check, the state machine waits between the checks
+        lrcs_response = ssm_client.list_resource_compliance_summaries(
+            Filters=[
+                {
+                    'Key': 'ComplianceType',
+                    'Values': [
+                        'Custom:Inspec',
+                    ]
+                },
+                {
+                    'Key': 'InstanceId',
+                    'Values': [
+                        instance_id
+                    ]
+                }
+            ]
+        )
 
-    except:
-        raise
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    # set compliance status to None
+    instance_compliance = None
+
+    for c_items in lrcs_response['ResourceComplianceSummaryItems']:
+        if c_items['ResourceId'] == instance_id:
+            print(c_items['ResourceId'])
+            print(c_items['Status'])
+            if c_items['Status'] == 'COMPLIANT':
+                print("Passed")
+                instance_compliance = 'COMPLIANT'
+            elif c_items['Status'] == 'NON_COMPLIANT':
+                print("Failed")
+                instance_compliance = 'NON_COMPLIANT'
 
     return instance_compliance
 
 
-def get_instance_id(region, test_automation_execution_id):
+def terminate_test_instance(region, event):
 
     '''
-        Get instance ID for test instance
+        Terminate the test instance as terminate_test_ec2 does
     '''
 
-    client = boto3.client('ssm', region_name=region)
+    if event.get('KeepTestInstance') == 'True':
+        print("KeepTestInstance is True. Skipping termination of '%s'" % event['InstanceID'])
+        return
+
+    client = get_client('ec2', region)
 
     try:
-        ssm_response = client.get_automation_execution(
-            AutomationExecutionId=test_automation_execution_id
+        terminate_response = client.terminate_instances(
+            InstanceIds=[event['InstanceID']]
         )
-
-        scan_output = ssm_response['AutomationExecution']['Outputs']['startInstances.InstanceIds'][0]
-        scan_output_format = scan_output.strip()
-        instance_id = scan_output_format.strip('"')
+        print(terminate_response)
 
     except botocore.exceptions.ClientError as exc:
         print(exc)
         raise exc
 
-    return instance_id
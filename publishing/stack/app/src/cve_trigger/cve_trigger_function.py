@@ -0,0 +1,307 @@
+'''
+
+This module starts the SOE build when a newly published security advisory applies to the packages of the current SOE AMI.
+
+'''
+import json
+import os
+import re
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import boto3
+import botocore
+
+
+print('Loading function ' + datetime.now().time().isoformat())
+
+### Environment variables ###
+# General
+solution_naming = os.environ['SolutionNaming']
+region = os.environ['Region']
+soe_type = os.environ['SOEType']
+next_ami_ssm_param = os.environ['NextAMIParam']
+state_machine_arn = os.environ['StateMachineArn']
+advisory_feed_url = os.environ.get('AdvisoryFeedUrl', 'https://alas.aws.amazon.com/AL2/alas.rss')
+advisory_feed_file = os.environ.get('AdvisoryFeedFile', '')
+min_severity = os.environ.get('MinSeverity', 'important')
+
+# Amazon Linux advisory severities, lowest first
+SEVERITIES = ['low', 'medium', 'important', 'critical']
+
+# e.g. "ALAS2-2023-2001 (important): kernel, kernel-headers"
+ADVISORY_TITLE_REGEX = re.compile(r'^(?P<id>ALAS[\w-]+)\s+\((?P<severity>\w+)\):\s*(?P<packages>.+)$')
+
+def lambda_handler(event, context):
+
+    '''
+        Run function and return output.
+    '''
+
+    print("Event: " + json.dumps(event))
+
+    try:
+        # Step 1 - Get the published advisories (a local feed file can be set for offline testing)
+        feed_body = read_feed(event.get('AdvisoryFeedFile', advisory_feed_file), advisory_feed_url)
+        advisories = parse_advisories(feed_body)
+        print("%s advisories in the feed" % len(advisories))
+
+        # Step 2 - Get the current SOE image and its installed packages
+        next_ami_id = get_ssm_param(region, next_ami_ssm_param)
+        image = get_image(region, next_ami_id)
+        image_created = datetime.strptime(image['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+        packages = get_package_inventory(region, image)
+        print("SOE image '%s' created '%s' has %s packages" % (next_ami_id, image['CreationDate'], len(packages)))
+
+        # Step 3 - Match the advisories published since the image was built and not triggered yet
+        trigger_state_param = '/' + solution_naming + '/' + soe_type + '/advisoryTrigger'
+        trigger_state = get_trigger_state(region, trigger_state_param)
+        applicable = find_applicable_advisories(advisories, packages, image_created, trigger_state.get('Advisories', []))
+        event['ApplicableAdvisories'] = [advisory['Id'] for advisory in applicable]
+        print("Applicable advisories: " + json.dumps(event['ApplicableAdvisories']))
+
+        if not applicable:
+            print("No new applicable advisory. Skipping build")
+            event['BuildTriggered'] = False
+            return event
+
+        # Step 4 - Start the build and remember the advisories it covers
+        execution_arn = start_build(region, state_machine_arn, event['ApplicableAdvisories'])
+        print("Started build '%s'" % execution_arn)
+        triggered = [advisory['Id'] for advisory in advisories if advisory['Published'] > image_created]
+        put_trigger_state(region, trigger_state_param, {
+            'Advisories': sorted(set(triggered) & set(trigger_state.get('Advisories', []) + event['ApplicableAdvisories'])),
+            'TriggeredAt': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        })
+
+        event['BuildTriggered'] = True
+        event['BuildExecutionArn'] = execution_arn
+        return event
+
+    except BaseException as exc:
+        print(exc)
+        raise exc
+
+
+def read_feed(feed_file, feed_url):
+
+    '''
+        Read the advisory RSS feed from the local file if set, otherwise from the feed URL
+    '''
+
+    if feed_file:
+        print("Reading advisories from file '%s'" % feed_file)
+        with open(feed_file, 'r') as feed:
+            return feed.read()
+
+    print("Reading advisories from '%s'" % feed_url)
+    with urllib.request.urlopen(feed_url, timeout=30) as response:
+        return response.read().decode('utf-8')
+
+
+def parse_advisories(feed_body):
+
+    '''
+        Parse the advisories out of the RSS feed items
+    '''
+
+    advisories = []
+    for item in ElementTree.fromstring(feed_body).iter('item'):
+        match = ADVISORY_TITLE_REGEX.match(item.findtext('title', '').strip())
+        if not match:
+            print("Ignoring feed item '%s'" % item.findtext('title'))
+            continue
+        advisories.append({
+            'Id': match.group('id'),
+            'Severity': match.group('severity').lower(),
+            'Packages': [package.strip() for package in match.group('packages').split(',') if package.strip()],
+            'Published': parsedate_to_datetime(item.findtext('pubDate')),
+        })
+
+    return advisories
+
+
+def find_applicable_advisories(advisories, packages, image_created, triggered_advisories):
+
+    '''
+        Get the advisories at or above the minimum severity, published after the image and for an installed package
+    '''
+
+    if min_severity not in SEVERITIES:
+        raise ValueError("MinSeverity '%s' must be one of %s" % (min_severity, ", ".join(SEVERITIES)))
+
+    applicable = []
+    for advisory in advisories:
+        if advisory['Id'] in triggered_advisories or advisory['Published'] <= image_created:
+            continue
+        if advisory['Severity'] not in SEVERITIES or SEVERITIES.index(advisory['Severity']) < SEVERITIES.index(min_severity):
+            continue
+        # Without an inventory every advisory is assumed to apply
+        if packages and not any(is_package_installed(package, packages) for package in advisory['Packages']):
+            continue
+        applicable.append(advisory)
+
+    return applicable
+
+
+def is_package_installed(source_package, packages):
+
+    '''
+        Check if the source package of an advisory or one of its sub packages (e.g. openssl-libs) is installed
+    '''
+
+    return any(package == source_package or package.startswith(source_package + '-') for package in packages)
+
+
+def get_ssm_param(region, ssm_param):
+
+    '''
+        Get the SSM Parameter value
+    '''
+
+    try:
+        client = boto3.client('ssm', region_name=region)
+
+        get_parameter_response = client.get_parameter(
+            Name=ssm_param,
+        )
+        current_value = get_parameter_response['Parameter']['Value']
+
+        print("Retrieved SSM Param '" + ssm_param + "' with value '" + current_value + "'")
+
+        return current_value
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def get_image(region, ami_id):
+
+    '''
+        Get the SOE image
+    '''
+
+    client = boto3.client('ec2', region_name=region)
+
+    try:
+        images = client.describe_images(
+            ImageIds=[ami_id]
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return images['Images'][0]
+
+
+def get_package_inventory(region, image):
+
+    '''
+        Get the package names the SSM Inventory collected on the build instance of the image
+    '''
+
+    client = boto3.client('ssm', region_name=region)
+    tags = {tag['Key']: tag['Value'] for tag in image.get('Tags', [])}
+    if 'SSMExecutionID' not in tags:
+        print("SOE image '%s' has no SSMExecutionID tag. No package inventory" % image['ImageId'])
+        return set()
+
+    try:
+        ssm_response = client.get_automation_execution(
+            AutomationExecutionId=tags['SSMExecutionID']
+        )
+        instance_id = ssm_response['AutomationExecution']['Outputs']['startInstances.InstanceIds'][0].strip().strip('"')
+
+        packages = set()
+        next_token_kwargs = {}
+        while True:
+            inventory_response = client.list_inventory_entries(
+                InstanceId=instance_id,
+                TypeName='AWS:Application',
+                **next_token_kwargs
+            )
+            packages.update(entry['Name'] for entry in inventory_response['Entries'])
+            if not inventory_response.get('NextToken'):
+                break
+            next_token_kwargs = {'NextToken': inventory_response['NextToken']}
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] in ['AutomationExecutionNotFoundException', 'InvalidInstanceId']:
+            print("No package inventory for SOE image '%s': %s" % (image['ImageId'], exc))
+            return set()
+        print(exc)
+        raise exc
+
+    return packages
+
+
+def get_trigger_state(region, ssm_param):
+
+    '''
+        Get the advisories already triggered a build for
+    '''
+
+    client = boto3.client('ssm', region_name=region)
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=ssm_param,
+        )
+        return json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + ssm_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            print("Parameter '" + ssm_param + "' does not exist. Returning empty record")
+            return {}
+        print(exc)
+        raise exc
+
+
+def put_trigger_state(region, ssm_param, state):
+
+    '''
+        Save the advisories a build has been triggered for
+    '''
+
+    client = boto3.client('ssm', region_name=region)
+
+    try:
+        client.put_parameter(
+            Name=ssm_param,
+            Value=json.dumps(state),
+            Type='String',
+            Overwrite=True
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def start_build(region, state_machine_arn, advisory_ids):
+
+    '''
+        Start the build state machine for the advisories
+    '''
+
+    client = boto3.client('stepfunctions', region_name=region)
+
+    try:
+        response = client.start_execution(
+            stateMachineArn=state_machine_arn,
+            name='advisory-' + datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+            input=json.dumps({'Advisories': advisory_ids})
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return response['executionArn']
@@ -0,0 +1,172 @@
+'''
+
+This module loads the SOE catalog describing every SOE Type to build.
+
+'''
+import json
+import os
+from datetime import datetime
+
+import boto3
+import botocore
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+print('Loading function ' + datetime.now().time().isoformat())
+
+### Environment variables ###
+# General
+solution_naming = os.environ['SolutionNaming']
+region = os.environ['Region']
+catalog_bucket = os.environ.get('CatalogBucket', '')
+catalog_key = os.environ.get('CatalogKey', '')
+# SOE Type of this stack, built when there is no catalog
+soe_type = os.environ.get('SOEType', '')
+ami_pattern = os.environ.get('AMIPattern', '')
+ami_owner = os.environ.get('AMIOwner', '')
+override_ami = os.environ.get('OverrideAMI', '')
+architectures_setting = os.environ.get('Architectures', '')
+
+# Settings every catalog entry must provide
+REQUIRED_SETTINGS = ['SOEType', 'AMIPattern', 'AMIOwner']
+
+# Architectures a SOE Type can be built for
+ARCHITECTURES = ['x86_64', 'arm64']
+
+def lambda_handler(event, context):
+
+    '''
+        Run function and return output.
+    '''
+
+    print("Event: " + json.dumps(event))
+
+    try:
+        if catalog_bucket:
+            # Step 1 - Get the catalog document
+            catalog_body = get_catalog(region, catalog_bucket, catalog_key)
+
+            # Step 2 - Parse and validate the SOE Types
+            soe_types = parse_catalog(catalog_key, catalog_body)
+        else:
+            # Step 1 - Build the SOE Type of this stack for each of its architectures
+            print("No SOE catalog. Building SOE Type '%s'" % soe_type)
+            stack_soe = {
+                'SOEType': soe_type,
+                'AMIPattern': ami_pattern,
+                'AMIOwner': ami_owner,
+                'OverrideAMI': override_ami,
+                'Architectures': architectures_setting,
+            }
+            soe_types = get_soe_types('stack', [stack_soe])
+        print("SOE Types: " + json.dumps([soe['SOEType'] for soe in soe_types]))
+
+        event['SOETypes'] = soe_types
+        return event
+
+    except BaseException as exc:
+        print(exc)
+        raise exc
+
+
+def get_catalog(region, catalog_bucket, catalog_key):
+
+    '''
+        Get the catalog document from S3
+    '''
+
+    client = boto3.client('s3', region_name=region)
+
+    try:
+        response = client.get_object(
+            Bucket=catalog_bucket,
+            Key=catalog_key
+        )
+        catalog_body = response['Body'].read().decode('utf-8')
+        print("Retrieved catalog 's3://%s/%s' version '%s'" % (catalog_bucket, catalog_key, response['ETag']))
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return catalog_body
+
+
+def parse_catalog(catalog_key, catalog_body):
+
+    '''
+        Parse the catalog and fill in the defaults for each SOE Type
+    '''
+
+    if catalog_key.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ValueError("Catalog '%s' is YAML but PyYAML is not available, use a JSON catalog" % catalog_key)
+        catalog = yaml.safe_load(catalog_body)
+    else:
+        catalog = json.loads(catalog_body)
+
+    if not isinstance(catalog, dict) or not isinstance(catalog.get('SOETypes'), list):
+        raise ValueError("Catalog '%s' must have a 'SOETypes' list" % catalog_key)
+
+    return get_soe_types(catalog_key, catalog['SOETypes'])
+
+
+def get_soe_types(catalog_key, catalog_soe_types):
+
+    '''
+        Validate the SOE Types, split them per architecture and fill in their defaults
+    '''
+
+    soe_types = []
+    seen_soe_types = set()
+    for catalog_soe in catalog_soe_types:
+        missing_settings = [setting for setting in REQUIRED_SETTINGS if not catalog_soe.get(setting)]
+        if missing_settings:
+            raise ValueError("Catalog SOE Type '%s' is missing %s" % (catalog_soe.get('SOEType'), ", ".join(missing_settings)))
+
+        for soe in split_architectures(catalog_key, catalog_soe):
+            if soe['SOEType'] in seen_soe_types:
+                raise ValueError("Catalog SOE Type '%s' is defined more than once" % soe['SOEType'])
+            seen_soe_types.add(soe['SOEType'])
+
+            soe.setdefault('OverrideAMI', '')
+            soe.setdefault('NextAMIParam', '/' + solution_naming + '/' + soe['SOEType'] + '/nextAmi')
+            soe_types.append(soe)
+
+    return soe_types
+
+
+def split_architectures(catalog_key, catalog_soe):
+
+    '''
+        Get one SOE Type per architecture, the first architecture keeping the SOE Type name
+    '''
+
+    soe = dict(catalog_soe)
+    architectures = soe.pop('Architectures', [])
+    if isinstance(architectures, str):
+        architectures = [architecture.strip() for architecture in architectures.split(',') if architecture.strip()]
+    if not architectures:
+        return [soe]
+
+    invalid_architectures = [architecture for architecture in architectures if architecture not in ARCHITECTURES]
+    if invalid_architectures:
+        raise ValueError("Catalog '%s' SOE Type '%s' has invalid Architectures %s, must be one of %s"
+                         % (catalog_key, soe['SOEType'], ", ".join(invalid_architectures), ", ".join(ARCHITECTURES)))
+
+    architecture_soe_types = []
+    for index, architecture in enumerate(architectures):
+        architecture_soe = dict(soe, Architecture=architecture)
+        # Other architectures get their own SOE Type so their nextAmi, lease and records are kept apart
+        if index:
+            architecture_soe['SOEType'] = soe['SOEType'] + '-' + architecture
+            if 'NextAMIParam' in soe:
+                param_path, _, param_name = soe['NextAMIParam'].rpartition('/')
+                architecture_soe['NextAMIParam'] = param_path + '-' + architecture + '/' + param_name
+        architecture_soe_types.append(architecture_soe)
+
+    return architecture_soe_types
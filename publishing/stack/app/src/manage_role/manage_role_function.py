@@ -9,6 +9,7 @@ from datetime import datetime
 
 import boto3
 import botocore
+from botocore.config import Config
 
 
 print('Loading function ' + datetime.now().time().isoformat())
@@ -18,6 +19,10 @@ print('Loading function ' + datetime.now().time().isoformat())
 solution_naming = os.environ['SolutionNaming']
 region = os.environ['Region']
 soe_type = os.environ['SOEType']
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
 
 def lambda_handler(event, context):
 
@@ -46,7 +51,7 @@ def access_role(solution_naming, region, local_account_id, account_ids, soe_type
         Create and update IAM role used my service owners to access SOE AMI ID in SSM parameter store
     '''
 
-    client = boto3.client('iam', region_name=region)
+    client = boto3.client('iam', region_name=region, config=CLIENT_CONFIG)
     role_name = (solution_naming + "-" + soe_type + "-soe-service-iam-role")
     role_policy_name = (solution_naming + "-" + soe_type + "-soe-service-iam-policy")
 
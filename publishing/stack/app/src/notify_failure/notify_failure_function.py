@@ -18,12 +18,17 @@ from urllib.request import Request, urlopen
 import boto3
 import botocore
 
+from soe_common.automation import SNAPSHOTS, get_execution_snapshot
+from soe_common.findings import get_finding_rules
+
 
 print('Loading function ' + datetime.now().time().isoformat())
 
 ### Environment variables ###
 region = os.environ['Region']
 exception_list = os.environ['VulnerabilityExceptionsList']
+exceptions_bucket = os.environ.get('VulnerabilityExceptionsBucket', '')
+exceptions_key = os.environ.get('VulnerabilityExceptionsKey', '')
 solution_naming = os.environ['SolutionNaming']
 os_type = os.environ['OSType']
 operating_system = os.environ['OS']
@@ -34,7 +39,6 @@ enable_slack = os.environ['EnableSlackIntegration']
 environment = os.environ['Environment']
 
 ## Clients
-ssm_client = boto3.client('ssm', region_name=region) # pylint: disable=invalid-name
 inspector_client = boto3.client('inspector') # pylint: disable=invalid-name
 ec2_client = boto3.client('ec2', region_name=region) # pylint: disable=invalid-name
 
@@ -48,6 +52,7 @@ def lambda_handler(event, context):
     '''
 
     print("Event: " + json.dumps(event))
+    SNAPSHOTS.clear()
     logger.info("Event: " + str(event))
     message = event
     logger.info("Message: " + str(message))
@@ -59,16 +64,17 @@ def lambda_handler(event, context):
         return event
     else:
         try:
-            instance_id = event['InstanceID']
+            # A build failing its pre-flight checks never launched an instance
+            instance_id = event.get('InstanceID')
             failure_on = event['CheckType']
             account_id = (boto3.client('sts').get_caller_identity()['Account'])
-            global exception_list
-            exception_list = event['IgnoreFindings'] if 'IgnoreFindings' in event else None
             keep_ec2 = event['KeepTestInstance'] in ['True', 'FailedOnly'] if 'KeepTestInstance' in event else False
 
             # Step 1
             if keep_ec2:
                 print("KeepTestInstance is '%s'. Skipping termination of '%s'" % (event['KeepTestInstance'], instance_id))
+            elif not instance_id:
+                print("No instance to terminate")
             else:
                 delete_instance_output = delete_instance(region, instance_id)
                 print(delete_instance_output)
@@ -79,7 +85,13 @@ def lambda_handler(event, context):
             else:
                 action = 'UNKNOWN_ACTION'
 
-            if failure_on == "ssm_build":
+            if failure_on == "task":
+                slack_message = get_failure_task(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
+            elif failure_on == "region":
+                slack_message = get_failure_region(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
+            elif failure_on == "preflight":
+                slack_message = get_failure_preflight(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
+            elif failure_on == "ssm_build":
                 slack_message = get_failure_ssm_build(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
             elif failure_on == "ssm_test":
                 purge_output = purge_ami(region, event)
@@ -89,7 +101,7 @@ def lambda_handler(event, context):
                 purge_output = purge_ami(region, event)
                 print(purge_output)
                 slack_message = get_failure_inspector(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
-            elif failure_on == "inspec":
+            elif failure_on in ["inspec", "inspec_not_reported"]:
                 purge_output = purge_ami(region, event)
                 print(purge_output)
                 slack_message = get_failure_inspec(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment)
@@ -104,9 +116,9 @@ def lambda_handler(event, context):
             event["Notification"] = "Success"
             return event
 
-    except BaseException as exc:
-        print(exc)
-        raise exc
+        except BaseException as exc:
+            print(exc)
+            raise exc
 
 
 def delete_instance(region, instance_id):
@@ -147,6 +159,113 @@ def delete_instance(region, instance_id):
     return output
 
 
+def get_failure_preflight(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment):
+
+    '''
+        Get pre-flight check failure message
+    '''
+
+    print("Pre-flight Check Failure")
+    step_function_url = ("https://" + region + ".console.aws.amazon.com/states/home?region=" + region + "#/statemachines/view/arn:aws:states:" + region + ":" + account_id + ":stateMachine:" + solution_naming + "-" + operating_system  + "-" + os_type + "-build-soe-sf-sm")
+    step_function_url_formatted = '<%s|Link>' % (step_function_url)
+
+    slack_message = {
+        'channel': slack_channel,
+        'username': ("AMI SOE " + action + " Failure - " + environment),
+        'icon_emoji': slack_icon,
+        'attachments': [
+            {
+                'mrkdwn_in': ['text', 'pretext', 'fields'],
+                'title': (solution_naming + "-" + os_type + "-" + operating_system),
+                'fallback': 'Pre-flight Check Failure',
+                'color': "#FF0000",
+                'text': 'SSM Build not started, pre-flight checks failed',
+                'fields': [
+                    {'title': 'Action', 'value': action, 'short': True},
+                    {'title': 'StepFunction', 'value': step_function_url_formatted, 'short': True},
+                    {'title': 'Failed Checks', 'value': "\n".join(event['PreflightErrors']), 'short': False},
+                ]
+            }
+        ]
+    }
+    print(slack_message)
+
+    return slack_message
+
+
+def get_failure_task(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment):
+
+    '''
+        Get state machine task failure message
+    '''
+
+    print("State Machine Task Failure")
+    task_error = event.get('TaskError', {})
+    step_function_url = ("https://" + region + ".console.aws.amazon.com/states/home?region=" + region + "#/statemachines/view/arn:aws:states:" + region + ":" + account_id + ":stateMachine:" + solution_naming + "-" + operating_system  + "-" + os_type + "-build-soe-sf-sm")
+    step_function_url_formatted = '<%s|Link>' % (step_function_url)
+
+    slack_message = {
+        'channel': slack_channel,
+        'username': ("AMI SOE " + action + " Failure - " + environment),
+        'icon_emoji': slack_icon,
+        'attachments': [
+            {
+                'mrkdwn_in': ['text', 'pretext', 'fields'],
+                'title': (solution_naming + "-" + os_type + "-" + operating_system),
+                'fallback': 'State Machine Task Failure',
+                'color': "#FF0000",
+                'text': 'State Machine Task Failed',
+                'fields': [
+                    {'title': 'Action', 'value': action, 'short': True},
+                    {'title': 'StepFunction', 'value': step_function_url_formatted, 'short': True},
+                    {'title': 'Error', 'value': task_error.get('Error', 'UNKNOWN_ERROR'), 'short': True},
+                    {'title': 'Cause', 'value': task_error.get('Cause', ''), 'short': False},
+                ]
+            }
+        ]
+    }
+    print(slack_message)
+
+    return slack_message
+
+
+def get_failure_region(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment):
+
+    '''
+        Get regional build start failure message
+    '''
+
+    print("Regional Build Failure")
+    step_function_url = ("https://" + region + ".console.aws.amazon.com/states/home?region=" + region + "#/statemachines/view/arn:aws:states:" + region + ":" + account_id + ":stateMachine:" + solution_naming + "-" + operating_system  + "-" + os_type + "-build-soe-sf-sm")
+    step_function_url_formatted = '<%s|Link>' % (step_function_url)
+    failed_regions = ["%s: %s" % (build_region, error) for build_region, error in event['RegionErrors'].items()]
+    started_builds = ["%s: %s" % (build_region, execution_id) for build_region, execution_id in event.get('BuildAutomationExecutionIds', {}).items()]
+
+    slack_message = {
+        'channel': slack_channel,
+        'username': ("AMI SOE " + action + " Failure - " + environment),
+        'icon_emoji': slack_icon,
+        'attachments': [
+            {
+                'mrkdwn_in': ['text', 'pretext', 'fields'],
+                'title': (solution_naming + "-" + os_type + "-" + operating_system),
+                'fallback': 'Regional Build Failure',
+                'color': "#FF0000",
+                'text': 'SSM Build not started in every region, the started builds keep running',
+                'fields': [
+                    {'title': 'Action', 'value': action, 'short': True},
+                    {'title': 'StepFunction', 'value': step_function_url_formatted, 'short': True},
+                    {'title': 'Failed Regions', 'value': "\n".join(failed_regions), 'short': False},
+                    {'title': 'Started Builds', 'value': "\n".join(started_builds) or 'None', 'short': False},
+                ]
+            }
+        ]
+    }
+    print(slack_message)
+
+    return slack_message
+
+
 def get_failure_ssm_build(failure_on, event, action, region, slack_icon, slack_channel, solution_naming, os_type, operating_system, account_id, environment):
 
     '''
@@ -200,10 +319,8 @@ def get_failure_ssm_test(failure_on, event, action, region, slack_icon, slack_ch
     try:
         print("SSM Test Failure")
         execution_id = event['TestAutomationExecutionId']
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=execution_id
-        )
-        ami_id = ssm_response['AutomationExecution']['Parameters']['sourceAMIid'][0]
+        test_execution = get_execution_snapshot(region, execution_id)
+        ami_id = test_execution.source_ami
         print(ami_id)
         url = ("https://" + region + ".console.aws.amazon.com/ec2/v2/home?region=" + region + "#ExecutionOutputs:AutomationExecutionId=execution_id")
         link_to_service = '<%s|%s>' % (url, execution_id)
@@ -249,14 +366,10 @@ def get_failure_inspector(failure_on, event, action, region, slack_icon, slack_c
     try:
         print("Inspector Failure")
         execution_id = event['TestAutomationExecutionId']
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=execution_id
-        )
-        ami_id = ssm_response['AutomationExecution']['Parameters']['sourceAMIid'][0]
+        test_execution = get_execution_snapshot(region, execution_id)
+        ami_id = test_execution.source_ami
         print(ami_id)
-        scan_output = ssm_response['AutomationExecution']['Outputs']['runVulnerabilityScan.Output'][0]
-        scan_output_format = scan_output.strip()
-        inspector_assessment_run_arn = scan_output_format.strip('"')
+        inspector_assessment_run_arn = test_execution.inspector_run_arn
         assesment_run_response = inspector_client.describe_assessment_runs(
             assessmentRunArns=[
                 inspector_assessment_run_arn,
@@ -309,10 +422,8 @@ def get_failure_inspec(failure_on, event, action, region, slack_icon, slack_chan
     try:
         print("InSpec Compliance Test Failure")
         execution_id = event['TestAutomationExecutionId']
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=execution_id
-        )
-        ami_id = ssm_response['AutomationExecution']['Parameters']['sourceAMIid'][0]
+        test_execution = get_execution_snapshot(region, execution_id)
+        ami_id = test_execution.source_ami
         print(ami_id)
         url = ("https://" + region + ".console.aws.amazon.com/ec2/v2/home?region=" + region + "#ExecutionOutputs:AutomationExecutionId=execution_id")
         link_to_service = '<%s|%s>' % (url, execution_id)
@@ -331,7 +442,7 @@ def get_failure_inspec(failure_on, event, action, region, slack_icon, slack_chan
                     'title': (solution_naming + "-" + os_type + "-" + operating_system),
                     'fallback': 'InSpec Compliance Failure',
                     'color': "#FF0000",
-                    'text': 'InSpec Compliance Test Failed',
+                    'text': 'InSpec Compliance Never Reported' if failure_on == 'inspec_not_reported' else 'InSpec Compliance Test Failed',
                     'fields': [
                         {'title': 'Action', 'value': action, 'short': True},
                         {'title': 'SSM Build', 'value': link_to_service, 'short': True},
@@ -349,25 +460,13 @@ def get_failure_inspec(failure_on, event, action, region, slack_icon, slack_chan
     return slack_message
 
 
-def is_breaking_finding(findings_detail):
+def is_breaking_finding(findings_detail, finding_rules):
     """
         Determine if a finding is a breaking failure.
     """
-    # Ignore non High severity
-    if 'severity' in findings_detail and findings_detail['severity'] != 'High':
-        logger.debug("Finding '%s' has Severity '%s', ignoring.", findings_detail['id'], findings_detail['severity'])
-        return False
-
-    # Ignore CIS Level 2
-    for attr in findings_detail['attributes']:
-        if attr['key'] == "CIS_BENCHMARK_PROFILE":
-            # Ignore Level 2 as we are currently using CIS Hardened AMI to Level 1 only
-            if "Level 2" in attr['value']:
-                logger.debug("Finding '%s' has CIS Profile '%s', ignoring.", findings_detail['id'], attr['value'])
-                return False
-
-    if exception_list and findings_detail['id'] in exception_list:
-        logger.debug("Finding '%s' is in VulnerabilityExceptionsList, ignoring.", findings_detail['id'])
+    ignore_reason = finding_rules.ignore_reason(findings_detail)
+    if ignore_reason:
+        logger.debug("Finding '%s' ignored by the '%s' rule.", findings_detail['id'], ignore_reason)
         return False
 
     # Every other findings are a breaking failure
@@ -384,14 +483,11 @@ def get_vulnerabilies(failure_on, event, action, region, slack_icon, slack_chann
     try:
         print("Vulnerability Scan Failure")
         execution_id = event['TestAutomationExecutionId']
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=execution_id
-        )
-        ami_id = ssm_response['AutomationExecution']['Parameters']['sourceAMIid'][0]
+        test_execution = get_execution_snapshot(region, execution_id)
+        ami_id = test_execution.source_ami
         print(ami_id)
-        scan_output = ssm_response['AutomationExecution']['Outputs']['runVulnerabilityScan.Output'][0]
-        scan_output_format = scan_output.strip()
-        inspector_assessment_run_arn = scan_output_format.strip('"')
+        inspector_assessment_run_arn = test_execution.inspector_run_arn
+        finding_rules = get_finding_rules(event['IgnoreFindings'] if 'IgnoreFindings' in event else exception_list, region, exceptions_bucket, exceptions_key)
 
         # Do while has nextToken (true the first time)
         has_next_token = True
@@ -415,7 +511,7 @@ def get_vulnerabilies(failure_on, event, action, region, slack_icon, slack_chann
         )
         # For each finding, filter down to breaking findings only
         for findings_detail in all_findings_details['findings']:
-            if is_breaking_finding(findings_detail):
+            if is_breaking_finding(findings_detail, finding_rules):
                 breaking_findings.append(findings_detail['id'])
             else:
                 ignored_findings.append(findings_detail['id'])
@@ -487,10 +583,8 @@ def purge_ami(region, event):
         print("Deleting AMI and snapshot")
 
         execution_id = event['TestAutomationExecutionId']
-        ssm_response = ssm_client.get_automation_execution(
-            AutomationExecutionId=execution_id
-        )
-        ami_id = ssm_response['AutomationExecution']['Parameters']['sourceAMIid'][0]
+        test_execution = get_execution_snapshot(region, execution_id)
+        ami_id = test_execution.source_ami
 
         image = ec2_client.describe_images(
             ImageIds=[ami_id],
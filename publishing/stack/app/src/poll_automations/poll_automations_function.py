@@ -0,0 +1,176 @@
+'''
+
+This module polls every in-flight SOE automation execution at once and publishes their status for the check functions.
+
+'''
+import json
+import os
+from datetime import datetime, timedelta
+
+import boto3
+import botocore
+from botocore.config import Config
+
+
+print('Loading function ' + datetime.now().time().isoformat())
+
+### Environment variables ###
+# General
+solution_naming = os.environ['SolutionNaming']
+region = os.environ['Region']
+document_name_prefix = os.environ['DocumentNamePrefix']
+poller_lookback = int(os.environ.get('PollerLookback', '21600'))
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
+
+# Same format as the other SSM records of the solution
+RECORD_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Only the executions the check functions still wait on are published, the finished ones are read once by the checks
+RUNNING_STATUSES = ['Pending', 'InProgress', 'Waiting']
+
+def lambda_handler(event, context):
+
+    '''
+        Run function and return output.
+    '''
+
+    print("Event: " + json.dumps(event))
+
+    try:
+        # Step 1 - One paginated sweep per running status over the executions of every SOE document
+        started_after = (datetime.utcnow() - timedelta(seconds=poller_lookback)).strftime(RECORD_DATE_FORMAT)
+        executions = list_executions(region, document_name_prefix, started_after)
+        print("Found %s running automation executions started after %s" % (len(executions), started_after))
+
+        # Step 2 - Carry the start of the current steps over from the previous record
+        status_param = get_status_param()
+        set_step_start_times(executions, get_status_record(status_param))
+
+        # Step 3 - Publish their status to the shared store read by check_build and check_test
+        put_status_record(status_param, {
+            'UpdatedAt': datetime.utcnow().strftime(RECORD_DATE_FORMAT),
+            'Executions': executions,
+        })
+        print("Published the status of %s automation executions to '%s'" % (len(executions), status_param))
+
+        return {'StatusParam': status_param, 'Executions': len(executions)}
+
+    except BaseException as exc:
+        print(exc)
+        raise exc
+
+
+def get_status_param():
+
+    '''
+        Get the SSM Parameter holding the shared automation status
+    '''
+
+    return '/' + solution_naming + '/automationStatus'
+
+
+def list_executions(region, document_name_prefix, started_after):
+
+    '''
+        Get the status, document, current step and start of the running automation executions by execution id
+    '''
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    executions = {}
+    try:
+        paginator = client.get_paginator('describe_automation_executions')
+        # The filter takes one status at a time
+        for execution_status in RUNNING_STATUSES:
+            for page in paginator.paginate(
+                    Filters=[
+                        {'Key': 'DocumentNamePrefix', 'Values': [document_name_prefix]},
+                        {'Key': 'StartTimeAfter', 'Values': [started_after]},
+                        {'Key': 'ExecutionStatus', 'Values': [execution_status]},
+                    ],
+                    PaginationConfig={'PageSize': 50}):
+                for execution in page['AutomationExecutionMetadataList']:
+                    # Compact entries keep the record within one parameter
+                    executions[execution['AutomationExecutionId']] = [
+                        execution['AutomationExecutionStatus'],
+                        execution['DocumentName'],
+                        execution.get('CurrentStepName', ''),
+                        execution['ExecutionStartTime'].strftime(RECORD_DATE_FORMAT),
+                    ]
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return executions
+
+
+def set_step_start_times(executions, previous_record):
+
+    '''
+        Add the start of the current step to every execution, the listing does not return it
+    '''
+
+    previous_executions = previous_record.get('Executions', {})
+    now = datetime.utcnow().strftime(RECORD_DATE_FORMAT)
+    for execution_id, execution in executions.items():
+        previous_execution = previous_executions.get(execution_id, [])
+        if len(previous_execution) == 5 and previous_execution[2] == execution[2]:
+            # Still on the same step
+            execution.append(previous_execution[4])
+        elif execution_id in previous_executions:
+            # Moved on since the previous sweep, at most one poll interval ago
+            execution.append(now)
+        else:
+            # Not seen before, the step started after the execution and after the previous sweep
+            execution.append(max(execution[3], previous_record.get('UpdatedAt', execution[3])))
+
+
+def get_status_record(status_param):
+
+    '''
+        Get the shared automation status published by the previous sweep, empty if there is none
+    '''
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=status_param,
+        )
+        return json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + status_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            return {}
+        print(exc)
+        raise exc
+
+
+def put_status_record(status_param, record):
+
+    '''
+        Store the shared automation status
+    '''
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        # Moves to the advanced tier on its own when many executions are in flight
+        client.put_parameter(
+            Name=status_param,
+            Value=json.dumps(record, separators=(',', ':')),
+            Type='String',
+            Tier='Intelligent-Tiering',
+            Overwrite=True
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
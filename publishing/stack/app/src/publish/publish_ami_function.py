@@ -9,6 +9,7 @@ from datetime import datetime
 
 import boto3
 import botocore
+from botocore.config import Config
 
 
 print('Loading function ' + datetime.now().time().isoformat())
@@ -18,6 +19,10 @@ print('Loading function ' + datetime.now().time().isoformat())
 region = os.environ['Region']
 next_ami_ssm_param = os.environ['NextAMIParam']
 latest_ami_ssm_param = os.environ['LatestAMIParam']
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
 
 
 def lambda_handler(event, context):
@@ -63,7 +68,7 @@ def share_ami(region, ami, account_ids):
     '''
 
     try:
-        client = boto3.client('ec2', region_name=region)
+        client = boto3.client('ec2', region_name=region, config=CLIENT_CONFIG)
 
         response = client.modify_image_attribute(
             Attribute='launchPermission',
@@ -86,7 +91,7 @@ def get_ssm_param(region, ssm_param):
     '''
 
     try:
-        client = boto3.client('ssm', region_name=region)
+        client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
 
         # Get current latest parameter value
         get_parameter_response = client.get_parameter(
@@ -112,7 +117,7 @@ def update_ssm_param(region, ssm_param, new_value):
     '''
 
     try:
-        client = boto3.client('ssm', region_name=region)
+        client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
 
         # Get current value
         current_value = get_ssm_param(region, ssm_param)
@@ -9,6 +9,7 @@ from datetime import datetime, timedelta
 
 import boto3
 import botocore
+from botocore.config import Config
 
 
 print('Loading function ' + datetime.now().time().isoformat())
@@ -19,6 +20,10 @@ region = os.environ['Region']
 ssm_path = os.environ['SSMPath']
 soe_type = os.environ['SOEType']
 solution_naming = os.environ['SolutionNaming']
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
 
 # Days to delete after
 day_limit = datetime.now() - timedelta(days=30)
@@ -52,7 +57,7 @@ def purge(region, ssm_path, soe_type, solution_naming, day_limit, today, context
     '''
 
     try:
-        client = boto3.client('ec2', region_name=region)
+        client = boto3.client('ec2', region_name=region, config=CLIENT_CONFIG)
         tagkey = 'SoeType'
         tagvalue = (solution_naming + "-" + soe_type)
         account_id = context.invoked_function_arn.split(":")[4]
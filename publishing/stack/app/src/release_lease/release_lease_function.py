@@ -0,0 +1,162 @@
+'''
+
+This module releases the build lease of the SOE Type and starts the coalesced follow-up build if any.
+
+'''
+import json
+import os
+import uuid
+from datetime import datetime
+
+import boto3
+import botocore
+from botocore.config import Config
+
+
+print('Loading function ' + datetime.now().time().isoformat())
+
+### Environment variables ###
+# General
+solution_naming = os.environ['SolutionNaming']
+region = os.environ['Region']
+soe_type = os.environ['SOEType']
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+lease_store = os.environ.get('LeaseStore', 'ssm')
+lease_dir = os.environ.get('LeaseDir', '/tmp/soe-leases')
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
+
+def lambda_handler(event, context):
+
+    '''
+        Run function and return output.
+    '''
+
+    print("Event: " + json.dumps(event))
+
+    try:
+        execution_id = event.get('Execution', {}).get('Id')
+        lease_param = '/' + solution_naming + '/' + event.get('SOE', {}).get('SOEType', soe_type) + '/buildLease'
+
+        # Step 1 - Release the lease if this execution holds it
+        lease = get_lease(lease_param)
+        if not execution_id or lease.get('Owner') != execution_id:
+            print("Build lease '%s' is held by '%s' not this execution. Not releasing" % (lease_param, lease.get('Owner')))
+            event['LeaseReleased'] = False
+            return event
+
+        delete_lease(lease_param)
+        print("Build lease '%s' released" % lease_param)
+        event['LeaseReleased'] = True
+
+        # Step 2 - Start the one follow-up run for the triggers coalesced while the build was running
+        follow_up = get_lease(lease_param + 'FollowUp')
+        if follow_up:
+            delete_lease(lease_param + 'FollowUp')
+            follow_up_arn = start_follow_up(region, execution_id, follow_up['Input'])
+            print("Started follow-up build '%s' coalesced from '%s'" % (follow_up_arn, follow_up.get('CoalescedFrom')))
+            event['FollowUpExecutionArn'] = follow_up_arn
+
+        return event
+
+    except BaseException as exc:
+        print(exc)
+        raise exc
+
+
+def get_lease_path(lease_param):
+
+    '''
+        Get the local stand-in file of a lease
+    '''
+
+    return os.path.join(lease_dir, lease_param.strip('/').replace('/', '_') + '.json')
+
+
+def get_lease(lease_param):
+
+    '''
+        Get the lease record, empty if there is none
+    '''
+
+    if lease_store == 'local':
+        try:
+            with open(get_lease_path(lease_param), 'r') as lease_file:
+                return json.load(lease_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=lease_param,
+        )
+        return json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + lease_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            return {}
+        print(exc)
+        raise exc
+
+
+def delete_lease(lease_param):
+
+    '''
+        Delete the lease record if it exists
+    '''
+
+    if lease_store == 'local':
+        try:
+            os.remove(get_lease_path(lease_param))
+        except FileNotFoundError:
+            pass
+        return
+
+    client = boto3.client('ssm', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        client.delete_parameter(
+            Name=lease_param
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] != "ParameterNotFound":
+            print(exc)
+            raise exc
+
+
+def start_follow_up(region, execution_id, follow_up_input):
+
+    '''
+        Start the follow-up run on the state machine of this execution
+    '''
+
+    # arn:aws:states:<region>:<account>:execution:<state machine>:<execution>
+    arn_parts = execution_id.split(':')
+    state_machine_arn = ':'.join(arn_parts[:5] + ['stateMachine', arn_parts[6]])
+    # One follow-up per releasing execution, a retried release does not start a second one
+    follow_up_name = 'follow-up-' + str(uuid.uuid5(uuid.NAMESPACE_URL, execution_id))
+
+    client = boto3.client('stepfunctions', region_name=region, config=CLIENT_CONFIG)
+
+    try:
+        response = client.start_execution(
+            stateMachineArn=state_machine_arn,
+            name=follow_up_name,
+            input=json.dumps(follow_up_input)
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ExecutionAlreadyExists":
+            print("Follow-up build '%s' already started" % follow_up_name)
+            return ':'.join(arn_parts[:5] + ['execution', arn_parts[6], follow_up_name])
+        print(exc)
+        raise exc
+
+    return response['executionArn']
@@ -3,12 +3,19 @@
 This module triggers a SSM automation build for a SOE AMI.
 
 '''
+import hashlib
 import json
 import os
-from datetime import datetime
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 import boto3
 import botocore
+from botocore.config import Config
+
+from soe_common.automation import get_client_token
 
 
 print('Loading function ' + datetime.now().time().isoformat())
@@ -22,10 +29,64 @@ soe_type = os.environ['SOEType']
 ami_pattern = os.environ['AMIPattern']
 ami_owner = os.environ['AMIOwner']
 pipeline_override_ami = os.environ['OverrideAMI']
+base_ami_cache_ttl = int(os.environ.get('BaseAMICacheTTL', '3600'))
+skip_unchanged_base = os.environ.get('SkipUnchangedBase', 'true')
+build_command_documents = [doc for doc in os.environ.get('BuildCommandDocuments', '').split(',') if doc]
+build_regions_setting = os.environ.get('BuildRegions', '')
+max_region_workers = int(os.environ.get('MaxRegionWorkers', '4'))
+instance_types_setting = os.environ.get('InstanceTypes', '')
+next_ami_ssm_param = os.environ.get('NextAMIParam', '')
+incremental_ssm_document = os.environ.get('IncrementalSSMDocument', '')
+full_build_days = int(os.environ.get('FullBuildDays', '7'))
+lease_store = os.environ.get('LeaseStore', 'ssm')
+lease_dir = os.environ.get('LeaseDir', '/tmp/soe-leases')
+build_lease_ttl = int(os.environ.get('BuildLeaseTTL', '21600'))
+max_api_attempts = int(os.environ.get('MaxApiAttempts', '10'))
+max_concurrent_builds = int(os.environ.get('MaxConcurrentBuilds', '0'))
+architecture = os.environ.get('Architecture', '')
+preflight_checks = os.environ.get('PreflightChecks', 'false')
+preflight_cache_ttl = int(os.environ.get('PreflightCacheTTL', '3600'))
+instance_profile = os.environ.get('InstanceProfile', '')
+build_variants_setting = os.environ.get('BuildVariants', '')
+base_ssm_document = os.environ.get('BaseSSMDocument', '')
+variant_ssm_document = os.environ.get('VariantSSMDocument', '')
+
+# Client side rate limiting that backs off when the AWS APIs throttle
+CLIENT_CONFIG = Config(retries={'max_attempts': max_api_attempts, 'mode': 'adaptive'})
+
+RECORD_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Instance type of the build document when none is passed
+DOCUMENT_INSTANCE_TYPE = 'm5.large'
+
+# Dry run launch errors of an image, subscription, instance type or network the build can not launch with,
+# any other error e.g. throttling or a missing permission is raised
+LAUNCH_ERRORS = [
+    'InvalidAMIID',
+    'OptInRequired',
+    'Unsupported',
+    'UnsupportedOperation',
+    'InvalidParameterValue',
+    'InvalidParameterCombination',
+    'VPCIdNotSpecified',
+]
+
+# Optional components a build variant can install on top of the shared base build
+VARIANT_COMPONENTS = ['codedeploy', 'corretto']
+
+# Instance type of each architecture when no candidate instance types are set
+ARCHITECTURE_INSTANCE_TYPES = {
+    'x86_64': 'm5.large',
+    'arm64': 'm6g.large',
+}
 
 # To override from unit test to work around moto
 EXEC_USERS = 'all'
 
+# Clients per service and region, shared by the fan-out threads
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
 def lambda_handler(event, context):
 
     '''
@@ -35,26 +96,109 @@ def lambda_handler(event, context):
     print("Event: " + json.dumps(event))
 
     try:
+        # Use the SOE Type from the catalog entry if set in the event
+        soe = get_soe(event)
+        print("SOE: " + json.dumps(soe))
+
+        # Only one build per SOE Type at a time, later triggers are coalesced into one follow-up run
+        execution_id = event.get('Execution', {}).get('Id')
+        lease = {}
+        if execution_id:
+            trigger_input = {key: value for key, value in event.items() if key not in ['Action', 'Execution']}
+            lease = acquire_build_lease(soe['SOEType'], execution_id, trigger_input)
+            if lease['Owner'] != execution_id:
+                print("Build of '%s' already in progress in '%s'. Coalesced into a follow-up run" % (soe['SOEType'], lease['Owner']))
+                event['LeaseOwner'] = lease['Owner']
+                event['BuildStatus'] = 'coalesced'
+                return event
+        else:
+            print("No state machine execution in the event. Building without the build lease")
+
+        # Queue the build while the fleet is already running the maximum number of builds, variant builds included.
+        # A retried trigger already passed the cap and would otherwise count its own running build
+        if max_concurrent_builds and lease.get('BuildSlotSince'):
+            print("Build slot taken by this execution since %s. Not counting the builds in flight" % lease['BuildSlotSince'])
+        elif max_concurrent_builds:
+            builds_in_flight = count_builds_in_flight(region, [soe['SSMDocument'], soe['IncrementalSSMDocument'], base_ssm_document, variant_ssm_document])
+            event['BuildsInFlight'] = builds_in_flight
+            if builds_in_flight >= max_concurrent_builds:
+                queued_since = event.setdefault('QueuedSince', datetime.utcnow().strftime(RECORD_DATE_FORMAT))
+                event['BuildQueueDepth'] = builds_in_flight - max_concurrent_builds + 1
+                event['GovernorWaitSeconds'] = int((datetime.utcnow() - datetime.strptime(queued_since, RECORD_DATE_FORMAT)).total_seconds())
+                print("%s builds in flight (max %s). Build queued for %s seconds" % (builds_in_flight, max_concurrent_builds, event['GovernorWaitSeconds']))
+                event['BuildStatus'] = 'queued'
+                return event
+            if lease:
+                lease['BuildSlotSince'] = datetime.utcnow().strftime(RECORD_DATE_FORMAT)
+                put_lease(get_lease_param(soe['SOEType']), lease)
+
         # Check if there is override AMI is set in the event
         if 'OverrideAMI' in event:
             event_override_ami = event['OverrideAMI']
-            if pipeline_override_ami:
-                print("Overriding the Pipeline level OverrideAMI '%s' with event OverrideAMI '%s'" % (pipeline_override_ami, event_override_ami))
+            if soe['OverrideAMI']:
+                print("Overriding the Pipeline level OverrideAMI '%s' with event OverrideAMI '%s'" % (soe['OverrideAMI'], event_override_ami))
             else:
-                print("Overriding the AMI Pattern '%s' with event OverrideAMI '%s'" % (ami_pattern, event_override_ami))
+                print("Overriding the AMI Pattern '%s' with event OverrideAMI '%s'" % (soe['AMIPattern'], event_override_ami))
             override_ami = event_override_ami
         else:
-            override_ami = pipeline_override_ami
+            override_ami = soe['OverrideAMI']
 
-        # Step 1
-        source_ami_id = get_ami(ami_pattern, region, override_ami, ami_owner)
-        print("AMI ID: " + source_ami_id)
+        force_build = event['ForceBuild'] == 'True' if 'ForceBuild' in event else False
+        # Advisory builds must pick up the package updates even if the build inputs are unchanged
+        if event.get('Advisories') and not soe['IncrementalSSMDocument']:
+            print("Building for advisories %s" % ", ".join(event['Advisories']))
+            force_build = True
+
+        # Pick the build and test instance types from the recorded wall times
+        instance_types = get_instance_types(soe['InstanceTypes'])
+        if instance_types:
+            benchmarks = get_ssm_record(region, get_benchmarks_param(soe['SOEType']))
+            event['BuildInstanceType'] = select_instance_type(benchmarks, instance_types, 'build')
+            event['TestInstanceType'] = select_instance_type(benchmarks, instance_types, 'test')
+            print("BuildInstanceType: %s, TestInstanceType: %s" % (event['BuildInstanceType'], event['TestInstanceType']))
+        elif soe['Architecture']:
+            event['BuildInstanceType'] = get_architecture_instance_type(soe['Architecture'])
+            event['TestInstanceType'] = event['BuildInstanceType']
+            print("%s BuildInstanceType and TestInstanceType: %s" % (soe['Architecture'], event['BuildInstanceType']))
+        build_instance_type = event.get('BuildInstanceType')
+
+        # The recorded step durations schedule the build and test status checks
+        if event.get('CompletionMode') != 'callback':
+            event['StepDurations'] = get_ssm_record(region, get_step_durations_param(soe['SOEType']))
+
+        build_regions = get_build_regions(build_regions_setting, soe['SSMDocument'])
+        if build_variants_setting and len(build_regions) > 1:
+            raise ValueError("BuildVariants can not be combined with BuildRegions")
+
+        if len(build_regions) > 1:
+            # Step 1 - Fan out the build to every region concurrently
+            regional_builds = fan_out_builds(soe, build_regions, override_ami, force_build, build_instance_type, event)
+            event['RegionalBuilds'] = regional_builds
+            event['BuildAutomationExecutionIds'] = {
+                build_region: build['BuildAutomationExecutionId']
+                for build_region, build in regional_builds.items() if 'BuildAutomationExecutionId' in build
+            }
+            print("BuildAutomationExecutionIds: " + json.dumps(event['BuildAutomationExecutionIds']))
+            event.update({key: value for key, value in regional_builds[region].items() if key != 'RegionError'})
+            region_errors = {build_region: build['RegionError'] for build_region, build in regional_builds.items() if 'RegionError' in build}
+            preflight_errors = [error for build in regional_builds.values() for error in build.get('PreflightErrors', [])]
+            if region_errors:
+                # The builds started in the other regions are reported with the failure
+                event['RegionErrors'] = region_errors
+                event['CheckType'] = 'region'
+                event['BuildStatus'] = 'failed'
+            elif preflight_errors:
+                event['PreflightErrors'] = preflight_errors
+                event['CheckType'] = 'preflight'
+                event['BuildStatus'] = 'failed'
+            elif event['BuildAutomationExecutionIds']:
+                event['BuildStatus'] = 'running'
+
+        else:
+            # Step 1 - Build in the local region only
+            event.update(start_build(soe, region, soe['SSMDocument'], build_command_documents, override_ami, force_build,
+                                     build_instance_type, get_client_token(event, 'build', region)))
 
-        # Step 2
-        build_execution_id = trigger_ssm(solution_naming, region, ssm_document, soe_type, source_ami_id)
-        print("BuildAutomationExecutionId: " + build_execution_id)
-        event['BuildAutomationExecutionId'] = build_execution_id
-        event['SourceAMI'] = source_ami_id
         return event
 
     except BaseException as exc:
@@ -62,55 +206,629 @@ def lambda_handler(event, context):
         raise exc
 
 
-def get_ami(ami_pattern, region, override_ami, ami_owner):
+def get_soe(event):
 
     '''
-        Get latest market place AMI for the SOE Type
+        Get the SOE Type settings, overriding the environment with the catalog entry in the event
     '''
 
-    global EXEC_USERS
-    client = boto3.client('ec2', region_name=region)
+    soe = {
+        'SOEType': soe_type,
+        'AMIPattern': ami_pattern,
+        'AMIOwner': ami_owner,
+        'OverrideAMI': pipeline_override_ami,
+        'SSMDocument': ssm_document,
+        'IncrementalSSMDocument': incremental_ssm_document,
+        'NextAMIParam': next_ami_ssm_param,
+        'Architecture': architecture,
+        'InstanceTypes': instance_types_setting,
+    }
+    if 'SOE' in event:
+        for key in soe:
+            if key in event['SOE']:
+                soe[key] = event['SOE'][key]
+
+    return soe
+
+
+def get_base_ami_param(soe_type):
+
+    '''
+        Get the SSM parameter holding the last resolved base AMI record for the SOE Type
+    '''
+
+    return '/' + solution_naming + '/' + soe_type + '/baseAmi'
+
+
+def get_solution_soe_type(soe_type):
+
+    '''
+        Get the name and SoeType tag value of the SOE Type images
+    '''
+
+    return solution_naming + '-' + soe_type
+
+
+def get_lease_param(soe_type):
+
+    '''
+        Get the SSM Parameter holding the build lease of the SOE Type
+    '''
+
+    return '/' + solution_naming + '/' + soe_type + '/buildLease'
+
+
+def acquire_build_lease(soe_type, execution_id, trigger_input):
+
+    '''
+        Take the build lease of the SOE Type, or record the trigger as a follow-up of the lease owner
+    '''
+
+    lease_param = get_lease_param(soe_type)
+    now = datetime.utcnow()
+    lease = {
+        'Owner': execution_id,
+        'ExpiresAt': (now + timedelta(seconds=build_lease_ttl)).strftime(RECORD_DATE_FORMAT),
+    }
+    if create_lease(lease_param, lease):
+        print("Build lease '%s' taken by '%s'" % (lease_param, execution_id))
+        return lease
+
+    current_lease = get_lease(lease_param)
+    if current_lease.get('Owner') == execution_id:
+        print("Build lease '%s' already held by this execution" % lease_param)
+        return current_lease
+
+    if current_lease and datetime.strptime(current_lease['ExpiresAt'], RECORD_DATE_FORMAT) < now:
+        print("Build lease '%s' of '%s' expired. Taking it over" % (lease_param, current_lease.get('Owner')))
+        if take_over_lease(lease_param, current_lease, lease):
+            return lease
+        current_lease = get_lease(lease_param)
+
+    # Released in the meantime
+    if not current_lease:
+        if create_lease(lease_param, lease):
+            print("Build lease '%s' taken by '%s'" % (lease_param, execution_id))
+            return lease
+        current_lease = get_lease(lease_param)
+
+    # The follow-up is a separate record so that a release racing with this write never resurrects the lease
+    put_lease(lease_param + 'FollowUp', {'Input': trigger_input, 'CoalescedFrom': execution_id})
+    return current_lease
+
+
+def take_over_lease(lease_param, expired_lease, lease):
+
+    '''
+        Replace the expired lease, only one contender can claim the takeover of a given lease record
+    '''
+
+    # The claim is keyed by the expired record so a later lease gets its own claim
+    claim_param = lease_param + 'Takeover/' + str(uuid.uuid5(uuid.NAMESPACE_URL, json.dumps(expired_lease, sort_keys=True)))
+    if not create_lease(claim_param, {'Owner': lease['Owner']}):
+        print("Build lease '%s' is being taken over by another execution" % lease_param)
+        return False
 
     try:
-        if override_ami == "":
+        # A contender that read the expired lease late must not replace the lease of the winner
+        if get_lease(lease_param) != expired_lease:
+            print("Build lease '%s' changed since it expired. Not taking it over" % lease_param)
+            return False
+        put_lease(lease_param, lease)
+
+    finally:
+        delete_lease(claim_param)
+
+    return True
+
+
+def get_lease_path(lease_param):
+
+    '''
+        Get the local stand-in file of a lease
+    '''
+
+    return os.path.join(lease_dir, lease_param.strip('/').replace('/', '_') + '.json')
+
+
+def create_lease(lease_param, record):
+
+    '''
+        Create the lease record only if it does not exist yet
+    '''
+
+    if lease_store == 'local':
+        os.makedirs(lease_dir, exist_ok=True)
+        try:
+            with open(get_lease_path(lease_param), 'x') as lease_file:
+                json.dump(record, lease_file)
+            return True
+        except FileExistsError:
+            return False
+
+    try:
+        get_client('ssm', region).put_parameter(
+            Name=lease_param,
+            Value=json.dumps(record),
+            Type='String',
+            Overwrite=False
+        )
+        return True
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterAlreadyExists":
+            return False
+        print(exc)
+        raise exc
+
+
+def get_lease(lease_param):
+
+    '''
+        Get the lease record, empty if there is none
+    '''
+
+    if lease_store == 'local':
+        try:
+            with open(get_lease_path(lease_param), 'r') as lease_file:
+                return json.load(lease_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    return get_ssm_record(region, lease_param)
+
+
+def put_lease(lease_param, record):
+
+    '''
+        Create or overwrite the lease record
+    '''
+
+    if lease_store == 'local':
+        os.makedirs(lease_dir, exist_ok=True)
+        with open(get_lease_path(lease_param), 'w') as lease_file:
+            json.dump(record, lease_file)
+        return
+
+    try:
+        get_client('ssm', region).put_parameter(
+            Name=lease_param,
+            Value=json.dumps(record),
+            Type='String',
+            Overwrite=True
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def delete_lease(lease_param):
+
+    '''
+        Delete the lease record if it exists
+    '''
+
+    if lease_store == 'local':
+        try:
+            os.remove(get_lease_path(lease_param))
+        except FileNotFoundError:
+            pass
+        return
+
+    try:
+        get_client('ssm', region).delete_parameter(
+            Name=lease_param
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] != "ParameterNotFound":
+            print(exc)
+            raise exc
+
+
+def get_architecture_instance_type(architecture):
+
+    '''
+        Get the default instance type of the architecture
+    '''
+
+    if architecture not in ARCHITECTURE_INSTANCE_TYPES:
+        raise ValueError("Invalid Architecture '%s', must be one of %s" % (architecture, ", ".join(ARCHITECTURE_INSTANCE_TYPES)))
+
+    return ARCHITECTURE_INSTANCE_TYPES[architecture]
+
+
+def get_benchmarks_param(soe_type):
+
+    '''
+        Get the SSM Parameter holding the instance type wall times of the SOE Type
+    '''
+
+    return '/' + solution_naming + '/' + soe_type + '/instanceBenchmarks'
+
+
+def get_step_durations_param(soe_type):
+
+    '''
+        Get the SSM Parameter holding the automation step durations of the SOE Type
+    '''
+
+    return '/' + solution_naming + '/' + soe_type + '/stepDurations'
+
+
+def get_instance_types(instance_types_setting):
+
+    '''
+        Get the candidate instance types and their hourly price from the "type:price" list
+    '''
+
+    instance_types = {}
+    for entry in instance_types_setting.split(','):
+        if not entry.strip():
+            continue
+        instance_type, _, price = entry.strip().partition(':')
+        try:
+            instance_types[instance_type] = float(price)
+        except ValueError:
+            raise ValueError("InstanceTypes entry '%s' must be 'type:hourly price' e.g. 'm5.large:0.096'" % entry.strip())
+
+    return instance_types
+
+
+def select_instance_type(benchmarks, instance_types, stage):
+
+    '''
+        Pick the instance type with the lowest cost per run, benchmarking untried types first
+    '''
+
+    stage_benchmarks = benchmarks.get(stage, {})
+    for instance_type in instance_types:
+        if instance_type not in stage_benchmarks:
+            print("No %s wall time recorded for '%s' yet. Benchmarking it" % (stage, instance_type))
+            return instance_type
+
+    return min(instance_types, key=lambda instance_type: stage_benchmarks[instance_type]['Seconds'] * instance_types[instance_type])
 
-            print("Get available images matching '%s' with owner '%s'" % (ami_pattern, ami_owner))
-            images = client.describe_images(
-                ExecutableUsers=[
-                    EXEC_USERS,
-                ],
-                Filters=[
-                    {
-                        'Name': 'name',
-                        'Values': [
-                            ami_pattern,
-                        ]
-                    },
-                    {
-                        'Name': 'state',
-                        'Values': [
-                            'available',
-                        ]
-                    },
-                ],
-                Owners=[
-                    ami_owner,
-                ]
+
+def count_builds_in_flight(region, build_documents):
+
+    '''
+        Count the build automations running for the build documents
+    '''
+
+    client = get_client('ssm', region)
+    builds_in_flight = 0
+
+    try:
+        for build_document in [document for document in build_documents if document]:
+            for execution_status in ['Pending', 'InProgress']:
+                paginator = client.get_paginator('describe_automation_executions')
+                for page in paginator.paginate(Filters=[
+                        {'Key': 'DocumentNamePrefix', 'Values': [build_document]},
+                        {'Key': 'ExecutionStatus', 'Values': [execution_status]},
+                ]):
+                    builds_in_flight += len(page['AutomationExecutionMetadataList'])
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return builds_in_flight
+
+
+def get_build_variants(build_variants_setting):
+
+    '''
+        Get the build variants and their components from the "name:component+component" list
+    '''
+
+    build_variants = []
+    for entry in build_variants_setting.split(','):
+        if not entry.strip():
+            continue
+        name, _, components_setting = entry.strip().partition(':')
+        components = [component.strip() for component in components_setting.split('+') if component.strip()]
+        invalid_components = [component for component in components if component not in VARIANT_COMPONENTS]
+        if not name or invalid_components:
+            raise ValueError("BuildVariants entry '%s' must be 'name:component+component' with components from %s"
+                             % (entry.strip(), ", ".join(VARIANT_COMPONENTS)))
+        if name in [build_variant['Name'] for build_variant in build_variants]:
+            raise ValueError("BuildVariants variant '%s' is defined more than once" % name)
+        build_variants.append({'Name': name, 'Components': components})
+
+    return build_variants
+
+
+def get_build_regions(build_regions_setting, ssm_document):
+
+    '''
+        Get the build and command documents for each region to build in, starting with the local region
+    '''
+
+    build_regions = {region: {'SSMDocument': ssm_document, 'CommandDocuments': build_command_documents}}
+    for build_region_setting in build_regions_setting.split(','):
+        if not build_region_setting.strip():
+            continue
+        # The documents of this stack only exist in the local region
+        build_region, _, documents_setting = build_region_setting.strip().partition(':')
+        build_document, _, command_documents_setting = documents_setting.partition(':')
+        if not build_region or not build_document:
+            raise ValueError("BuildRegions entry '%s' must be 'region:build document' or 'region:build document:command document+command document'"
+                             % build_region_setting.strip())
+        build_regions[build_region] = {
+            'SSMDocument': build_document,
+            'CommandDocuments': [document.strip() for document in command_documents_setting.split('+') if document.strip()],
+        }
+
+    return build_regions
+
+
+def fan_out_builds(soe, build_regions, override_ami, force_build, build_instance_type, event):
+
+    '''
+        Start the build in every region concurrently
+    '''
+
+    if override_ami:
+        print("OverrideAMI '%s' only applies to region '%s'" % (override_ami, region))
+
+    workers = min(max_region_workers, len(build_regions))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            build_region: executor.submit(
+                start_build, soe, build_region, documents['SSMDocument'], documents['CommandDocuments'],
+                override_ami if build_region == region else "", force_build, build_instance_type,
+                get_client_token(event, 'build', build_region)
             )
-            print(images)
-            image_date_list = []
-            for image in images['Images']:
-                date = image['CreationDate']
-                image_date_list.append(date)
+            for build_region, documents in build_regions.items()
+        }
+
+    # A region failing to start must not lose the builds already started in the other regions
+    regional_builds = {}
+    for build_region, future in futures.items():
+        try:
+            regional_builds[build_region] = future.result()
+        except Exception as exc:
+            print("[%s] Build not started: %s" % (build_region, exc))
+            regional_builds[build_region] = {'RegionError': str(exc), 'BuildStatus': 'failed'}
+
+    return regional_builds
+
+
+def start_build(soe, build_region, build_document, command_documents, override_ami, force_build, build_instance_type, client_token):
+
+    '''
+        Resolve the source AMI and start the build automation in a region
+    '''
+
+    build = {}
+
+    # Step 1
+    source_ami_id = get_ami(soe['AMIPattern'], build_region, override_ami, soe['AMIOwner'], get_base_ami_param(soe['SOEType']),
+                            soe['Architecture'])
+    print("[%s] AMI ID: %s" % (build_region, source_ami_id))
+    build['SourceAMI'] = source_ami_id
+
+    # Step 2 - Patch the previous SOE image when it comes from the same base AMI and its full build is recent
+    incremental_mode = build_region == region and bool(soe['IncrementalSSMDocument'])
+    incremental_source = None
+    if incremental_mode and not force_build:
+        incremental_source = get_incremental_source(build_region, soe['NextAMIParam'], source_ami_id)
+
+    if incremental_source:
+        next_ami_id, full_build_date = incremental_source
+        print("[%s] Patching SOE image '%s' from full build '%s'" % (build_region, next_ami_id, full_build_date))
+        build['BuildMode'] = 'incremental'
+        build_document = soe['IncrementalSSMDocument']
+        build_parameters = {'sourceAMIid': [next_ami_id], 'BaseAMIid': [source_ami_id], 'FullBuildDate': [full_build_date]}
+
+    else:
+        # Step 3 - Reuse an existing SOE image built from the exact same inputs
+        build['BuildMode'] = 'full'
+        build_parameters = {'sourceAMIid': [source_ami_id]}
+        fingerprint_inputs = dict(build_parameters)
+        fingerprint_documents = command_documents
+
+        # Variants are finished from one shared base build, the first variant carries the fingerprint
+        build_variants = get_build_variants(build_variants_setting) if build_region == region else []
+        if build_variants:
+            build_document = base_ssm_document
+            fingerprint_inputs['BuildVariants'] = [build_variants_setting]
+            fingerprint_documents = command_documents + [variant_ssm_document]
 
-            print("Date list: " + json.dumps(image_date_list))
-            latest_date = max(image_date_list)
-            print("Latest date: " + latest_date)
+        fingerprint = compute_build_fingerprint(build_region, build_document, fingerprint_documents, fingerprint_inputs)
+        print("[%s] BuildFingerprint: %s" % (build_region, fingerprint))
+        build['BuildFingerprint'] = fingerprint
 
-            for image in images['Images']:
-                if image['CreationDate'] == latest_date:
-                    print("Latest AMI ID: " + image['ImageId'])
-                    ami_id = image['ImageId']
+        # An override AMI always builds, and so does incremental mode so the package updates are picked up
+        if skip_unchanged_base == 'true' and not override_ami and not force_build and not incremental_mode:
+            reused_ami_id = find_fingerprint_image(build_region, get_solution_soe_type(soe['SOEType']), fingerprint)
+            if reused_ami_id:
+                print("[%s] SOE image '%s' already built with fingerprint '%s'. Skipping build" % (build_region, reused_ami_id, fingerprint))
+                build['ReusedAMI'] = reused_ami_id
+                build['AMI'] = reused_ami_id
+                build['BuildStatus'] = 'skipped'
+                return build
+
+        build_parameters['BuildFingerprint'] = [fingerprint]
+        if incremental_mode:
+            build_parameters['FullBuildDate'] = [datetime.utcnow().strftime(RECORD_DATE_FORMAT)]
+        if build_variants:
+            build['BuildVariants'] = build_variants
+            build['BuildStage'] = 'base'
+
+    # Step 4 - Fail before paying for an instance if the build cannot succeed
+    if build_instance_type:
+        build_parameters['InstanceType'] = [build_instance_type]
+    if preflight_checks == 'true':
+        preflight_errors = run_preflight_checks(soe['SOEType'], build_region, build_document, command_documents,
+                                                build_parameters['sourceAMIid'][0], build_instance_type or DOCUMENT_INSTANCE_TYPE)
+        if preflight_errors:
+            print("[%s] Pre-flight checks failed: %s" % (build_region, json.dumps(preflight_errors)))
+            build['PreflightErrors'] = preflight_errors
+            build['CheckType'] = 'preflight'
+            build['BuildStatus'] = 'failed'
+            return build
+
+    # Step 5 - Name and tag the image per SOE Type so architectures and catalog entries are kept apart
+    build_parameters['SolutionSOEType'] = [get_solution_soe_type(soe['SOEType'])]
+    build_execution_id = trigger_ssm(solution_naming, build_region, build_document, soe['SOEType'], build_parameters, client_token)
+    print("[%s] BuildAutomationExecutionId: %s" % (build_region, build_execution_id))
+    build['BuildAutomationExecutionId'] = build_execution_id
+    if build.get('BuildVariants'):
+        # The variant builds start from the base image with the same build parameters
+        build['VariantParameters'] = dict(build_parameters, BaseAMIid=[source_ami_id])
+        del build['VariantParameters']['sourceAMIid']
+    build['BuildStatus'] = 'running'
+    return build
+
+
+def get_preflight_param(soe_type):
+
+    '''
+        Get the SSM Parameter holding the passed pre-flight checks of the SOE Type
+    '''
+
+    return '/' + solution_naming + '/' + soe_type + '/preflight'
+
+
+def run_preflight_checks(soe_type, build_region, build_document, command_documents, image_id, instance_type):
+
+    '''
+        Check in parallel that the build documents, instance profile and image launch are valid, skipping recently passed checks
+    '''
+
+    checks = {}
+    variant_documents = [variant_ssm_document] if build_variants_setting else []
+    for document_name in [build_document] + command_documents + variant_documents:
+        checks['document:%s:%s' % (build_region, document_name)] = (check_document, build_region, document_name)
+    if instance_profile:
+        checks['instance-profile:%s' % instance_profile] = (check_instance_profile, instance_profile)
+    checks['launch:%s:%s:%s:%s' % (build_region, image_id, instance_type, instance_profile)] = (
+        check_launch, build_region, image_id, instance_type, instance_profile)
+
+    preflight_param = get_preflight_param(soe_type)
+    now = datetime.utcnow()
+    passed_checks = {
+        key: passed_at for key, passed_at in get_ssm_record(region, preflight_param).items()
+        if now - datetime.strptime(passed_at, RECORD_DATE_FORMAT) < timedelta(seconds=preflight_cache_ttl)
+    }
+    pending_checks = {key: check for key, check in checks.items() if key not in passed_checks}
+    if not pending_checks:
+        print("[%s] All %s pre-flight checks passed within the last %s seconds" % (build_region, len(checks), preflight_cache_ttl))
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(pending_checks)) as executor:
+        futures = {key: executor.submit(*check) for key, check in pending_checks.items()}
+
+    preflight_errors = []
+    for key, future in futures.items():
+        preflight_error = future.result()
+        if preflight_error:
+            preflight_errors.append(preflight_error)
+        else:
+            passed_checks[key] = now.strftime(RECORD_DATE_FORMAT)
+
+    # Only passed checks are cached so a fixed failure is checked again on the next build
+    if len(passed_checks) > len(checks) - len(pending_checks):
+        put_ssm_record(region, preflight_param, passed_checks)
+
+    return preflight_errors
+
+
+def check_document(build_region, document_name):
+
+    '''
+        Check the SSM document exists and is active
+    '''
+
+    try:
+        document = get_client('ssm', build_region).describe_document(Name=document_name)['Document']
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == 'InvalidDocument':
+            return "SSM document '%s' does not exist in '%s'" % (document_name, build_region)
+        print(exc)
+        raise exc
+
+    if document.get('Status', 'Active') != 'Active':
+        return "SSM document '%s' in '%s' is '%s'" % (document_name, build_region, document['Status'])
+    return None
+
+
+def check_instance_profile(profile_name):
+
+    '''
+        Check the instance profile exists and has a role
+    '''
+
+    try:
+        profile = get_client('iam', region).get_instance_profile(InstanceProfileName=profile_name)['InstanceProfile']
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == 'NoSuchEntity':
+            return "Instance profile '%s' does not exist" % profile_name
+        print(exc)
+        raise exc
+
+    if not profile['Roles']:
+        return "Instance profile '%s' has no role" % profile_name
+    return None
+
+
+def check_launch(build_region, image_id, instance_type, profile_name):
+
+    '''
+        Dry run the build instance launch to check the image, its subscription, the instance type and the default subnet
+    '''
+
+    launch_args = {'IamInstanceProfile': {'Name': profile_name}} if profile_name else {}
+
+    try:
+        get_client('ec2', build_region).run_instances(
+            DryRun=True,
+            ImageId=image_id,
+            InstanceType=instance_type,
+            MinCount=1,
+            MaxCount=1,
+            **launch_args
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == 'DryRunOperation':
+            return None
+        # e.g. InvalidAMIID.NotFound
+        if exc.response['Error']['Code'].split('.')[0] in LAUNCH_ERRORS:
+            return "Launching '%s' on '%s' in '%s' would fail: %s" % (image_id, instance_type, build_region, exc.response['Error']['Message'])
+        print(exc)
+        raise exc
+
+    return None
+
+
+def get_client(service_name, client_region):
+
+    '''
+        Get a client for the service in the region, creating it once
+    '''
+
+    with CLIENTS_LOCK:
+        if (service_name, client_region) not in CLIENTS:
+            CLIENTS[(service_name, client_region)] = boto3.client(service_name, region_name=client_region, config=CLIENT_CONFIG)
+        return CLIENTS[(service_name, client_region)]
+
+
+def get_ami(ami_pattern, region, override_ami, ami_owner, base_ami_param, architecture=''):
+
+    '''
+        Get the source AMI for the SOE Type
+    '''
+
+    try:
+        if override_ami == "":
+            record = resolve_base_ami(ami_pattern, region, ami_owner, base_ami_param, architecture)
+            ami_id = record['ImageId']
 
         else:
             if override_ami.startswith('ami-'):
@@ -125,18 +843,292 @@ def get_ami(ami_pattern, region, override_ami, ami_owner):
 
     return ami_id
 
-def trigger_ssm(solution_naming, region, ssm_document, soe_type, ami_id):
+
+def resolve_base_ami(ami_pattern, region, ami_owner, base_ami_param, architecture=''):
+
+    '''
+        Resolve the latest base AMI, only scanning the marketplace when the cached record is stale
+    '''
+
+    record = get_ssm_record(region, base_ami_param)
+    if is_record_fresh(record, ami_pattern, ami_owner, architecture):
+        print("Using cached base AMI '%s' resolved at '%s'" % (record['ImageId'], record['ResolvedAt']))
+        return record
+
+    image = get_latest_image(region, ami_pattern, ami_owner, architecture)
+    record = {
+        'ImageId': image['ImageId'],
+        'CreationDate': image['CreationDate'],
+        'Pattern': ami_pattern,
+        'Owner': ami_owner,
+        'Architecture': architecture,
+        'ResolvedAt': datetime.utcnow().strftime(RECORD_DATE_FORMAT),
+    }
+    put_base_ami_record(region, base_ami_param, record)
+    return record
+
+
+def is_record_fresh(record, ami_pattern, ami_owner, architecture=''):
+
+    '''
+        Check the cached base AMI record matches the SOE Type and is within its TTL
+    '''
+
+    if not record:
+        return False
+    if record.get('Pattern') != ami_pattern or record.get('Owner') != ami_owner:
+        print("Cached base AMI record is for a different pattern or owner")
+        return False
+    if record.get('Architecture', '') != architecture:
+        print("Cached base AMI record is for a different architecture")
+        return False
+    try:
+        resolved_at = datetime.strptime(record['ResolvedAt'], RECORD_DATE_FORMAT)
+    except (KeyError, ValueError):
+        return False
+    return datetime.utcnow() - resolved_at < timedelta(seconds=base_ami_cache_ttl)
+
+
+def get_latest_image(region, ami_pattern, ami_owner, architecture=''):
+
+    '''
+        Get latest market place AMI for the SOE Type
+    '''
+
+    client = get_client('ec2', region)
+
+    filters = [
+        {
+            'Name': 'name',
+            'Values': [
+                ami_pattern,
+            ]
+        },
+        {
+            'Name': 'state',
+            'Values': [
+                'available',
+            ]
+        },
+    ]
+    # Patterns such as marketplace product names match the images of every architecture
+    if architecture:
+        filters.append({
+            'Name': 'architecture',
+            'Values': [
+                architecture,
+            ]
+        })
+
+    try:
+        print("Get available %simages matching '%s' with owner '%s'" % (architecture + ' ' if architecture else '', ami_pattern, ami_owner))
+        paginator = client.get_paginator('describe_images')
+        pages = paginator.paginate(
+            ExecutableUsers=[
+                EXEC_USERS,
+            ],
+            Filters=filters,
+            Owners=[
+                ami_owner,
+            ]
+        )
+        images = [image for page in pages for image in page['Images']]
+        print("Found %s images" % len(images))
+
+        latest_image = max(images, key=lambda image: image['CreationDate'])
+        print("Latest AMI ID: '%s' created '%s'" % (latest_image['ImageId'], latest_image['CreationDate']))
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    return latest_image
+
+
+def get_ssm_record(region, ssm_param):
+
+    '''
+        Get a JSON record from SSM Parameter store
+    '''
+
+    client = get_client('ssm', region)
+
+    try:
+        get_parameter_response = client.get_parameter(
+            Name=ssm_param,
+        )
+        return json.loads(get_parameter_response['Parameter']['Value'])
+
+    except ValueError:
+        print("Parameter '" + ssm_param + "' is not a valid record. Ignoring")
+        return {}
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] == "ParameterNotFound":
+            print("Parameter '" + ssm_param + "' does not exist. Returning empty record")
+            return {}
+        print(exc)
+        raise exc
+
+
+def put_base_ami_record(region, ssm_param, record):
+
+    '''
+        Save the resolved base AMI record to SSM Parameter store
+    '''
+
+    put_ssm_record(region, ssm_param, record)
+    print("SSM Parameter store '" + ssm_param + "' updated with base AMI '" + record['ImageId'] + "'")
+
+
+def put_ssm_record(region, ssm_param, record):
+
+    '''
+        Save a JSON record to SSM Parameter store
+    '''
+
+    client = get_client('ssm', region)
+
+    try:
+        client.put_parameter(
+            Name=ssm_param,
+            Value=json.dumps(record),
+            Type='String',
+            Overwrite=True
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
+def get_incremental_source(region, next_ami_param, source_ami_id):
+
+    '''
+        Get the next AMI and its full build date if it can be patched instead of rebuilt
+    '''
+
+    try:
+        get_parameter_response = get_client('ssm', region).get_parameter(
+            Name=next_ami_param,
+        )
+        next_ami_id = get_parameter_response['Parameter']['Value']
+        if not next_ami_id.startswith('ami-'):
+            print("No SOE image in '%s' to patch. Running a full build" % next_ami_param)
+            return None
+
+        images = get_client('ec2', region).describe_images(
+            ImageIds=[next_ami_id],
+            Owners=['self']
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        if exc.response['Error']['Code'] in ['ParameterNotFound', 'InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable']:
+            print("No SOE image in '%s' to patch. Running a full build" % next_ami_param)
+            return None
+        print(exc)
+        raise exc
+
+    if not images['Images']:
+        print("SOE image '%s' is not available. Running a full build" % next_ami_id)
+        return None
+
+    tags = {tag['Key']: tag['Value'] for tag in images['Images'][0].get('Tags', [])}
+    if tags.get('BaseAMIid') != source_ami_id:
+        print("SOE image '%s' was built from base AMI '%s' not '%s'. Running a full build" % (next_ami_id, tags.get('BaseAMIid'), source_ami_id))
+        return None
+
+    try:
+        full_build_date = datetime.strptime(tags['FullBuildDate'], RECORD_DATE_FORMAT)
+    except (KeyError, ValueError):
+        print("SOE image '%s' has no valid FullBuildDate. Running a full build" % next_ami_id)
+        return None
+
+    if datetime.utcnow() - full_build_date > timedelta(days=full_build_days):
+        print("SOE image '%s' full build is older than %s days. Running a full build" % (next_ami_id, full_build_days))
+        return None
+
+    return next_ami_id, tags['FullBuildDate']
+
+
+def compute_build_fingerprint(region, ssm_document, command_documents, build_parameters):
+
+    '''
+        Compute a content-addressed fingerprint of the build inputs
+    '''
+
+    client = get_client('ssm', region)
+
+    try:
+        document_hashes = {}
+        for document_name in [ssm_document] + command_documents:
+            document = client.describe_document(Name=document_name)['Document']
+            document_hashes[document_name] = document['Hash']
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    build_inputs = {
+        'Documents': document_hashes,
+        'Parameters': build_parameters,
+    }
+    return hashlib.sha256(json.dumps(build_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def find_fingerprint_image(region, solution_soe_type, fingerprint):
+
+    '''
+        Get the latest owned SOE image tagged with the build fingerprint
+    '''
+
+    client = get_client('ec2', region)
+
+    try:
+        images = client.describe_images(
+            Filters=[
+                {
+                    'Name': 'tag:SoeType',
+                    'Values': [solution_soe_type]
+                },
+                {
+                    'Name': 'tag:BuildFingerprint',
+                    'Values': [fingerprint]
+                },
+                {
+                    'Name': 'state',
+                    'Values': ['available']
+                },
+            ],
+            Owners=[
+                'self',
+            ]
+        )
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+    if not images['Images']:
+        return None
+    return max(images['Images'], key=lambda image: image['CreationDate'])['ImageId']
+
+
+def trigger_ssm(solution_naming, region, ssm_document, soe_type, build_parameters, client_token=None):
 
     '''
         Trigger Build SSM automation
     '''
 
-    client = boto3.client('ssm', region_name=region)
+    client = get_client('ssm', region)
+
+    # A replayed step with the same ClientToken gets back the original execution
+    launch_args = {'ClientToken': client_token} if client_token else {}
 
     try:
         ssm_response = client.start_automation_execution(
             DocumentName=ssm_document,
-            Parameters={'sourceAMIid': [ami_id]}
+            Parameters=build_parameters,
+            **launch_args
         )
         execution_id = ssm_response['AutomationExecutionId']
 
@@ -10,12 +10,17 @@ from datetime import datetime
 import boto3
 import botocore
 
+from soe_common.automation import start_test_automation
+
+
 print('Loading function ' + datetime.now().time().isoformat())
 
 ### Environment variables ###
 # General
 region = os.environ['Region']
 ssm_document = os.environ['SSMDocument']
+spot_ssm_document = os.environ.get('SpotSSMDocument', '')
+use_spot_test = os.environ.get('UseSpotTest', 'false')
 
 def lambda_handler(event, context):
 
@@ -34,11 +39,10 @@ def lambda_handler(event, context):
         ami_id = get_ami(region, build_automation_execution_id)
         print("AMI ID:" + ami_id)
 
-        # Step 2
-        test_execution_id = trigger_ssm(region, ssm_document, ami_id)
-        print("TestAutomationExecutionId: " + test_execution_id)
+        # Step 2 - Same launch as the fused advance of check_build
+        start_test_automation(region, event, ami_id, ssm_document, spot_ssm_document, use_spot_test)
+        print("TestAutomationExecutionId: " + event['TestAutomationExecutionId'])
 
-        event['TestAutomationExecutionId'] = test_execution_id
         event['AMI'] = ami_id
         return event
 
@@ -67,25 +71,3 @@ def get_ami(region, automation_execution_id):
 
     return ami_id
 
-
-def trigger_ssm(region, ssm_document, ami_id):
-
-    '''
-        Trigger test SSM automation
-    '''
-
-    client = boto3.client('ssm', region_name=region)
-
-
-    try:
-        ssm_response = client.start_automation_execution(
-            DocumentName=ssm_document,
-            Parameters={'sourceAMIid': [ami_id]}
-        )
-        execution_id = ssm_response['AutomationExecutionId']
-
-    except botocore.exceptions.ClientError as exc:
-        print(exc)
-        raise exc
-
-    return execution_id
@@ -18,6 +18,10 @@ print('Loading function ' + datetime.now().time().isoformat())
 # General
 region = os.environ['Region']
 next_ami_ssm_param = os.environ['NextAMIParam']
+instance_id_ssm_param = '/ami-baking-lnx-amzn-soe/lnx-amzn/instanceId'
+
+# Number of runs averaged per instance type and document so recent wall times keep their weight
+MAX_BENCHMARK_RUNS = 10
 
 def lambda_handler(event, context):
 
@@ -28,29 +32,52 @@ def lambda_handler(event, context):
     print("Event: " + json.dumps(event))
 
     try:
+        # Step 0 - Catalog builds keep their own nextAmi/instanceId params
+        next_ami_param, instance_id_param = get_soe_params(event.get('SOE', {}))
+
         # Step 1 - Get the latest build AMI ID (saved from trigger_test_function)
         next_ami_id = event['AMI']
         ami_id_regex = "^ami-([a-f0-9]+)$"
         pattern = re.compile(ami_id_regex)
         if not pattern.match(next_ami_id):
-            print("NextAMIParam '" + next_ami_ssm_param + "' does not match AMI Id format '" + ami_id_regex + "'")
-            raise ValueError("NextAMIParam '" + next_ami_ssm_param + "' does not match AMI Id format '" + ami_id_regex + "'")
+            print("NextAMIParam '" + next_ami_param + "' does not match AMI Id format '" + ami_id_regex + "'")
+            raise ValueError("NextAMIParam '" + next_ami_param + "' does not match AMI Id format '" + ami_id_regex + "'")
 
         # Step 2 - Update nextAmi SSM parameter
-        update_ssm_output = update_ssm_param(region, next_ami_ssm_param, next_ami_id)
-        print("SSM Parameter store '" + next_ami_ssm_param + "' updated with AMI '" + next_ami_id + "' version '" + update_ssm_output + "'")
+        update_ssm_output = update_ssm_param(region, next_ami_param, next_ami_id)
+        print("SSM Parameter store '" + next_ami_param + "' updated with AMI '" + next_ami_id + "' version '" + update_ssm_output + "'")
 
         # Step 3 - Update instanceId SSM parameter
         instance_id = event['BuildInstanceID']
         if instance_id:
-            instance_id_ssm_param = '/ami-baking-lnx-amzn-soe/lnx-amzn/instanceId'
-            update_ssm_output2 = update_ssm_param(region, instance_id_ssm_param, instance_id)
-            print("SSM Parameter store '" + instance_id_ssm_param + "' updated with AMI '" + instance_id + "' version '" + update_ssm_output2 + "'")
+            update_ssm_output2 = update_ssm_param(region, instance_id_param, instance_id)
+            print("SSM Parameter store '" + instance_id_param + "' updated with AMI '" + instance_id + "' version '" + update_ssm_output2 + "'")
         else:
             raise ValueError("BuildInstanceID is None")
 
+        # Step 4 - Record the build and test wall times of the instance types used
+        benchmarks_param = next_ami_param.rsplit('/', 1)[0] + '/instanceBenchmarks'
+        build_stage = 'incremental-build' if event.get('BuildMode') == 'incremental' else 'build'
+        stage_executions = {
+            build_stage: (event.get('BuildInstanceType'), event.get('BuildAutomationExecutionId')),
+            'test': (event.get('TestInstanceType'), event.get('TestAutomationExecutionId')),
+        }
+        if any(instance_type and execution_id for instance_type, execution_id in stage_executions.values()):
+            record_benchmarks(region, benchmarks_param, stage_executions)
+
+        # Step 5 - The other variants keep their own nextAmi next to the SOE Type
+        for build_variant in event.get('BuildVariants', [])[1:]:
+            variant_param = get_variant_param(next_ami_param, build_variant['Name'])
+            variant_ami_id = event['VariantAMIs'][build_variant['Name']]
+            update_ssm_param(region, variant_param, variant_ami_id)
+            print("SSM Parameter store '" + variant_param + "' updated with variant AMI '" + variant_ami_id + "'")
+
+        # Step 6 - Record the step durations of the build and test automations to schedule the next status checks
+        if event.get('StepSeconds'):
+            record_step_durations(region, next_ami_param.rsplit('/', 1)[0] + '/stepDurations', event['StepSeconds'])
+
         event["SsmParamVersion"] = update_ssm_output
-        event["SsmParam"] = next_ami_ssm_param
+        event["SsmParam"] = next_ami_param
         return event
 
     except BaseException as exc:
@@ -58,6 +85,112 @@ def lambda_handler(event, context):
         raise exc
 
 
+def get_soe_params(soe):
+
+    '''
+        Get the nextAmi and instanceId SSM Parameters for the SOE Type
+    '''
+
+    # The stack's own SOE Type keeps the instanceId parameter read by the publish function
+    if not soe.get('NextAMIParam') or soe['NextAMIParam'] == next_ami_ssm_param:
+        return next_ami_ssm_param, instance_id_ssm_param
+
+    next_ami_param = soe['NextAMIParam']
+    instance_id_param = next_ami_param.rsplit('/', 1)[0] + '/instanceId'
+    return next_ami_param, instance_id_param
+
+
+def get_variant_param(next_ami_param, variant):
+
+    '''
+        Get the nextAmi SSM Parameter of a build variant e.g. /prefix/lnx-amzn-java/nextAmi
+    '''
+
+    param_path, _, param_name = next_ami_param.rpartition('/')
+    return param_path + '-' + variant + '/' + param_name
+
+
+def record_benchmarks(region, benchmarks_param, stage_executions):
+
+    '''
+        Add the wall time of each stage to the running average of its instance type
+    '''
+
+    current_value = get_ssm_param(region, benchmarks_param)
+    try:
+        benchmarks = json.loads(current_value) if current_value else {}
+    except ValueError:
+        print("Parameter '" + benchmarks_param + "' is not a valid record. Starting again")
+        benchmarks = {}
+
+    for stage, (instance_type, execution_id) in stage_executions.items():
+        if not instance_type or not execution_id:
+            continue
+        seconds = get_execution_seconds(region, execution_id)
+        benchmark = benchmarks.setdefault(stage, {}).get(instance_type, {'Runs': 0, 'Seconds': 0})
+        runs = min(benchmark['Runs'], MAX_BENCHMARK_RUNS - 1)
+        benchmarks[stage][instance_type] = {
+            'Runs': runs + 1,
+            'Seconds': round((benchmark['Seconds'] * runs + seconds) / (runs + 1)),
+        }
+        print("Recorded %s wall time of %s seconds for '%s'" % (stage, seconds, instance_type))
+
+    update_ssm_param(region, benchmarks_param, json.dumps(benchmarks))
+    return benchmarks
+
+
+def record_step_durations(region, step_durations_param, step_seconds):
+
+    '''
+        Add the duration of each automation step to the running average of its document
+    '''
+
+    current_value = get_ssm_param(region, step_durations_param)
+    try:
+        step_durations = json.loads(current_value) if current_value else {}
+    except ValueError:
+        print("Parameter '" + step_durations_param + "' is not a valid record. Starting again")
+        step_durations = {}
+
+    for document_name, document_steps in step_seconds.items():
+        document_durations = step_durations.get(document_name, {'Runs': 0, 'Steps': {}})
+        runs = min(document_durations['Runs'], MAX_BENCHMARK_RUNS - 1)
+        for step_name, seconds in document_steps.items():
+            # A step skipped by earlier runs starts its average from this run
+            step_runs = runs if step_name in document_durations['Steps'] else 0
+            document_durations['Steps'][step_name] = round(
+                (document_durations['Steps'].get(step_name, 0) * step_runs + seconds) / (step_runs + 1)
+            )
+        document_durations['Runs'] = runs + 1
+        step_durations[document_name] = document_durations
+        print("Recorded the step durations of '%s'" % document_name)
+
+    update_ssm_param(region, step_durations_param, json.dumps(step_durations, separators=(',', ':')))
+    return step_durations
+
+
+def get_execution_seconds(region, execution_id):
+
+    '''
+        Get the wall time of an SSM automation execution
+    '''
+
+    try:
+        client = boto3.client('ssm', region_name=region)
+
+        ssm_response = client.get_automation_execution(
+            AutomationExecutionId=execution_id
+        )
+        execution = ssm_response['AutomationExecution']
+        end_time = execution.get('ExecutionEndTime', datetime.now(execution['ExecutionStartTime'].tzinfo))
+
+        return int((end_time - execution['ExecutionStartTime']).total_seconds())
+
+    except botocore.exceptions.ClientError as exc:
+        print(exc)
+        raise exc
+
+
 def get_ssm_param(region, ssm_param):
 
     '''
@@ -23,6 +23,10 @@ os.environ['SSMDocument'] = 'NON_SESNSIBLE_DEFAULT'
 os.environ['AMIPattern'] = 'NON_SESNSIBLE_DEFAULT'
 os.environ['AMIOwner'] = 'NON_SESNSIBLE_DEFAULT'
 os.environ['OverrideAMI'] = 'NON_SESNSIBLE_DEFAULT'
+os.environ['CatalogBucket'] = 'NON_SESNSIBLE_DEFAULT'
+os.environ['CatalogKey'] = 'NON_SESNSIBLE_DEFAULT'
+os.environ['StateMachineArn'] = 'NON_SESNSIBLE_DEFAULT'
+os.environ['DocumentNamePrefix'] = 'NON_SESNSIBLE_DEFAULT'
 
 class ContextMock(object):
     """Mock Context
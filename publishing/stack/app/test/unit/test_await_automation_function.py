@@ -0,0 +1,194 @@
+"""
+Test await_automation_function
+"""
+import copy
+import json
+import os
+from importlib import reload
+from test import CONST_REGION, ContextMock
+
+import botocore
+import pytest
+from mock import patch
+
+from await_automation import await_automation_function
+
+EVENT_FILE = os.path.join(os.path.dirname(__file__), 'data', 'automation_status_change_event.json')
+TASK_TOKEN = 'mock_task_token'
+
+
+def load_status_change_event(status):
+    """Load the local stand-in of the SSM automation status change event"""
+
+    with open(EVENT_FILE, 'r') as event_file:
+        event = json.load(event_file)
+    event['detail']['Status'] = status
+    return event
+
+
+def mock_aws(statuses, sent_outputs, send_error=None):
+    """Mock the automation status and the task token callback, which moto does NOT support"""
+
+    def mock_make_api_call(self, operation, args): # pylint: disable=unused-argument
+        if operation == 'GetAutomationExecution':
+            return {'AutomationExecution': {'AutomationExecutionStatus': statuses[args['AutomationExecutionId']]}}
+        if send_error:
+            raise botocore.exceptions.ClientError({'Error': {'Code': send_error, 'Message': send_error}}, operation)
+        sent_outputs.append((args['taskToken'], json.loads(args['output'])))
+        return {}
+
+    return mock_make_api_call
+
+
+@pytest.mark.parametrize("status,expected_resumed", [
+    ('Success', True),
+    ('Failed', True),
+    ('TimedOut', True),
+    ('InProgress', False), # Not a final status
+])
+def test_lambda_handler(status, expected_resumed, monkeypatch, tmp_path):
+    """Test await_automation_function.lambda_handler resumes the waiting build as soon as its automation finishes"""
+
+    monkeypatch.setenv("TokenStore", 'local')
+    monkeypatch.setenv("TokenDir", str(tmp_path))
+    reload(await_automation_function)
+    sent_outputs = []
+    statuses = {'mock_build_execution_id': 'InProgress'}
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_aws(statuses, sent_outputs)):
+        # The waiting state registers its token while the build is running
+        output = await_automation_function.lambda_handler({
+            'TaskToken': TASK_TOKEN,
+            'Stage': 'build',
+            'Input': {'BuildAutomationExecutionId': 'mock_build_execution_id'}
+        }, ContextMock())
+        assert output['AutomationExecutionIds'] == ['mock_build_execution_id']
+        assert sent_outputs == []
+
+        output = await_automation_function.lambda_handler(load_status_change_event(status), ContextMock())
+
+    assert output['Resumed'] is expected_resumed
+    token_record = await_automation_function.get_token_record(await_automation_function.get_token_param('mock_build_execution_id'))
+    if expected_resumed:
+        assert sent_outputs == [(TASK_TOKEN, {'AutomationExecutionId': 'mock_build_execution_id', 'Status': status})]
+        assert token_record == {}
+    else:
+        assert sent_outputs == []
+        assert token_record['TaskToken'] == TASK_TOKEN
+
+
+def test_lambda_handler_with_finished_automation(monkeypatch, tmp_path):
+    """Test await_automation_function.lambda_handler resumes straight away when an automation finished before the token was stored"""
+
+    monkeypatch.setenv("TokenStore", 'local')
+    monkeypatch.setenv("TokenDir", str(tmp_path))
+    reload(await_automation_function)
+    sent_outputs = []
+    statuses = {'exec-variant-1': 'InProgress', 'exec-variant-2': 'Failed'}
+    event = {
+        'TaskToken': TASK_TOKEN,
+        'Stage': 'build',
+        'Input': {
+            'BuildStage': 'variants',
+            'BuildAutomationExecutionId': 'exec-variant-1',
+            'VariantAutomationExecutionIds': {'standard': 'exec-variant-1', 'minimal': 'exec-variant-2'}
+        }
+    }
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_aws(statuses, sent_outputs)):
+        output = await_automation_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+        assert output['AutomationExecutionIds'] == []
+        assert sent_outputs == [(TASK_TOKEN, {'AutomationExecutionId': 'exec-variant-2', 'Status': 'Failed'})]
+
+        # Every record of the token is removed so a later event does not resume the execution again
+        status_change_event = load_status_change_event('Success')
+        status_change_event['detail']['ExecutionId'] = 'exec-variant-1'
+        assert await_automation_function.lambda_handler(status_change_event, ContextMock())['Resumed'] is False
+        assert len(sent_outputs) == 1
+
+
+def test_lambda_handler_with_succeeded_variant(monkeypatch, tmp_path):
+    """Test await_automation_function.lambda_handler only waits for the variants still running once one has succeeded"""
+
+    monkeypatch.setenv("TokenStore", 'local')
+    monkeypatch.setenv("TokenDir", str(tmp_path))
+    reload(await_automation_function)
+    sent_outputs = []
+    statuses = {'exec-variant-1': 'InProgress', 'exec-variant-2': 'Success'}
+    event = {
+        'TaskToken': TASK_TOKEN,
+        'Stage': 'build',
+        'Input': {
+            'BuildStage': 'variants',
+            'BuildAutomationExecutionId': 'exec-variant-1',
+            'VariantAutomationExecutionIds': {'standard': 'exec-variant-1', 'minimal': 'exec-variant-2'}
+        }
+    }
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_aws(statuses, sent_outputs)):
+        output = await_automation_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+        # Not resumed by the variant that already succeeded, so the state machine does not loop
+        assert output['AutomationExecutionIds'] == ['exec-variant-1']
+        assert sent_outputs == []
+        assert await_automation_function.get_token_record(await_automation_function.get_token_param('exec-variant-2')) == {}
+
+        status_change_event = load_status_change_event('Success')
+        status_change_event['detail']['ExecutionId'] = 'exec-variant-1'
+        assert await_automation_function.lambda_handler(status_change_event, ContextMock())['Resumed'] is True
+        assert sent_outputs == [(TASK_TOKEN, {'AutomationExecutionId': 'exec-variant-1', 'Status': 'Success'})]
+
+
+def test_lambda_handler_with_remote_automation(monkeypatch, tmp_path):
+    """Test await_automation_function.lambda_handler refuses to wait for an automation of another region"""
+
+    monkeypatch.setenv("TokenStore", 'local')
+    monkeypatch.setenv("TokenDir", str(tmp_path))
+    reload(await_automation_function)
+    sent_outputs = []
+    statuses = {'exec-local': 'Success', 'exec-us-east-1': 'InProgress'}
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_aws(statuses, sent_outputs)):
+        with pytest.raises(ValueError) as excinfo:
+            await_automation_function.lambda_handler({
+                'TaskToken': TASK_TOKEN,
+                'Stage': 'build',
+                'Input': {'BuildAutomationExecutionId': 'exec-local', 'BuildAutomationExecutionIds': {'us-east-1': 'exec-us-east-1'}}
+            }, ContextMock())
+
+    assert "can not be awaited" in str(excinfo.value)
+    assert sent_outputs == []
+
+
+def test_lambda_handler_with_stale_token(monkeypatch, tmp_path):
+    """Test await_automation_function.lambda_handler ignores a state machine task that is no longer waiting"""
+
+    monkeypatch.setenv("TokenStore", 'local')
+    monkeypatch.setenv("TokenDir", str(tmp_path))
+    reload(await_automation_function)
+    sent_outputs = []
+    statuses = {'mock_test_execution_id': 'InProgress'}
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_aws(statuses, sent_outputs, 'TaskTimedOut')):
+        await_automation_function.lambda_handler({
+            'TaskToken': TASK_TOKEN,
+            'Stage': 'test',
+            'Input': {'TestAutomationExecutionId': 'mock_test_execution_id'}
+        }, ContextMock())
+
+        status_change_event = load_status_change_event('Success')
+        status_change_event['detail']['ExecutionId'] = 'mock_test_execution_id'
+        output = await_automation_function.lambda_handler(status_change_event, ContextMock())
+
+    assert output == {'Resumed': False, 'Stage': 'test'}
+    assert await_automation_function.get_token_record(await_automation_function.get_token_param('mock_test_execution_id')) == {}
+
+
+def test_get_awaited_executions():
+    """Test await_automation_function.get_awaited_executions waits for the build in every region"""
+
+    assert await_automation_function.get_awaited_executions('build', {
+        'BuildAutomationExecutionId': 'exec-local',
+        'BuildAutomationExecutionIds': {CONST_REGION: 'exec-local', 'us-east-1': 'exec-us-east-1'}
+    }) == {'exec-local': CONST_REGION, 'exec-us-east-1': 'us-east-1'}
@@ -2,12 +2,14 @@
 Test check_build_function
 """
 import copy
+import json
+from datetime import datetime, timedelta, timezone
 from test import ContextMock
 
 import pytest
 from mock import MagicMock, patch, call
 
-from check_build.check_build_function import lambda_handler
+from check_build.check_build_function import classify_status, lambda_handler
 
 
 @pytest.mark.parametrize("automation_execution_status,build_status", [
@@ -54,14 +56,283 @@ def test_lambda_handler(mock_get_automation_execution, automation_execution_stat
     assert output_event["CheckType"] == "ssm_build"
 
     # Verify the mocks have been called as expected
-    # TODO: Update lambda_handler to call once instead of twice the exact same request
-    assert mock_get_automation_execution.call_count == 2
+    assert mock_get_automation_execution.call_count == 1
     expected = [
         call('GetAutomationExecution', {
             'AutomationExecutionId': mock_automation_execution_id
         }),
-        call('GetAutomationExecution', {
-            'AutomationExecutionId': mock_automation_execution_id
-        }),
     ]
     assert mock_get_automation_execution.call_args_list == expected
+
+
+@pytest.mark.parametrize("regional_statuses, local_build, expected_build_status", [
+    ({'ap-southeast-2': 'Success', 'us-east-1': 'Success'}, True, 'succeeded'),
+    ({'ap-southeast-2': 'Success', 'us-east-1': 'InProgress'}, True, 'running'),
+    ({'ap-southeast-2': 'InProgress', 'us-east-1': 'Failed'}, True, 'failed'),
+    ({'ap-southeast-2': 'Success', 'us-east-1': 'Other'}, True, 'unknown'),
+    ({'us-east-1': 'Success'}, False, 'skipped'), # Local region reused an existing image
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_build_regions(mock_get_automation_execution, regional_statuses, local_build, expected_build_status):
+    """Test check_build_function.lambda_handler polls every regional build"""
+
+    mock_instance_id = 'i-12345678'
+    statuses = {'exec-' + build_region: status for build_region, status in regional_statuses.items()}
+
+    def mock_ssm_client(operation, args): # pylint: disable=unused-argument
+        return {
+            'AutomationExecution': {
+                'AutomationExecutionStatus': statuses[args['AutomationExecutionId']],
+                'Outputs': {
+                    'startInstances.InstanceIds': ["  \"%s\"  " % mock_instance_id]
+                }
+            }
+        }
+    mock_get_automation_execution.side_effect = mock_ssm_client
+
+    event = {'BuildAutomationExecutionIds': {build_region: 'exec-' + build_region for build_region in regional_statuses}}
+    if local_build:
+        event['BuildAutomationExecutionId'] = 'exec-ap-southeast-2'
+
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event["BuildStatus"] == expected_build_status
+    assert set(output_event["RegionalBuildStatus"]) == set(regional_statuses)
+    if local_build:
+        assert output_event["InstanceID"] == mock_instance_id
+    else:
+        assert "InstanceID" not in output_event
+
+
+@pytest.mark.parametrize("update_output, expected_build_status", [
+    (["SOE_UPDATES_APPLIED\n"], 'succeeded'),
+    (["SOE_NO_UPDATES_APPLIED\n"], 'no-op'),
+    (None, 'succeeded'), # Full build without the updates check
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_no_updates_applied(mock_get_automation_execution, update_output, expected_build_status):
+    """Test check_build_function.lambda_handler ends the run when the build applied no updates"""
+
+    outputs = {'startInstances.InstanceIds': ["i-12345678"]}
+    if update_output is not None:
+        outputs['checkUpdatesApplied.Output'] = update_output
+    mock_get_automation_execution.return_value = {
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'Success',
+            'Outputs': outputs
+        }
+    }
+
+    output_event = lambda_handler({'BuildAutomationExecutionId': 'mock_automation_execution_id'}, ContextMock())
+
+    assert output_event["BuildStatus"] == expected_build_status
+    assert output_event["InstanceID"] == 'i-12345678'
+
+
+@pytest.mark.parametrize("minimal_status", ['Success', 'Failed'])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_build_variants(mock_make_api_call, minimal_status):
+    """Test check_build_function.lambda_handler finishes every variant from the base build"""
+
+    executions = {
+        'exec-base': ('Success', 'ami-base'),
+        'exec-standard': ('InProgress', None),
+        'exec-minimal': ('InProgress', None),
+    }
+    started_variants = []
+
+    def mock_ssm_client(operation, args):
+        if operation == 'StartAutomationExecution':
+            started_variants.append(args)
+            return {'AutomationExecutionId': 'exec-' + args['Parameters']['Variant'][0]}
+        if operation == 'GetAutomationExecution':
+            status, image_id = executions[args['AutomationExecutionId']]
+            outputs = {'startInstances.InstanceIds': ['i-' + args['AutomationExecutionId']]}
+            if image_id:
+                outputs['createImage.ImageId'] = [image_id]
+            return {'AutomationExecution': {'AutomationExecutionStatus': status, 'Outputs': outputs}}
+        if operation == 'DescribeImages':
+            return {'Images': [{'ImageId': 'ami-base', 'BlockDeviceMappings': [{'Ebs': {'SnapshotId': 'snap-base'}}]}]}
+        return {}
+    mock_make_api_call.side_effect = mock_ssm_client
+
+    event = {
+        'BuildAutomationExecutionId': 'exec-base',
+        'BuildStage': 'base',
+        'BuildVariants': [{'Name': 'standard', 'Components': ['codedeploy', 'corretto']}, {'Name': 'minimal', 'Components': []}],
+        'VariantParameters': {'BaseAMIid': ['ami-source'], 'BuildFingerprint': ['mock-fingerprint']},
+    }
+
+    # The base build finished, the variants are started from its image
+    event = lambda_handler(event, ContextMock())
+
+    assert event['BuildStatus'] == 'running'
+    assert event['BuildStage'] == 'variants'
+    assert event['VariantAutomationExecutionIds'] == {'standard': 'exec-standard', 'minimal': 'exec-minimal'}
+    assert event['BuildAutomationExecutionId'] == 'exec-standard'
+    assert event['BaseAutomationExecutionId'] == 'exec-base'
+    started_parameters = {args['Parameters']['Variant'][0]: args['Parameters'] for args in started_variants}
+    assert started_parameters['standard'] == {
+        'BaseAMIid': ['ami-source'], 'BuildFingerprint': ['mock-fingerprint'], 'sourceAMIid': ['ami-base'],
+        'Variant': ['standard'], 'InstallCodedeploy': ['true'], 'InstallCorretto': ['true'],
+    }
+    assert started_parameters['minimal']['BuildFingerprint'] == ['none']
+    assert started_parameters['minimal']['InstallCodedeploy'] == ['false']
+
+    # One variant still running
+    executions['exec-standard'] = ('Success', 'ami-standard')
+    event = lambda_handler(event, ContextMock())
+    assert event['BuildStatus'] == 'running'
+    assert event['VariantBuildStatus'] == {'standard': 'succeeded', 'minimal': 'running'}
+
+    # Every variant finished, the base image is removed
+    executions['exec-minimal'] = (minimal_status, 'ami-minimal' if minimal_status == 'Success' else None)
+    event = lambda_handler(event, ContextMock())
+    assert event['BuildStage'] == 'done'
+    assert event['InstanceID'] == 'i-exec-standard'
+    mock_make_api_call.assert_any_call('DeregisterImage', {'ImageId': 'ami-base'})
+    mock_make_api_call.assert_any_call('DeleteSnapshot', {'SnapshotId': 'snap-base'})
+    if minimal_status == 'Success':
+        assert event['BuildStatus'] == 'succeeded'
+        assert event['VariantAMIs'] == {'standard': 'ami-standard', 'minimal': 'ami-minimal'}
+    else:
+        # The image of the variant that succeeded is not kept either
+        assert event['BuildStatus'] == 'failed'
+        assert 'VariantAMIs' not in event
+        mock_make_api_call.assert_any_call('DeregisterImage', {'ImageId': 'ami-standard'})
+
+
+@pytest.mark.parametrize("step_durations, expected_next_poll_seconds", [
+    ({}, 60), # No recorded durations
+    ({'BuildDoc': {'Runs': 3, 'Steps': {'startInstances': 60, 'updateOS': 400, 'createImage': 300}}}, 500),
+    ({'BuildDoc': {'Runs': 3, 'Steps': {'startInstances': 60, 'updateOS': 90}}}, 15), # Overdue, poll tightly
+    ({'BuildDoc': {'Runs': 3, 'Steps': {'startInstances': 60, 'updateOS': 400, 'createImage': 3000}}}, 600),
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_step_durations(mock_make_api_call, step_durations, expected_next_poll_seconds):
+    """Test check_build_function.lambda_handler sleeps until the build is expected to finish"""
+
+    now = datetime.now(timezone.utc)
+    mock_make_api_call.return_value = {
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'InProgress',
+            'DocumentName': 'BuildDoc',
+            'Outputs': {'startInstances.InstanceIds': ["i-12345678"]},
+            'StepExecutions': [
+                {'StepName': 'startInstances', 'StepStatus': 'Success',
+                 'ExecutionStartTime': now - timedelta(seconds=300), 'ExecutionEndTime': now - timedelta(seconds=200)},
+                {'StepName': 'updateOS', 'StepStatus': 'InProgress', 'ExecutionStartTime': now - timedelta(seconds=200)},
+                {'StepName': 'createImage', 'StepStatus': 'Pending'},
+            ]
+        }
+    }
+
+    event = {'BuildAutomationExecutionId': 'mock_automation_execution_id', 'StepDurations': step_durations, 'NextPollSeconds': 45}
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildStatus'] == 'running'
+    assert output_event['NextPollSeconds'] == expected_next_poll_seconds
+    assert mock_make_api_call.call_count == 1
+
+    # A finished build records its step durations and no longer schedules a poll
+    mock_make_api_call.return_value['AutomationExecution']['AutomationExecutionStatus'] = 'Success'
+    mock_make_api_call.return_value['AutomationExecution']['StepExecutions'][1].update(
+        {'StepStatus': 'Success', 'ExecutionEndTime': now})
+    output_event = lambda_handler(output_event, ContextMock())
+
+    assert output_event['BuildStatus'] == 'succeeded'
+    assert 'NextPollSeconds' not in output_event
+    assert output_event['StepSeconds'] == {'BuildDoc': {'startInstances': 100, 'updateOS': 200}}
+
+
+@pytest.mark.parametrize("expected_update_os_seconds, expected_progress", [
+    (None, {'CurrentStep': 'updateOS', 'StepsCompleted': 1, 'StepsTotal': 3, 'ElapsedSeconds': 300, 'StepElapsedSeconds': 200}),
+    (400, {'CurrentStep': 'updateOS', 'StepsCompleted': 1, 'StepsTotal': 3, 'ElapsedSeconds': 300, 'StepElapsedSeconds': 200,
+           'EtaSeconds': 500, 'StepExpectedSeconds': 400, 'Overrun': False}),
+    (60, {'CurrentStep': 'updateOS', 'StepsCompleted': 1, 'StepsTotal': 3, 'ElapsedSeconds': 300, 'StepElapsedSeconds': 200,
+          'EtaSeconds': 300, 'StepExpectedSeconds': 60, 'Overrun': True}), # Running far beyond its normal duration
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_progress(mock_make_api_call, expected_update_os_seconds, expected_progress, capsys):
+    """Test check_build_function.lambda_handler reports the step progress of a running build in the event and as metrics"""
+
+    now = datetime.now(timezone.utc)
+    mock_make_api_call.return_value = {
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'InProgress',
+            'DocumentName': 'BuildDoc',
+            'Outputs': {'startInstances.InstanceIds': ["i-12345678"]},
+            'StepExecutions': [
+                {'StepName': 'startInstances', 'StepStatus': 'Success',
+                 'ExecutionStartTime': now - timedelta(seconds=300), 'ExecutionEndTime': now - timedelta(seconds=200)},
+                {'StepName': 'updateOS', 'StepStatus': 'InProgress', 'ExecutionStartTime': now - timedelta(seconds=200)},
+                {'StepName': 'createImage', 'StepStatus': 'Pending'},
+            ]
+        }
+    }
+    step_durations = {}
+    if expected_update_os_seconds:
+        step_durations = {'BuildDoc': {'Runs': 3, 'Steps': {'startInstances': 100, 'updateOS': expected_update_os_seconds, 'createImage': 300}}}
+
+    event = {'BuildAutomationExecutionId': 'mock_automation_execution_id', 'StepDurations': step_durations}
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildProgress'] == expected_progress
+    metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+    assert len(metrics) == 1
+    assert metrics[0]['Stage'] == 'build'
+    assert metrics[0]['Step'] == 'updateOS'
+    assert metrics[0]['StepElapsedSeconds'] == 200
+    assert metrics[0].get('StepOverrun') == (None if not expected_update_os_seconds else int(expected_progress['Overrun']))
+
+
+@patch('check_build.check_build_function.test_ssm_document', 'TestDoc')
+@patch('check_build.check_build_function.fused_advance', 'true')
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_fused_advance(mock_make_api_call):
+    """Test check_build_function.lambda_handler starts the test of a successful build in the same invocation"""
+
+    def mock_api_call(operation, args):
+        if operation == 'GetAutomationExecution':
+            return {'AutomationExecution': {
+                'AutomationExecutionStatus': 'Success',
+                'Outputs': {'startInstances.InstanceIds': ["i-12345678"], 'createImage.ImageId': ["ami-12345678"]},
+            }}
+        return {'AutomationExecutionId': 'mock_test_execution_id'}
+    mock_make_api_call.side_effect = mock_api_call
+
+    event = {
+        'BuildAutomationExecutionId': 'mock_automation_execution_id',
+        'Execution': {'Id': 'arn:aws:states:ap-southeast-2:123456789012:execution:sm:run-1'},
+        'StepDurations': {'TestDoc': {'Runs': 1, 'Steps': {'startInstances': 90, 'runInSpecLinux': 240}}},
+    }
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildStatus'] == 'succeeded'
+    assert output_event['Advanced'] == 'test'
+    assert output_event['TestAutomationExecutionId'] == 'mock_test_execution_id'
+    assert output_event['AMI'] == 'ami-12345678'
+    assert output_event['BuildInstanceID'] == 'i-12345678'
+    assert output_event['TestCapacity'] == 'on-demand'
+    assert output_event['NextPollSeconds'] == 330
+    start_args = mock_make_api_call.call_args_list[-1][0][1]
+    assert start_args['DocumentName'] == 'TestDoc'
+    assert start_args['Parameters'] == {'sourceAMIid': ['ami-12345678']}
+    assert start_args['ClientToken']
+
+
+@pytest.mark.parametrize("automation_status, expected_state", [
+    ('Pending', 'running'),
+    ('InProgress', 'running'),
+    ('Waiting', 'running'),
+    ('Success', 'succeeded'),
+    ('Cancelling', 'failed'),
+    ('Failed', 'failed'),
+    ('Cancelled', 'failed'),
+    ('TimedOut', 'failed'),
+    ('ChangeCalendarOverrideApproved', 'unknown'),
+])
+def test_classify_status(automation_status, expected_state):
+    """Test check_build_function.classify_status maps every automation status without an API call"""
+
+    assert classify_status(automation_status) == expected_state
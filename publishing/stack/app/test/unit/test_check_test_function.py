@@ -2,12 +2,15 @@
 Test check_test_function
 """
 import copy
+from datetime import datetime, timedelta, timezone
 from test import ContextMock
 
 import pytest
-from mock import MagicMock, patch, call
+from mock import ANY, MagicMock, patch, call
 
-from check_test.check_test_function import lambda_handler
+from check_test.check_test_function import lambda_handler, vulnerability_result
+from soe_common.automation import ExecutionSnapshot
+from soe_common.findings import FindingRules
 
 
 @pytest.mark.parametrize("automation_execution_status, expected_build_status, ignore_test_failure", [
@@ -83,14 +86,204 @@ def test_lambda_handler(mock_get_automation_execution, automation_execution_stat
     assert output_event["CheckType"] == "ssm_test"
 
     # Verify the mocks have been called as expected
-    # TODO: Update lambda_handler to call once instead of twice the exact same request
-    assert mock_get_automation_execution.call_count == 2
+    assert mock_get_automation_execution.call_count == 1
     expected = [
         call('GetAutomationExecution', {
             'AutomationExecutionId': mock_automation_execution_id
         }),
-        call('GetAutomationExecution', {
-            'AutomationExecutionId': mock_automation_execution_id
-        }),
     ]
     assert mock_get_automation_execution.call_args_list == expected
+
+
+@pytest.mark.parametrize("failure_message, test_capacity, expected_test_status", [
+    ('InsufficientInstanceCapacity: There is no Spot capacity available', 'spot', 'retry'),
+    ('An error occurred (SpotMaxPriceTooLow) when calling RunInstances', 'spot', 'retry'),
+    ('An error occurred (UnauthorizedOperation) when calling RunInstances', 'spot', 'failed'),
+    ('InsufficientInstanceCapacity: There is no capacity available', 'on-demand', 'failed'),
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_spot_capacity_failure(mock_get_automation_execution, failure_message, test_capacity, expected_test_status):
+    """Test check_test_function.lambda_handler retries on demand when spot capacity is unavailable"""
+
+    mock_get_automation_execution.side_effect = MagicMock(return_value={
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'Failed',
+            'Outputs': {
+                'startInstances.InstanceIds': ["  \"i-12345678\"  "]
+            },
+            'StepExecutions': [
+                {'StepName': 'startInstances', 'StepStatus': 'Failed', 'FailureMessage': failure_message}
+            ]
+        }
+    })
+
+    event = {'TestAutomationExecutionId': 'mock_automation_execution_id', 'TestCapacity': test_capacity}
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event["TestStatus"] == expected_test_status
+    assert output_event["TestCapacity"] == ('on-demand' if expected_test_status == 'retry' else test_capacity)
+
+
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_step_durations(mock_make_api_call):
+    """Test check_test_function.lambda_handler sleeps until the test automation is expected to finish"""
+
+    now = datetime.now(timezone.utc)
+    mock_make_api_call.return_value = {
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'InProgress',
+            'DocumentName': 'TestDoc',
+            'Outputs': {'startInstances.InstanceIds': ["i-12345678"]},
+            'StepExecutions': [
+                {'StepName': 'startInstances', 'StepStatus': 'InProgress', 'ExecutionStartTime': now - timedelta(seconds=30)},
+            ]
+        }
+    }
+
+    event = {
+        'TestAutomationExecutionId': 'mock_automation_execution_id',
+        'StepDurations': {'TestDoc': {'Runs': 1, 'Steps': {'startInstances': 90, 'runInSpecLinux': 240}}}
+    }
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['TestStatus'] == 'running'
+    assert output_event['NextPollSeconds'] == 300
+    assert mock_make_api_call.call_count == 1
+
+
+@pytest.mark.parametrize("keep_test_instance, expected_terminated", [
+    (None, True),
+    ('True', False),
+])
+@patch('check_test.check_test_function.fused_advance', 'true')
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_fused_advance(mock_make_api_call, keep_test_instance, expected_terminated):
+    """Test check_test_function.lambda_handler terminates the test instance of a finished test in the same invocation"""
+
+    mock_make_api_call.return_value = {
+        'AutomationExecution': {
+            'AutomationExecutionStatus': 'Failed',
+            'Outputs': {'startInstances.InstanceIds': ["i-12345678"]},
+        }
+    }
+
+    event = {'TestAutomationExecutionId': 'mock_automation_execution_id', 'IgnoreTestFailure': 'True', 'Advanced': 'test'}
+    if keep_test_instance:
+        event['KeepTestInstance'] = keep_test_instance
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['TestStatus'] == 'skipped'
+    assert output_event['Advanced'] == 'terminate'
+    terminated = call('TerminateInstances', {'InstanceIds': ['i-12345678']}) in mock_make_api_call.call_args_list
+    assert terminated is expected_terminated
+
+
+@pytest.mark.parametrize("assessment_run_state, compliance_status, inspec_deadline, expected_test_status, expected_check_type, expected_stopped", [
+    ('COLLECTING_DATA', 'NON_COMPLIANT', None, 'failed', 'inspec', True), # Fails without waiting out the assessment
+    ('COLLECTING_DATA', 'COMPLIANT', None, 'running', 'inspector', False),
+    ('FAILED', 'COMPLIANT', None, 'failed', 'inspector', False),
+    ('FAILED', 'NON_COMPLIANT', None, 'failed', 'inspec', False),
+    ('COMPLETED', None, None, 'running', 'inspec', False), # Not reported yet, checked again by the state machine
+    ('COMPLETED', None, '2099-01-01T00:00:00Z', 'running', 'inspec', False),
+    ('COLLECTING_DATA', None, '2020-01-01T00:00:00Z', 'failed', 'inspec_not_reported', True),
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_concurrent_results(mock_make_api_call, assessment_run_state, compliance_status, inspec_deadline,
+                                                expected_test_status, expected_check_type, expected_stopped):
+    """Test check_test_function.lambda_handler reads the Inspector and InSpec results at once and fails fast on InSpec"""
+
+    run_arn = 'arn:aws:inspector:ap-southeast-2:123456789012:target/0-ab/template/0-cd/run/0-ef'
+
+    def mock_api_call(operation, args):
+        if operation == 'GetAutomationExecution':
+            return {'AutomationExecution': {
+                'AutomationExecutionStatus': 'Success',
+                'Outputs': {'startInstances.InstanceIds': ["i-12345678"], 'runVulnerabilityScan.Output': ['"%s"' % run_arn]},
+            }}
+        if operation == 'DescribeAssessmentRuns':
+            return {'assessmentRuns': [{'state': assessment_run_state}]}
+        if operation == 'ListResourceComplianceSummaries':
+            if not compliance_status:
+                return {'ResourceComplianceSummaryItems': []}
+            return {'ResourceComplianceSummaryItems': [{'ResourceId': 'i-12345678', 'Status': compliance_status}]}
+        return {}
+    mock_make_api_call.side_effect = mock_api_call
+
+    event = {'TestAutomationExecutionId': 'mock_automation_execution_id'}
+    if inspec_deadline:
+        event['InSpecDeadline'] = inspec_deadline
+    output_event = lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['TestStatus'] == expected_test_status
+    assert output_event['CheckType'] == expected_check_type
+    assert ('InSpecDeadline' in output_event) is (not compliance_status or bool(inspec_deadline))
+    assert mock_make_api_call.call_args_list.count(call('ListResourceComplianceSummaries', ANY)) == 1
+    stopped = call('StopAssessmentRun', {'assessmentRunArn': run_arn, 'stopAction': 'SKIP_EVALUATION'}) in mock_make_api_call.call_args_list
+    assert stopped is expected_stopped
+
+
+def mock_findings_pages(pages):
+    """Mock the Inspector findings, one page of finding ARNs per list_findings call"""
+
+    findings = {arn: finding for page in pages for arn, finding in page}
+
+    def mock_api_call(operation, args):
+        if operation == 'ListFindings':
+            page_index = int(args.get('nextToken', 0))
+            page = {'findingArns': [arn for arn, _ in pages[page_index]]}
+            if page_index + 1 < len(pages):
+                page['nextToken'] = str(page_index + 1)
+            return page
+        return {'findings': [findings[arn] for arn in args['findingArns']]}
+
+    return mock_api_call
+
+
+def make_finding(finding_id, severity):
+    """Make an Inspector finding of the severity"""
+
+    return ('arn:finding/' + finding_id, {'id': finding_id, 'severity': severity, 'attributes': []})
+
+
+@pytest.mark.parametrize("fail_fast, expected_describe_calls", [
+    ('false', 3),
+    ('true', 1), # Stops listing after the breaking finding of the first page
+])
+@patch('check_test.check_test_function.max_findings_workers', 1)
+@patch('botocore.client.BaseClient._make_api_call')
+def test_vulnerability_result(mock_make_api_call, fail_fast, expected_describe_calls):
+    """Test check_test_function.vulnerability_result classifies each page of findings as it is described"""
+
+    mock_make_api_call.side_effect = mock_findings_pages([
+        [make_finding('CVE-1', 'High'), make_finding('CVE-2', 'Low')],
+        [make_finding('CVE-3', 'Medium')],
+        [make_finding('CVE-4', 'Low')],
+    ])
+    test_execution = ExecutionSnapshot({'Outputs': {'runVulnerabilityScan.Output': ['"mock_run_arn"']}})
+
+    with patch('check_test.check_test_function.findings_fail_fast', fail_fast):
+        result, stats = vulnerability_result(test_execution, FindingRules([]))
+
+    assert result == 'Failed'
+    describe_calls = [args for args in mock_make_api_call.call_args_list if args[0][0] == 'DescribeFindings']
+    assert len(describe_calls) == expected_describe_calls
+    assert stats == ({'Low': 2, 'Medium': 1} if fail_fast == 'false' else {'Low': 1})
+    list_calls = [args for args in mock_make_api_call.call_args_list if args[0][0] == 'ListFindings']
+    assert all(args[0][1]['maxResults'] == 100 for args in list_calls)
+
+
+@patch('botocore.client.BaseClient._make_api_call')
+def test_vulnerability_result_without_breaking_findings(mock_make_api_call):
+    """Test check_test_function.vulnerability_result passes once every page of findings is classified"""
+
+    mock_make_api_call.side_effect = mock_findings_pages([
+        [make_finding('CVE-%s' % index, 'Low') for index in range(100)],
+        [make_finding('CVE-%s' % index, 'Medium') for index in range(100, 150)],
+        [],
+    ])
+    test_execution = ExecutionSnapshot({'Outputs': {'runVulnerabilityScan.Output': ['"mock_run_arn"']}})
+
+    result, stats = vulnerability_result(test_execution, FindingRules([]))
+
+    assert result == 'Passed'
+    assert stats == {'Low': 100, 'Medium': 50}
@@ -0,0 +1,93 @@
+"""
+Test cve_trigger_function
+"""
+import copy
+import json
+import os
+from importlib import reload
+from test import CONST_NEXT_AMI_PARAM, CONST_REGION, CONST_SOE_TYPE, CONST_SOL_NAMING, ContextMock
+
+import boto3
+import pytest
+from mock import MagicMock
+from moto import mock_ec2, mock_ssm
+
+from cve_trigger import cve_trigger_function
+
+FEED_FILE = os.path.join(os.path.dirname(__file__), 'data', 'alas.rss')
+TRIGGER_STATE_PARAM = '/' + CONST_SOL_NAMING + '/' + CONST_SOE_TYPE + '/advisoryTrigger'
+
+
+def setup_soe_image(monkeypatch, packages):
+    """Create the current SOE image and mock its package inventory and the build state machine"""
+    monkeypatch.setenv("StateMachineArn", 'arn:aws:states:ap-southeast-2:123456789012:stateMachine:unit-build-sf-sm')
+    monkeypatch.setenv("MinSeverity", 'important')
+    reload(cve_trigger_function)
+
+    ec2_client = boto3.client('ec2', region_name=CONST_REGION)
+    instance_id = ec2_client.run_instances(ImageId='ami-12345678', MaxCount=1, MinCount=1)['Instances'][0]['InstanceId']
+    next_ami_id = ec2_client.create_image(InstanceId=instance_id, Name='soe-image')['ImageId']
+    boto3.client('ssm', region_name=CONST_REGION).put_parameter(Name=CONST_NEXT_AMI_PARAM, Value=next_ami_id, Type='String')
+
+    monkeypatch.setattr('cve_trigger.cve_trigger_function.get_package_inventory', MagicMock(return_value=packages))
+    mock_start_build = MagicMock(return_value='mock_execution_arn')
+    monkeypatch.setattr('cve_trigger.cve_trigger_function.start_build', mock_start_build)
+    return mock_start_build
+
+
+def test_parse_advisories():
+    """Test cve_trigger_function.parse_advisories reads the ALAS RSS feed"""
+
+    with open(FEED_FILE) as feed:
+        advisories = cve_trigger_function.parse_advisories(feed.read())
+
+    assert [advisory['Id'] for advisory in advisories] == [
+        'ALAS2-2099-0004', 'ALAS2-2099-0003', 'ALAS2-2099-0002', 'ALAS2-2099-0001', 'ALAS2-2000-0001'
+    ]
+    assert advisories[0]['Severity'] == 'critical'
+    assert advisories[0]['Packages'] == ['openssl']
+    assert advisories[0]['Published'].year == 2099
+
+
+@pytest.mark.parametrize("packages, triggered_advisories, expected_advisories", [
+    # Only new important/critical advisories for installed packages, old and medium ones are ignored
+    ({'openssl-libs', 'kernel', 'curl'}, [], ['ALAS2-2099-0004', 'ALAS2-2099-0003']),
+    ({'kernel'}, [], ['ALAS2-2099-0003']),
+    ({'bash'}, [], []),
+    # Advisories a build was already triggered for are not triggered again
+    ({'openssl-libs', 'kernel'}, ['ALAS2-2099-0004', 'ALAS2-2099-0003'], []),
+    # Without a package inventory every new advisory applies
+    (set(), [], ['ALAS2-2099-0004', 'ALAS2-2099-0003', 'ALAS2-2099-0001']),
+])
+@mock_ec2
+@mock_ssm
+def test_lambda_handler(packages, triggered_advisories, expected_advisories, monkeypatch):
+    """Test cve_trigger_function.lambda_handler only starts the build for applicable advisories"""
+
+    mock_start_build = setup_soe_image(monkeypatch, packages)
+    if triggered_advisories:
+        boto3.client('ssm', region_name=CONST_REGION).put_parameter(
+            Name=TRIGGER_STATE_PARAM, Value=json.dumps({'Advisories': triggered_advisories}), Type='String'
+        )
+
+    event = {'AdvisoryFeedFile': FEED_FILE}
+    output_event = cve_trigger_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['ApplicableAdvisories'] == expected_advisories
+    assert output_event['BuildTriggered'] is bool(expected_advisories)
+    if expected_advisories:
+        mock_start_build.assert_called_once_with(CONST_REGION, cve_trigger_function.state_machine_arn, expected_advisories)
+        trigger_state = json.loads(cve_trigger_function.get_ssm_param(CONST_REGION, TRIGGER_STATE_PARAM))
+        assert trigger_state['Advisories'] == sorted(expected_advisories)
+    else:
+        mock_start_build.assert_not_called()
+
+
+def test_find_applicable_advisories_with_invalid_severity(monkeypatch):
+    """Test cve_trigger_function.find_applicable_advisories rejects an unknown MinSeverity"""
+
+    monkeypatch.setattr('cve_trigger.cve_trigger_function.min_severity', 'high')
+
+    with pytest.raises(ValueError) as excinfo:
+        cve_trigger_function.find_applicable_advisories([], set(), None, [])
+    assert "MinSeverity 'high' must be one of" in str(excinfo.value)
@@ -0,0 +1,125 @@
+"""
+Test load_catalog_function
+"""
+import copy
+import json
+from importlib import reload
+from test import CONST_REGION, CONST_SOE_TYPE, CONST_SOL_NAMING, ContextMock
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from load_catalog import load_catalog_function
+
+CATALOG_BUCKET = 'unit-test-catalog-bucket'
+
+CATALOG = {
+    'SOETypes': [
+        {'SOEType': 'lnx-amzn', 'AMIPattern': 'CIS Amazon Linux 2 Benchmark *', 'AMIOwner': 'aws-marketplace'},
+        {'SOEType': 'lnx-rhel', 'AMIPattern': 'RHEL-8*', 'AMIOwner': '309956199498',
+         'OverrideAMI': 'ami-12345678', 'NextAMIParam': '/custom/rhel/nextAmi'},
+    ]
+}
+
+YAML_CATALOG = """
+SOETypes:
+  - SOEType: lnx-amzn
+    AMIPattern: CIS Amazon Linux 2 Benchmark *
+    AMIOwner: aws-marketplace
+"""
+
+
+def setup_catalog(monkeypatch, catalog_key, catalog_body):
+    """Upload the catalog to the mock bucket and point the function at it"""
+    s3_client = boto3.client('s3', region_name=CONST_REGION)
+    s3_client.create_bucket(Bucket=CATALOG_BUCKET, CreateBucketConfiguration={'LocationConstraint': CONST_REGION})
+    s3_client.put_object(Bucket=CATALOG_BUCKET, Key=catalog_key, Body=catalog_body.encode('utf-8'))
+    monkeypatch.setenv("CatalogBucket", CATALOG_BUCKET)
+    monkeypatch.setenv("CatalogKey", catalog_key)
+    reload(load_catalog_function)
+
+
+@mock_s3
+def test_lambda_handler(monkeypatch):
+    """Test load_catalog_function.lambda_handler returns every SOE Type with defaults"""
+
+    setup_catalog(monkeypatch, 'catalog/soe-catalog.json', json.dumps(CATALOG))
+
+    event = {}
+    output_event = load_catalog_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['SOETypes'] == [
+        {'SOEType': 'lnx-amzn', 'AMIPattern': 'CIS Amazon Linux 2 Benchmark *', 'AMIOwner': 'aws-marketplace',
+         'OverrideAMI': '', 'NextAMIParam': '/' + CONST_SOL_NAMING + '/lnx-amzn/nextAmi'},
+        {'SOEType': 'lnx-rhel', 'AMIPattern': 'RHEL-8*', 'AMIOwner': '309956199498',
+         'OverrideAMI': 'ami-12345678', 'NextAMIParam': '/custom/rhel/nextAmi'},
+    ]
+
+
+@mock_s3
+def test_lambda_handler_with_yaml_catalog(monkeypatch):
+    """Test load_catalog_function.lambda_handler parses a YAML catalog"""
+
+    setup_catalog(monkeypatch, 'soe-catalog.yaml', YAML_CATALOG)
+
+    output_event = load_catalog_function.lambda_handler({}, ContextMock())
+
+    assert [soe['SOEType'] for soe in output_event['SOETypes']] == ['lnx-amzn']
+    assert output_event['SOETypes'][0]['AMIPattern'] == 'CIS Amazon Linux 2 Benchmark *'
+
+
+def test_lambda_handler_with_architectures():
+    """Test load_catalog_function.lambda_handler builds one SOE Type per architecture"""
+
+    catalog = {'SOETypes': [
+        {'SOEType': 'lnx-amzn', 'AMIPattern': 'CIS Amazon Linux 2 Benchmark *', 'AMIOwner': 'aws-marketplace',
+         'Architectures': ['x86_64', 'arm64']},
+        {'SOEType': 'lnx-rhel', 'AMIPattern': 'RHEL-8*', 'AMIOwner': '309956199498',
+         'NextAMIParam': '/custom/rhel/nextAmi', 'Architectures': 'x86_64, arm64'},
+    ]}
+
+    soe_types = load_catalog_function.parse_catalog('soe-catalog.json', json.dumps(catalog))
+
+    assert [(soe['SOEType'], soe['Architecture'], soe['NextAMIParam']) for soe in soe_types] == [
+        ('lnx-amzn', 'x86_64', '/' + CONST_SOL_NAMING + '/lnx-amzn/nextAmi'),
+        ('lnx-amzn-arm64', 'arm64', '/' + CONST_SOL_NAMING + '/lnx-amzn-arm64/nextAmi'),
+        ('lnx-rhel', 'x86_64', '/custom/rhel/nextAmi'),
+        ('lnx-rhel-arm64', 'arm64', '/custom/rhel-arm64/nextAmi'),
+    ]
+    assert all('Architectures' not in soe for soe in soe_types)
+
+
+def test_lambda_handler_without_catalog(monkeypatch):
+    """Test load_catalog_function.lambda_handler builds the SOE Type of the stack for each architecture"""
+
+    monkeypatch.setenv("CatalogBucket", '')
+    monkeypatch.setenv("AMIPattern", 'amzn2-ami-hvm-*-gp2')
+    monkeypatch.setenv("AMIOwner", 'amazon')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("Architectures", 'x86_64,arm64')
+    reload(load_catalog_function)
+
+    output_event = load_catalog_function.lambda_handler({}, ContextMock())
+
+    assert [(soe['SOEType'], soe['Architecture']) for soe in output_event['SOETypes']] == [
+        (CONST_SOE_TYPE, 'x86_64'),
+        (CONST_SOE_TYPE + '-arm64', 'arm64'),
+    ]
+
+
+@pytest.mark.parametrize("catalog, exception_message", [
+    ({}, "must have a 'SOETypes' list"),
+    ({'SOETypes': 'lnx-amzn'}, "must have a 'SOETypes' list"),
+    ({'SOETypes': [{'SOEType': 'lnx-amzn', 'AMIPattern': 'CIS*'}]}, "'lnx-amzn' is missing AMIOwner"),
+    ({'SOETypes': [CATALOG['SOETypes'][0], CATALOG['SOETypes'][0]]}, "'lnx-amzn' is defined more than once"),
+    ({'SOETypes': [dict(CATALOG['SOETypes'][0], Architectures=['x86_64', 'arm64']), dict(CATALOG['SOETypes'][0], SOEType='lnx-amzn-arm64')]},
+     "'lnx-amzn-arm64' is defined more than once"),
+    ({'SOETypes': [dict(CATALOG['SOETypes'][0], Architectures=['i386'])]}, "invalid Architectures i386"),
+])
+def test_parse_catalog_with_invalid_catalog(catalog, exception_message):
+    """Test load_catalog_function.parse_catalog rejects invalid catalogs"""
+
+    with pytest.raises(ValueError) as excinfo:
+        load_catalog_function.parse_catalog('soe-catalog.json', json.dumps(catalog))
+    assert exception_message in str(excinfo.value)
@@ -0,0 +1,129 @@
+"""
+Test poll_automations_function
+"""
+import json
+from datetime import datetime, timedelta
+from importlib import reload
+from test import CONST_REGION, CONST_SOL_NAMING, ContextMock
+
+import boto3
+import botocore
+from mock import patch
+from moto import mock_ssm
+
+from check_build import check_build_function
+from poll_automations import poll_automations_function
+from soe_common import automation
+
+STATUS_PARAM = '/' + CONST_SOL_NAMING + '/automationStatus'
+ORIGINAL_MAKE_API_CALL = botocore.client.BaseClient._make_api_call
+
+
+def get_record_time(seconds_ago):
+    """Get the shared status time of the given number of seconds ago"""
+
+    return (datetime.utcnow() - timedelta(seconds=seconds_ago)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def mock_describe_automation_executions(pages):
+    """Mock the paginated sweeps as moto does NOT support describe_automation_executions"""
+
+    requests = []
+
+    def mock_make_api_call(self, operation, args):
+        if operation != 'DescribeAutomationExecutions':
+            return ORIGINAL_MAKE_API_CALL(self, operation, args)
+        requests.append(args)
+        execution_status = [sweep_filter['Values'][0] for sweep_filter in args['Filters'] if sweep_filter['Key'] == 'ExecutionStatus'][0]
+        status_pages = pages.get(execution_status, [[]])
+        page_index = int(args.get('NextToken', 0))
+        page = {'AutomationExecutionMetadataList': status_pages[page_index]}
+        if page_index + 1 < len(status_pages):
+            page['NextToken'] = str(page_index + 1)
+        return page
+
+    return mock_make_api_call, requests
+
+
+@mock_ssm
+def test_lambda_handler(monkeypatch):
+    """Test poll_automations_function.lambda_handler publishes every running execution of the SOE documents in one sweep per status"""
+
+    monkeypatch.setenv("DocumentNamePrefix", 'ami-baking-unit-stack')
+    reload(poll_automations_function)
+    pages = {
+        'InProgress': [
+            [{'AutomationExecutionId': 'exec-build-1', 'AutomationExecutionStatus': 'InProgress', 'ExecutionStartTime': datetime(2021, 7, 1, 10, 0),
+              'DocumentName': 'ami-baking-unit-stack-BuildDoc', 'CurrentStepName': 'updateOS'}],
+            [{'AutomationExecutionId': 'exec-test-1', 'AutomationExecutionStatus': 'InProgress', 'ExecutionStartTime': datetime(2021, 7, 1, 10, 5),
+              'DocumentName': 'ami-baking-unit-stack-TestDoc', 'CurrentStepName': 'runVulnerabilityScan'}],
+        ],
+        'Waiting': [
+            [{'AutomationExecutionId': 'exec-build-2', 'AutomationExecutionStatus': 'Waiting', 'ExecutionStartTime': datetime(2021, 7, 1, 10, 10),
+              'DocumentName': 'ami-baking-unit-stack-BuildDoc', 'CurrentStepName': 'createImage'}],
+        ],
+    }
+    client = boto3.client('ssm', region_name=CONST_REGION)
+    client.put_parameter(
+        Name=STATUS_PARAM,
+        Value=json.dumps({
+            'UpdatedAt': '2021-07-01T10:20:00Z',
+            'Executions': {
+                'exec-build-1': ['InProgress', 'ami-baking-unit-stack-BuildDoc', 'updateOS', '2021-07-01T10:00:00Z', '2021-07-01T10:01:00Z'],
+                'exec-test-1': ['InProgress', 'ami-baking-unit-stack-TestDoc', 'startInstances', '2021-07-01T10:05:00Z', '2021-07-01T10:05:00Z'],
+            }
+        }),
+        Type='String'
+    )
+    mock_make_api_call, requests = mock_describe_automation_executions(pages)
+
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+        output = poll_automations_function.lambda_handler({}, ContextMock())
+
+    assert output == {'StatusParam': STATUS_PARAM, 'Executions': 3}
+    # Pending, 2 InProgress pages and Waiting
+    assert len(requests) == 4
+    assert {request['Filters'][2]['Values'][0] for request in requests} == {'Pending', 'InProgress', 'Waiting'}
+    record = json.loads(client.get_parameter(Name=STATUS_PARAM)['Parameter']['Value'])
+    assert record['Executions']['exec-build-1'] == ['InProgress', 'ami-baking-unit-stack-BuildDoc', 'updateOS', '2021-07-01T10:00:00Z', '2021-07-01T10:01:00Z']
+    assert record['Executions']['exec-test-1'][:4] == ['InProgress', 'ami-baking-unit-stack-TestDoc', 'runVulnerabilityScan', '2021-07-01T10:05:00Z']
+    assert record['Executions']['exec-test-1'][4] > '2021-07-01T10:20:00Z'
+    assert record['Executions']['exec-build-2'] == ['Waiting', 'ami-baking-unit-stack-BuildDoc', 'createImage', '2021-07-01T10:10:00Z', '2021-07-01T10:20:00Z']
+
+
+@mock_ssm
+def test_check_build_with_shared_status(monkeypatch):
+    """Test check_build_function.lambda_handler reads a running build from the shared status without polling it"""
+
+    monkeypatch.setenv("SharedStatus", 'true')
+    reload(check_build_function)
+    automation.CLIENTS.clear()
+    client = boto3.client('ssm', region_name=CONST_REGION)
+    client.put_parameter(
+        Name=STATUS_PARAM,
+        Value=json.dumps({
+            'UpdatedAt': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'Executions': {'exec-build-1': ['InProgress', 'BuildDoc', 'updateOS', get_record_time(500), get_record_time(350)]}
+        }),
+        Type='String'
+    )
+
+    # moto does NOT support get_automation_execution, only the shared status can answer
+    event = {
+        'BuildAutomationExecutionId': 'exec-build-1',
+        'StepDurations': {'BuildDoc': {'Runs': 1, 'Steps': {'startInstances': 60, 'updateOS': 400, 'createImage': 300}}}
+    }
+    try:
+        output_event = check_build_function.lambda_handler(event, ContextMock())
+    finally:
+        monkeypatch.undo()
+        reload(check_build_function)
+        automation.CLIENTS.clear()
+
+    assert output_event['BuildStatus'] == 'running'
+    # 50 seconds left of updateOS and 300 of createImage
+    assert output_event['NextPollSeconds'] in [349, 350]
+    assert output_event['BuildProgress']['ElapsedSeconds'] in [500, 501]
+    assert output_event['BuildProgress']['StepElapsedSeconds'] in [350, 351]
+    assert output_event['BuildProgress']['Overrun'] is False
+    assert 'InstanceID' not in output_event
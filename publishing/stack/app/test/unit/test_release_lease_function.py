@@ -0,0 +1,74 @@
+"""
+Test release_lease_function
+"""
+import copy
+from importlib import reload
+from test import CONST_REGION, CONST_SOE_TYPE, CONST_SOL_NAMING, ContextMock
+
+import botocore
+import pytest
+from mock import MagicMock, patch
+from moto import mock_ssm
+
+from release_lease import release_lease_function
+from trigger_build import trigger_build_function
+
+EXECUTION_ID = 'arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:first'
+OTHER_EXECUTION_ID = 'arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:second'
+LEASE_PARAM = '/' + CONST_SOL_NAMING + '/' + CONST_SOE_TYPE + '/buildLease'
+
+
+@pytest.mark.parametrize("lease_store", ['ssm', 'local'])
+@mock_ssm
+def test_lambda_handler(lease_store, monkeypatch, tmp_path):
+    """Test release_lease_function.lambda_handler releases the lease and starts the coalesced follow-up"""
+
+    monkeypatch.setenv("LeaseStore", lease_store)
+    monkeypatch.setenv("LeaseDir", str(tmp_path))
+    reload(trigger_build_function)
+    reload(release_lease_function)
+    mock_start_follow_up = MagicMock(return_value='mock_follow_up_arn')
+    monkeypatch.setattr('release_lease.release_lease_function.start_follow_up', mock_start_follow_up)
+
+    # The first execution takes the lease and the second one is coalesced
+    assert trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, EXECUTION_ID, {})['Owner'] == EXECUTION_ID
+    assert trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, OTHER_EXECUTION_ID, {'OverrideAMI': 'ami-12345678'})['Owner'] == EXECUTION_ID
+
+    # Only the owner can release the lease
+    output_event = release_lease_function.lambda_handler({'Execution': {'Id': OTHER_EXECUTION_ID}}, ContextMock())
+    assert output_event['LeaseReleased'] is False
+
+    event = {'Execution': {'Id': EXECUTION_ID}}
+    output_event = release_lease_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['LeaseReleased'] is True
+    assert output_event['FollowUpExecutionArn'] == 'mock_follow_up_arn'
+    mock_start_follow_up.assert_called_once_with(CONST_REGION, EXECUTION_ID, {'OverrideAMI': 'ami-12345678'})
+    assert release_lease_function.get_lease(LEASE_PARAM) == {}
+    assert release_lease_function.get_lease(LEASE_PARAM + 'FollowUp') == {}
+
+
+
+@patch('botocore.client.BaseClient._make_api_call')
+def test_start_follow_up(mock_boto_client):
+    """Test release_lease_function.start_follow_up starts one follow-up per releasing execution"""
+
+    follow_up_arns = []
+
+    def mock_sfn_client(operation, args):
+        assert operation == 'StartExecution'
+        follow_up_arn = args['stateMachineArn'].replace(':stateMachine:', ':execution:') + ':' + args['name']
+        if follow_up_arn in follow_up_arns:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'ExecutionAlreadyExists'}}, operation)
+        follow_up_arns.append(follow_up_arn)
+        return {'executionArn': follow_up_arn}
+
+    mock_boto_client.side_effect = mock_sfn_client
+
+    follow_up_arn = release_lease_function.start_follow_up(CONST_REGION, EXECUTION_ID, {})
+    assert follow_up_arn.startswith('arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:follow-up-')
+
+    # A retried release gets back the same follow-up, another releasing execution starts its own
+    assert release_lease_function.start_follow_up(CONST_REGION, EXECUTION_ID, {}) == follow_up_arn
+    assert release_lease_function.start_follow_up(CONST_REGION, OTHER_EXECUTION_ID, {}) != follow_up_arn
+    assert len(follow_up_arns) == 2
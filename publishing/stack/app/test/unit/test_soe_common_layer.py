@@ -0,0 +1,117 @@
+"""
+Test soe_common layer
+"""
+import copy
+from test import CONST_REGION
+
+import boto3
+import pytest
+from mock import MagicMock
+from moto import mock_s3
+
+from soe_common import automation, findings
+from soe_common.automation import ExecutionSnapshot, get_client_token, get_execution_snapshot
+from soe_common.findings import FindingRules, split_exceptions
+
+MOCK_EXECUTION_ID = 'arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:mock-execution'
+
+
+def test_execution_snapshot():
+    """Test automation.ExecutionSnapshot exposes the values every check reads from one automation execution"""
+
+    test_execution = ExecutionSnapshot({
+        'AutomationExecutionId': 'mock_automation_execution_id',
+        'AutomationExecutionStatus': 'Success',
+        'Parameters': {'sourceAMIid': ['ami-12345678']},
+        'Outputs': {
+            'startInstances.InstanceIds': ['i-12345678'],
+            'runVulnerabilityScan.Output': ['  "arn:aws:inspector:ap-southeast-2:123456789012:target/0-ab/template/0-cd/run/0-ef"\n'],
+        },
+    })
+
+    assert test_execution.status == 'Success'
+    assert test_execution.instance_id == 'i-12345678'
+    assert test_execution.source_ami == 'ami-12345678'
+    assert test_execution.inspector_run_arn == 'arn:aws:inspector:ap-southeast-2:123456789012:target/0-ab/template/0-cd/run/0-ef'
+    assert test_execution.step_executions == []
+
+
+def test_get_client_token():
+    """Test automation.get_client_token is stable for a state machine execution"""
+
+    event = {'Execution': {'Id': MOCK_EXECUTION_ID}}
+    client_token = get_client_token(event, 'build', CONST_REGION)
+
+    assert len(client_token) == 36
+    assert client_token == get_client_token(copy.deepcopy(event), 'build', CONST_REGION)
+    assert client_token != get_client_token(event, 'build', 'us-east-1')
+    assert client_token != get_client_token(event, 'test-spot', CONST_REGION)
+    assert get_client_token({}, 'build', CONST_REGION) is None
+
+
+def test_get_execution_snapshot(monkeypatch):
+    """Test automation.get_execution_snapshot fetches an automation execution once per invocation"""
+
+    mock_client = MagicMock()
+    mock_client.get_automation_execution.return_value = {
+        'AutomationExecution': {'AutomationExecutionId': 'mock_automation_execution_id', 'AutomationExecutionStatus': 'InProgress'}
+    }
+    monkeypatch.setattr(automation, 'get_client', MagicMock(return_value=mock_client))
+    monkeypatch.setattr(automation, 'SNAPSHOTS', {})
+
+    assert get_execution_snapshot(CONST_REGION, 'mock_automation_execution_id').status == 'InProgress'
+    assert get_execution_snapshot(CONST_REGION, 'mock_automation_execution_id').status == 'InProgress'
+    mock_client.get_automation_execution.assert_called_once_with(AutomationExecutionId='mock_automation_execution_id')
+
+    # The next invocation clears the executions of the previous one
+    automation.SNAPSHOTS.clear()
+    get_execution_snapshot(CONST_REGION, 'mock_automation_execution_id')
+    assert mock_client.get_automation_execution.call_count == 2
+
+
+@pytest.mark.parametrize("finding, expected_reason", [
+    ({'id': 'CVE-2019-0001', 'severity': 'High', 'attributes': []}, 'ExceptionList'),
+    ({'id': 'CVE-2019-00011', 'severity': 'High', 'attributes': []}, None), # No substring match
+    ({'id': 'CVE-2020-1234', 'severity': 'High', 'attributes': []}, 'ExceptionList'), # Wildcard
+    ({'id': 'CVE-2021-1234', 'severity': 'High', 'attributes': []}, None), # Expired exception
+    ({'id': 'CVE-2021-2345', 'severity': 'High', 'attributes': []}, None), # Expired exception without zero padding
+    ({'id': 'CVE-2021-3456', 'severity': 'High', 'attributes': []}, None), # Invalid expiry
+    ({'id': 'CVE-2021-4567', 'severity': 'High', 'attributes': []}, 'ExceptionList'), # Expires today
+    ({'id': 'CIS-1.1', 'severity': 'High', 'attributes': [], 'serviceAttributes': {'rulesPackageArn': 'arn:aws:inspector:ap-southeast-2:454640832652:rulespackage/0-ab'}}, 'ExceptionList'),
+    ({'id': 'CIS-1.2', 'severity': 'High', 'attributes': [{'key': 'CIS_BENCHMARK_PROFILE', 'value': 'Level 2 - Server'}]}, 'CIS_Level_2'),
+    ({'id': 'CIS-1.3', 'severity': 'Medium', 'attributes': [{'key': 'CIS_BENCHMARK_PROFILE', 'value': 'Level 1 - Server'}]}, 'Medium'),
+    ({'id': 'CIS-1.4', 'severity': 'High', 'attributes': [{'key': 'CIS_BENCHMARK_PROFILE', 'value': 'Level 1 - Server'}]}, None),
+])
+def test_finding_rules(finding, expected_reason):
+    """Test findings.FindingRules matches exact, wildcard, rules package and expiring exceptions"""
+
+    finding_rules = FindingRules(split_exceptions("""
+        CVE-2019-0001, CVE-2020-*
+        CVE-2021-1234@2021-06-30 # Accepted until the fix was released
+        CVE-2021-2345@2021-6-5, CVE-2021-3456@2021-31-12, CVE-2021-4567@2021-07-01
+        arn:aws:inspector:ap-southeast-2:454640832652:rulespackage/0-ab/*
+    """), '2021-07-01')
+
+    assert finding_rules.ignore_reason(finding) == expected_reason
+
+
+@mock_s3
+def test_get_finding_rules_from_s3(monkeypatch):
+    """Test findings.get_finding_rules only downloads the S3 exceptions file again once it changes"""
+
+    client = boto3.client('s3', region_name=CONST_REGION)
+    client.create_bucket(Bucket='mock-exceptions-bucket', CreateBucketConfiguration={'LocationConstraint': CONST_REGION})
+    client.put_object(Bucket='mock-exceptions-bucket', Key='exceptions.txt', Body=b'CVE-2019-0001\nCVE-2019-0002')
+    monkeypatch.setattr(findings, 'S3_EXCEPTIONS', {})
+    monkeypatch.setattr(automation, 'CLIENTS', {})
+
+    finding_rules = findings.get_finding_rules('CVE-2019-0003', CONST_REGION, 'mock-exceptions-bucket', 'exceptions.txt')
+    assert finding_rules.exact_ids == {'CVE-2019-0001', 'CVE-2019-0002', 'CVE-2019-0003'}
+    etag = findings.S3_EXCEPTIONS['ETag']
+
+    # Not modified, the cached entries and compiled rules are reused
+    assert findings.get_finding_rules('CVE-2019-0003', CONST_REGION, 'mock-exceptions-bucket', 'exceptions.txt') is finding_rules
+    assert findings.S3_EXCEPTIONS['ETag'] == etag
+
+    client.put_object(Bucket='mock-exceptions-bucket', Key='exceptions.txt', Body=b'CVE-2019-0004')
+    assert findings.get_finding_rules('CVE-2019-0003', CONST_REGION, 'mock-exceptions-bucket', 'exceptions.txt').exact_ids == {'CVE-2019-0004', 'CVE-2019-0003'}
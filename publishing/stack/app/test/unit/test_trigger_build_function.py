@@ -2,16 +2,22 @@
 Test trigger_build_function
 """
 import copy
+import json
+from datetime import datetime, timedelta
 from importlib import reload
-from test import CONST_REGION, CONST_SOL_NAMING, ContextMock
+from test import CONST_REGION, CONST_SOE_TYPE, CONST_SOL_NAMING, ContextMock
 
 import boto3
+import botocore
 import pytest
 from mock import MagicMock, patch
-from moto import mock_ec2, mock_organizations
+from moto import mock_ec2, mock_iam, mock_organizations, mock_ssm
 
 from trigger_build import trigger_build_function
 
+MOCK_FINGERPRINT = 'mock-build-fingerprint'
+MOCK_EXECUTION_ID = 'arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:mock-execution'
+
 
 @pytest.mark.parametrize("ami_pattern, pipeline_override_ami, event_override_ami, expected_error, exception_message", [
     # Standard Test Cases (with No event OverrideAMI)
@@ -33,6 +39,7 @@ from trigger_build import trigger_build_function
 ])
 @mock_ec2
 @mock_organizations
+@mock_ssm
 def test_lambda_handler(ami_pattern, pipeline_override_ami, event_override_ami, expected_error, exception_message, monkeypatch):
     """Test trigger_build_function.lambda_handler"""
 
@@ -56,6 +63,8 @@ def test_lambda_handler(ami_pattern, pipeline_override_ami, event_override_ami,
     # https://github.com/spulec/moto/blame/603f7c58a230919da3ee836575351366e46cc26c/IMPLEMENTATION_COVERAGE.md#L4022
     mock_trigger_ssm = MagicMock(return_value=mock_automation_execution_id)
     monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+    # patch compute_build_fingerprint as the SSM documents are not deployed in moto
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
 
     if pipeline_override_ami:
         ami_id = pipeline_override_ami
@@ -111,7 +120,750 @@ def test_lambda_handler(ami_pattern, pipeline_override_ami, event_override_ami,
         # Verify the output
         assert output_event != event # Assert that the event has been modified
         assert output_event["BuildAutomationExecutionId"] == mock_automation_execution_id
+        assert output_event["BuildStatus"] == 'running'
 
         mock_trigger_ssm.assert_called_with(
-            CONST_SOL_NAMING, CONST_REGION, ssm_document, soe_type, ami_id
+            CONST_SOL_NAMING, CONST_REGION, ssm_document, soe_type,
+            {'sourceAMIid': [ami_id], 'BuildFingerprint': [MOCK_FINGERPRINT], 'SolutionSOEType': [CONST_SOL_NAMING + '-' + soe_type]}, None
+        )
+
+
+def create_public_image(ec2_client, monkeypatch, image_name):
+    """Create a mock public base image (moto does not support ExecutableUsers 'all')"""
+    run_ec2_response = ec2_client.run_instances(ImageId='ami-12345678', MaxCount=1, MinCount=1)
+    instance_id = run_ec2_response['Instances'][0]['InstanceId']
+    ami_id = ec2_client.create_image(InstanceId=instance_id, Name=image_name)['ImageId']
+    exec_user_id = '123456789012'
+    monkeypatch.setattr('trigger_build.trigger_build_function.EXEC_USERS', exec_user_id)
+    ec2_client.modify_image_attribute(
+        Attribute='launchPermission',
+        ImageId=ami_id,
+        OperationType='add',
+        UserIds=[exec_user_id]
+    )
+    return ami_id, instance_id
+
+
+@pytest.mark.parametrize("fingerprint_tag, soe_type_tag, force_build, override_ami, expect_skip", [
+    (MOCK_FINGERPRINT, CONST_SOE_TYPE, None, False, True),
+    (MOCK_FINGERPRINT, CONST_SOE_TYPE, 'True', False, False),
+    (MOCK_FINGERPRINT, CONST_SOE_TYPE, 'False', False, True),
+    (MOCK_FINGERPRINT, CONST_SOE_TYPE, None, True, False), # Override AMI always builds
+    ('other-build-fingerprint', CONST_SOE_TYPE, None, False, False), # Same base AMI but different build documents
+    (MOCK_FINGERPRINT, CONST_SOE_TYPE + '-arm64', None, False, False), # Image of another SOE Type
+])
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_existing_build(fingerprint_tag, soe_type_tag, force_build, override_ami, expect_skip, monkeypatch):
+    """Test trigger_build_function.lambda_handler reuses a SOE image built from identical inputs"""
+
+    monkeypatch.setenv("AMIPattern", 'plt-baking-soe*')
+    monkeypatch.setenv("AMIOwner", 'self')
+    monkeypatch.setenv("OverrideAMI", '')
+    reload(trigger_build_function)
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+
+    # Setup a base image and a SOE image previously built from it
+    ec2_client = boto3.client('ec2', region_name=CONST_REGION)
+    ami_id, instance_id = create_public_image(ec2_client, monkeypatch, 'plt-baking-soe-base')
+    soe_ami_id = ec2_client.create_image(InstanceId=instance_id, Name='soe-image')['ImageId']
+    ec2_client.create_tags(Resources=[soe_ami_id], Tags=[
+        {'Key': 'SoeType', 'Value': CONST_SOL_NAMING + '-' + soe_type_tag},
+        {'Key': 'SourceAMIid', 'Value': ami_id},
+        {'Key': 'BuildFingerprint', 'Value': fingerprint_tag},
+    ])
+
+    event = {}
+    if force_build:
+        event['ForceBuild'] = force_build
+    if override_ami:
+        event['OverrideAMI'] = ami_id
+    output_event = trigger_build_function.lambda_handler(event, ContextMock())
+
+    assert output_event['SourceAMI'] == ami_id
+    assert output_event['BuildFingerprint'] == MOCK_FINGERPRINT
+    if expect_skip:
+        assert output_event['BuildStatus'] == 'skipped'
+        assert output_event['ReusedAMI'] == soe_ami_id
+        assert output_event['AMI'] == soe_ami_id
+        assert 'BuildAutomationExecutionId' not in output_event
+        mock_trigger_ssm.assert_not_called()
+    else:
+        assert output_event['BuildStatus'] == 'running'
+        assert 'ReusedAMI' not in output_event
+        mock_trigger_ssm.assert_called_once()
+
+
+@mock_ssm
+def test_compute_build_fingerprint():
+    """Test trigger_build_function.compute_build_fingerprint changes with any build input"""
+
+    ssm_client = boto3.client('ssm', region_name=CONST_REGION)
+    for document_name, command in [('BuildDoc', 'echo build'), ('UpdateOSDoc', 'yum update -y')]:
+        ssm_client.create_document(
+            Name=document_name,
+            DocumentType='Command',
+            Content=json.dumps({
+                'schemaVersion': '2.2',
+                'description': document_name,
+                'mainSteps': [{'name': 'run', 'action': 'aws:runShellScript', 'inputs': {'runCommand': [command]}}]
+            })
+        )
+
+    parameters = {'sourceAMIid': ['ami-12345678']}
+    fingerprint = trigger_build_function.compute_build_fingerprint(CONST_REGION, 'BuildDoc', ['UpdateOSDoc'], parameters)
+    assert fingerprint == trigger_build_function.compute_build_fingerprint(CONST_REGION, 'BuildDoc', ['UpdateOSDoc'], parameters)
+
+    # A different source AMI changes the fingerprint
+    assert fingerprint != trigger_build_function.compute_build_fingerprint(
+        CONST_REGION, 'BuildDoc', ['UpdateOSDoc'], {'sourceAMIid': ['ami-87654321']})
+
+    # A new version of a command document changes the fingerprint
+    ssm_client.update_document(
+        Name='UpdateOSDoc',
+        DocumentVersion='$LATEST',
+        Content=json.dumps({
+            'schemaVersion': '2.2',
+            'description': 'UpdateOSDoc',
+            'mainSteps': [{'name': 'run', 'action': 'aws:runShellScript', 'inputs': {'runCommand': ['yum update -y --security']}}]
+        })
+    )
+    ssm_client.update_document_default_version(Name='UpdateOSDoc', DocumentVersion='2')
+    assert fingerprint != trigger_build_function.compute_build_fingerprint(CONST_REGION, 'BuildDoc', ['UpdateOSDoc'], parameters)
+
+
+@mock_ec2
+@mock_ssm
+def test_resolve_base_ami_uses_cached_record(monkeypatch):
+    """Test trigger_build_function.resolve_base_ami only scans the marketplace when the record is stale"""
+
+    reload(trigger_build_function)
+    ec2_client = boto3.client('ec2', region_name=CONST_REGION)
+    ami_id, _ = create_public_image(ec2_client, monkeypatch, 'plt-baking-soe-base')
+
+    # First call scans and saves the record
+    base_ami_param = trigger_build_function.get_base_ami_param(CONST_SOE_TYPE)
+    record = trigger_build_function.resolve_base_ami('plt-baking-soe*', CONST_REGION, 'self', base_ami_param)
+    assert record['ImageId'] == ami_id
+    saved_record = trigger_build_function.get_ssm_record(CONST_REGION, base_ami_param)
+    assert saved_record == record
+
+    # Second call within the TTL uses the record
+    mock_get_latest_image = MagicMock()
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_latest_image', mock_get_latest_image)
+    assert trigger_build_function.resolve_base_ami('plt-baking-soe*', CONST_REGION, 'self', base_ami_param) == record
+    mock_get_latest_image.assert_not_called()
+
+    # A different pattern or an expired record forces a new scan
+    assert not trigger_build_function.is_record_fresh(record, 'other-pattern*', 'self')
+    monkeypatch.setattr('trigger_build.trigger_build_function.base_ami_cache_ttl', 0)
+    assert not trigger_build_function.is_record_fresh(record, 'plt-baking-soe*', 'self')
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_build_regions(monkeypatch):
+    """Test trigger_build_function.lambda_handler fans the build out to every region"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("BuildRegions", 'us-east-1:VirginiaSSMDocument, eu-west-1:EuropeSSMDocument:EuropeUpdateOSDoc')
+    reload(trigger_build_function)
+
+    source_amis = {CONST_REGION: 'ami-11111111', 'us-east-1': 'ami-22222222', 'eu-west-1': 'ami-33333333'}
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami',
+                        lambda ami_pattern, build_region, override_ami, ami_owner, base_ami_param, architecture: source_amis[build_region])
+    mock_compute_build_fingerprint = MagicMock(return_value=MOCK_FINGERPRINT)
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', mock_compute_build_fingerprint)
+    mock_trigger_ssm = MagicMock(
+        side_effect=lambda solution_naming, build_region, build_document, soe_type, build_parameters, client_token: 'exec-' + build_region
+    )
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    event = {'Execution': {'Id': MOCK_EXECUTION_ID}}
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildAutomationExecutionIds'] == {
+        CONST_REGION: 'exec-' + CONST_REGION,
+        'us-east-1': 'exec-us-east-1',
+        'eu-west-1': 'exec-eu-west-1',
+    }
+    assert output_event['BuildAutomationExecutionId'] == 'exec-' + CONST_REGION
+    assert output_event['SourceAMI'] == source_amis[CONST_REGION]
+    assert output_event['BuildStatus'] == 'running'
+    assert output_event['RegionalBuilds']['eu-west-1']['SourceAMI'] == 'ami-33333333'
+    assert mock_trigger_ssm.call_count == 3
+    mock_trigger_ssm.assert_any_call(
+        CONST_SOL_NAMING, 'eu-west-1', 'EuropeSSMDocument', trigger_build_function.soe_type,
+        {'sourceAMIid': ['ami-33333333'], 'BuildFingerprint': [MOCK_FINGERPRINT],
+         'SolutionSOEType': [CONST_SOL_NAMING + '-' + trigger_build_function.soe_type]},
+        trigger_build_function.get_client_token(event, 'build', 'eu-west-1')
+    )
+    mock_trigger_ssm.assert_any_call(
+        CONST_SOL_NAMING, 'us-east-1', 'VirginiaSSMDocument', trigger_build_function.soe_type,
+        {'sourceAMIid': ['ami-22222222'], 'BuildFingerprint': [MOCK_FINGERPRINT],
+         'SolutionSOEType': [CONST_SOL_NAMING + '-' + trigger_build_function.soe_type]},
+        trigger_build_function.get_client_token(event, 'build', 'us-east-1')
+    )
+    # Every region launch gets its own idempotency token
+    client_tokens = {kwargs_call[0][5] for kwargs_call in mock_trigger_ssm.call_args_list}
+    assert len(client_tokens) == 3
+    # Each region fingerprints its own documents
+    mock_compute_build_fingerprint.assert_any_call('eu-west-1', 'EuropeSSMDocument', ['EuropeUpdateOSDoc'], {'sourceAMIid': ['ami-33333333']})
+    mock_compute_build_fingerprint.assert_any_call('us-east-1', 'VirginiaSSMDocument', [], {'sourceAMIid': ['ami-22222222']})
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_failed_region(monkeypatch):
+    """Test trigger_build_function.lambda_handler keeps the builds started in the other regions when one region fails"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("BuildRegions", 'us-east-1:VirginiaSSMDocument,eu-west-1:EuropeSSMDocument')
+    reload(trigger_build_function)
+
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+
+    def mock_trigger_ssm(solution_naming, build_region, build_document, soe_type, build_parameters, client_token):
+        if build_region == 'eu-west-1':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidDocument', 'Message': 'Document not found'}}, 'StartAutomationExecution')
+        return 'exec-' + build_region
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    output_event = trigger_build_function.lambda_handler({}, ContextMock())
+
+    assert output_event['BuildStatus'] == 'failed'
+    assert output_event['CheckType'] == 'region'
+    assert list(output_event['RegionErrors']) == ['eu-west-1']
+    assert output_event['BuildAutomationExecutionIds'] == {CONST_REGION: 'exec-' + CONST_REGION, 'us-east-1': 'exec-us-east-1'}
+    assert output_event['BuildAutomationExecutionId'] == 'exec-' + CONST_REGION
+
+
+def test_get_build_regions_without_document():
+    """Test trigger_build_function.get_build_regions requires the build document of every other region"""
+
+    with pytest.raises(ValueError) as excinfo:
+        trigger_build_function.get_build_regions('us-east-1', 'SSMDocument')
+    assert "BuildRegions entry 'us-east-1' must be 'region:build document'" in str(excinfo.value)
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_catalog_soe(monkeypatch):
+    """Test trigger_build_function.lambda_handler builds the SOE Type from the catalog entry in the event"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("AMIPattern", 'env-pattern*')
+    monkeypatch.setenv("OverrideAMI", '')
+    reload(trigger_build_function)
+
+    mock_get_ami = MagicMock(return_value='ami-12345678')
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', mock_get_ami)
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    event = {'SOE': {
+        'SOEType': 'lnx-rhel',
+        'AMIPattern': 'RHEL-8*',
+        'AMIOwner': '309956199498',
+        'SSMDocument': 'RhelSSMDocument',
+    }}
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildAutomationExecutionId'] == 'mock_automation_execution_id'
+    assert output_event['SOE'] == event['SOE']
+    mock_get_ami.assert_called_with('RHEL-8*', CONST_REGION, '', '309956199498', '/' + CONST_SOL_NAMING + '/lnx-rhel/baseAmi', '')
+    mock_trigger_ssm.assert_called_with(
+        CONST_SOL_NAMING, CONST_REGION, 'RhelSSMDocument', 'lnx-rhel',
+        {'sourceAMIid': ['ami-12345678'], 'BuildFingerprint': [MOCK_FINGERPRINT], 'SolutionSOEType': [CONST_SOL_NAMING + '-lnx-rhel']}, None
+    )
+
+
+@pytest.mark.parametrize("benchmarks, stage, expected_instance_type", [
+    # Untried instance types are benchmarked first, in the configured order
+    ({}, 'build', 'm5.large'),
+    ({'build': {'m5.large': {'Runs': 1, 'Seconds': 900}}}, 'build', 'c5.large'),
+    # Cheapest per run wins once every type has a wall time
+    ({'build': {'m5.large': {'Runs': 3, 'Seconds': 900}, 'c5.large': {'Runs': 2, 'Seconds': 700}}}, 'build', 'c5.large'),
+    ({'build': {'m5.large': {'Runs': 3, 'Seconds': 600}, 'c5.large': {'Runs': 2, 'Seconds': 700}}}, 'build', 'm5.large'),
+    # Each stage is benchmarked separately
+    ({'build': {'m5.large': {'Runs': 3, 'Seconds': 600}, 'c5.large': {'Runs': 2, 'Seconds': 700}}}, 'test', 'm5.large'),
+])
+def test_select_instance_type(benchmarks, stage, expected_instance_type):
+    """Test trigger_build_function.select_instance_type picks the cheapest run per instance type"""
+
+    instance_types = trigger_build_function.get_instance_types('m5.large:0.096, c5.large:0.085')
+
+    assert trigger_build_function.select_instance_type(benchmarks, instance_types, stage) == expected_instance_type
+
+
+def test_get_instance_types_with_invalid_setting():
+    """Test trigger_build_function.get_instance_types rejects entries without a price"""
+
+    with pytest.raises(ValueError) as excinfo:
+        trigger_build_function.get_instance_types('m5.large')
+    assert "must be 'type:hourly price'" in str(excinfo.value)
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_instance_types(monkeypatch):
+    """Test trigger_build_function.lambda_handler builds on the selected instance type"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("InstanceTypes", 'm5.large:0.096,c5.large:0.085')
+    reload(trigger_build_function)
+
+    ssm_client = boto3.client('ssm', region_name=CONST_REGION)
+    ssm_client.put_parameter(
+        Name=trigger_build_function.get_benchmarks_param(CONST_SOE_TYPE),
+        Value=json.dumps({
+            'build': {'m5.large': {'Runs': 3, 'Seconds': 900}, 'c5.large': {'Runs': 2, 'Seconds': 700}},
+            'test': {'m5.large': {'Runs': 3, 'Seconds': 600}},
+        }),
+        Type='String'
+    )
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    output_event = trigger_build_function.lambda_handler({}, ContextMock())
+
+    assert output_event['BuildInstanceType'] == 'c5.large'
+    assert output_event['TestInstanceType'] == 'c5.large'
+    mock_trigger_ssm.assert_called_with(
+        CONST_SOL_NAMING, CONST_REGION, 'SSMDocument', CONST_SOE_TYPE,
+        {'sourceAMIid': ['ami-12345678'], 'BuildFingerprint': [MOCK_FINGERPRINT], 'InstanceType': ['c5.large'],
+         'SolutionSOEType': [CONST_SOL_NAMING + '-' + CONST_SOE_TYPE]}, None
+    )
+
+
+@pytest.mark.parametrize("base_ami_tag, full_build_age_days, force_build, expected_build_mode", [
+    ('base', 1, None, 'incremental'),
+    # Full build cadence reached
+    ('base', 8, None, 'full'),
+    # Base AMI changed since the last full build
+    ('ami-87654321', 1, None, 'full'),
+    # SOE image built before incremental mode
+    (None, None, None, 'full'),
+    ('base', 1, 'True', 'full'),
+])
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_incremental_build(base_ami_tag, full_build_age_days, force_build, expected_build_mode, monkeypatch):
+    """Test trigger_build_function.lambda_handler patches the next AMI until a full rebuild is due"""
+
+    next_ami_param = '/' + CONST_SOL_NAMING + '/' + CONST_SOE_TYPE + '/nextAmi'
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("IncrementalSSMDocument", 'IncrementalSSMDocument')
+    monkeypatch.setenv("NextAMIParam", next_ami_param)
+    monkeypatch.setenv("FullBuildDays", '7')
+    reload(trigger_build_function)
+
+    # Setup the base image and the next SOE image built from it
+    ec2_client = boto3.client('ec2', region_name=CONST_REGION)
+    ami_id, instance_id = create_public_image(ec2_client, monkeypatch, 'plt-baking-soe-base')
+    next_ami_id = ec2_client.create_image(InstanceId=instance_id, Name='soe-image')['ImageId']
+    full_build_date = None
+    if base_ami_tag:
+        full_build_date = (datetime.utcnow() - timedelta(days=full_build_age_days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        ec2_client.create_tags(Resources=[next_ami_id], Tags=[
+            {'Key': 'BaseAMIid', 'Value': ami_id if base_ami_tag == 'base' else base_ami_tag},
+            {'Key': 'FullBuildDate', 'Value': full_build_date},
+        ])
+    boto3.client('ssm', region_name=CONST_REGION).put_parameter(Name=next_ami_param, Value=next_ami_id, Type='String')
+
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value=ami_id))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    event = {'ForceBuild': force_build} if force_build else {}
+    output_event = trigger_build_function.lambda_handler(event, ContextMock())
+
+    assert output_event['BuildMode'] == expected_build_mode
+    assert output_event['BuildStatus'] == 'running'
+    build_document, build_parameters = mock_trigger_ssm.call_args[0][2], mock_trigger_ssm.call_args[0][4]
+    if expected_build_mode == 'incremental':
+        assert build_document == 'IncrementalSSMDocument'
+        assert build_parameters == {'sourceAMIid': [next_ami_id], 'BaseAMIid': [ami_id], 'FullBuildDate': [full_build_date],
+                                    'SolutionSOEType': [CONST_SOL_NAMING + '-' + CONST_SOE_TYPE]}
+    else:
+        assert build_document == 'SSMDocument'
+        assert build_parameters['sourceAMIid'] == [ami_id]
+        assert build_parameters['FullBuildDate'][0] != full_build_date
+
+
+@mock_ssm
+def test_lambda_handler_with_build_in_progress(monkeypatch):
+    """Test trigger_build_function.lambda_handler coalesces a trigger while another build holds the lease"""
+
+    monkeypatch.setenv("LeaseStore", 'ssm')
+    reload(trigger_build_function)
+    mock_get_ami = MagicMock(return_value='ami-12345678')
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', mock_get_ami)
+
+    lease_param = trigger_build_function.get_lease_param(CONST_SOE_TYPE)
+    trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, 'in-flight-execution', {})
+
+    event = {'Execution': {'Id': MOCK_EXECUTION_ID}, 'OverrideAMI': 'ami-87654321'}
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildStatus'] == 'coalesced'
+    assert output_event['LeaseOwner'] == 'in-flight-execution'
+    mock_get_ami.assert_not_called()
+    assert trigger_build_function.get_lease(lease_param + 'FollowUp') == {
+        'Input': {'OverrideAMI': 'ami-87654321'}, 'CoalescedFrom': MOCK_EXECUTION_ID
+    }
+
+
+@mock_ssm
+def test_acquire_build_lease_with_expired_lease(monkeypatch):
+    """Test trigger_build_function.acquire_build_lease takes over an expired lease"""
+
+    monkeypatch.setenv("LeaseStore", 'ssm')
+    reload(trigger_build_function)
+    lease_param = trigger_build_function.get_lease_param(CONST_SOE_TYPE)
+    boto3.client('ssm', region_name=CONST_REGION).put_parameter(
+        Name=lease_param, Value=json.dumps({'Owner': 'expired-execution', 'ExpiresAt': '2000-01-01T00:00:00Z'}), Type='String'
+    )
+
+    lease = trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, MOCK_EXECUTION_ID, {})
+
+    assert lease['Owner'] == MOCK_EXECUTION_ID
+    assert trigger_build_function.get_lease(lease_param)['Owner'] == MOCK_EXECUTION_ID
+    # A replayed step keeps the lease
+    assert trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, MOCK_EXECUTION_ID, {})['Owner'] == MOCK_EXECUTION_ID
+
+    # A contender that read the same expired lease does not replace the new one
+    expired_lease = {'Owner': 'expired-execution', 'ExpiresAt': '2000-01-01T00:00:00Z'}
+    assert not trigger_build_function.take_over_lease(lease_param, expired_lease, {'Owner': 'late-execution', 'ExpiresAt': '2000-01-01T00:00:00Z'})
+    assert trigger_build_function.get_lease(lease_param)['Owner'] == MOCK_EXECUTION_ID
+
+
+@mock_ssm
+def test_take_over_lease_with_concurrent_takeover(monkeypatch):
+    """Test trigger_build_function.take_over_lease lets only one contender take over an expired lease"""
+
+    monkeypatch.setenv("LeaseStore", 'ssm')
+    reload(trigger_build_function)
+    lease_param = trigger_build_function.get_lease_param(CONST_SOE_TYPE)
+    expired_lease = {'Owner': 'expired-execution', 'ExpiresAt': '2000-01-01T00:00:00Z'}
+    trigger_build_function.put_lease(lease_param, expired_lease)
+
+    # Another contender holds the takeover claim of this lease record
+    mock_create_lease = MagicMock(return_value=False)
+    monkeypatch.setattr('trigger_build.trigger_build_function.create_lease', mock_create_lease)
+    lease = trigger_build_function.acquire_build_lease(CONST_SOE_TYPE, MOCK_EXECUTION_ID, {})
+
+    assert lease == expired_lease
+    assert trigger_build_function.get_lease(lease_param) == expired_lease
+    claim_param = mock_create_lease.call_args_list[1][0][0]
+    assert claim_param.startswith(lease_param + 'Takeover/')
+
+
+@pytest.mark.parametrize("builds_in_flight, queued_since, build_variants, expected_build_status", [
+    (1, None, False, 'running'),
+    (2, None, False, 'queued'),
+    (3, '2000-01-01T00:00:00Z', False, 'queued'),
+    (2, None, True, 'queued'), # Base and variant builds take build slots too
+])
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_max_concurrent_builds(builds_in_flight, queued_since, build_variants, expected_build_status, monkeypatch):
+    """Test trigger_build_function.lambda_handler queues the build while the fleet runs the maximum builds"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("MaxConcurrentBuilds", '2')
+    if build_variants:
+        monkeypatch.setenv("BuildVariants", 'standard:codedeploy+corretto')
+        monkeypatch.setenv("BaseSSMDocument", 'BaseSSMDocument')
+        monkeypatch.setenv("VariantSSMDocument", 'VariantSSMDocument')
+    reload(trigger_build_function)
+    mock_count_builds_in_flight = MagicMock(return_value=builds_in_flight)
+    monkeypatch.setattr('trigger_build.trigger_build_function.count_builds_in_flight', mock_count_builds_in_flight)
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', MagicMock(return_value='mock_automation_execution_id'))
+
+    event = {'QueuedSince': queued_since} if queued_since else {}
+    output_event = trigger_build_function.lambda_handler(event, ContextMock())
+
+    assert output_event['BuildStatus'] == expected_build_status
+    assert output_event['BuildsInFlight'] == builds_in_flight
+    variant_documents = ['BaseSSMDocument', 'VariantSSMDocument'] if build_variants else ['', '']
+    mock_count_builds_in_flight.assert_called_once_with(CONST_REGION, ['SSMDocument', ''] + variant_documents)
+    if expected_build_status == 'queued':
+        assert output_event['BuildQueueDepth'] == builds_in_flight - 1
+        assert 'BuildAutomationExecutionId' not in output_event
+        if queued_since:
+            assert output_event['QueuedSince'] == queued_since
+            assert output_event['GovernorWaitSeconds'] > 0
+    else:
+        assert output_event['BuildAutomationExecutionId'] == 'mock_automation_execution_id'
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_retried_build_at_max_concurrent_builds(monkeypatch):
+    """Test trigger_build_function.lambda_handler does not queue a retried trigger behind its own running build"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("MaxConcurrentBuilds", '2')
+    monkeypatch.setenv("LeaseStore", 'ssm')
+    reload(trigger_build_function)
+    mock_count_builds_in_flight = MagicMock(return_value=1)
+    monkeypatch.setattr('trigger_build.trigger_build_function.count_builds_in_flight', mock_count_builds_in_flight)
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    event = {'Execution': {'Id': MOCK_EXECUTION_ID}}
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+    assert output_event['BuildStatus'] == 'running'
+    lease_param = trigger_build_function.get_lease_param(CONST_SOE_TYPE)
+    assert 'BuildSlotSince' in trigger_build_function.get_lease(lease_param)
+
+    # The retry finds its own build in flight, at the cap
+    mock_count_builds_in_flight.return_value = 2
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildStatus'] == 'running'
+    mock_count_builds_in_flight.assert_called_once()
+    assert mock_trigger_ssm.call_args_list[0][0][5] == mock_trigger_ssm.call_args_list[1][0][5]
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_architecture(monkeypatch):
+    """Test trigger_build_function.lambda_handler resolves the base AMI and instance types of the architecture"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    reload(trigger_build_function)
+
+    mock_get_ami = MagicMock(return_value='ami-12345678')
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', mock_get_ami)
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    event = {'SOE': {'SOEType': 'lnx-arm64', 'Architecture': 'arm64'}}
+    output_event = trigger_build_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['BuildInstanceType'] == 'm6g.large'
+    assert output_event['TestInstanceType'] == 'm6g.large'
+    mock_get_ami.assert_called_with(
+        trigger_build_function.ami_pattern, CONST_REGION, '', trigger_build_function.ami_owner,
+        '/' + CONST_SOL_NAMING + '/lnx-arm64/baseAmi', 'arm64'
+    )
+    mock_trigger_ssm.assert_called_with(
+        CONST_SOL_NAMING, CONST_REGION, 'SSMDocument', 'lnx-arm64',
+        {'sourceAMIid': ['ami-12345678'], 'BuildFingerprint': [MOCK_FINGERPRINT], 'InstanceType': ['m6g.large'],
+         'SolutionSOEType': [CONST_SOL_NAMING + '-lnx-arm64']}, None
+    )
+
+    with pytest.raises(ValueError) as excinfo:
+        trigger_build_function.lambda_handler({'SOE': {'Architecture': 'sparc'}}, ContextMock())
+    assert "Invalid Architecture 'sparc'" in str(excinfo.value)
+
+
+def test_get_latest_image_with_architecture(monkeypatch):
+    """Test trigger_build_function.get_latest_image only scans the images of the architecture"""
+
+    reload(trigger_build_function)
+    mock_client = MagicMock()
+    mock_client.get_paginator.return_value.paginate.return_value = [{'Images': [
+        {'ImageId': 'ami-11111111', 'CreationDate': '2021-01-01T00:00:00.000Z'},
+        {'ImageId': 'ami-22222222', 'CreationDate': '2021-02-01T00:00:00.000Z'},
+    ]}]
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_client', MagicMock(return_value=mock_client))
+
+    latest_image = trigger_build_function.get_latest_image(CONST_REGION, 'plt-baking-soe*', 'self', 'arm64')
+
+    assert latest_image['ImageId'] == 'ami-22222222'
+    filters = mock_client.get_paginator.return_value.paginate.call_args[1]['Filters']
+    assert {'Name': 'architecture', 'Values': ['arm64']} in filters
+
+    # A cached record of another architecture is not reused
+    record = {'Pattern': 'plt-baking-soe*', 'Owner': 'self', 'Architecture': 'x86_64',
+              'ResolvedAt': datetime.utcnow().strftime(trigger_build_function.RECORD_DATE_FORMAT)}
+    assert trigger_build_function.is_record_fresh(record, 'plt-baking-soe*', 'self', 'x86_64')
+    assert not trigger_build_function.is_record_fresh(record, 'plt-baking-soe*', 'self', 'arm64')
+
+
+@mock_ec2
+@mock_iam
+@mock_ssm
+def test_run_preflight_checks(monkeypatch):
+    """Test trigger_build_function.run_preflight_checks reports every failed check and caches the passed ones"""
+
+    monkeypatch.setenv("BuildCommandDocuments", 'UpdateOSDoc,DeletedDoc')
+    monkeypatch.setenv("InstanceProfile", 'unit-test-ssm-instance-profile')
+    reload(trigger_build_function)
+
+    ssm_client = boto3.client('ssm', region_name=CONST_REGION)
+    for document_name in ['BuildDoc', 'UpdateOSDoc']:
+        ssm_client.create_document(
+            Name=document_name,
+            DocumentType='Command',
+            Content=json.dumps({
+                'schemaVersion': '2.2',
+                'description': document_name,
+                'mainSteps': [{'name': 'run', 'action': 'aws:runShellScript', 'inputs': {'runCommand': ['echo']}}]
+            })
         )
+
+    iam_client = boto3.client('iam', region_name=CONST_REGION)
+    iam_client.create_role(RoleName='unit-test-ssm-instance-role', AssumeRolePolicyDocument='{}')
+    iam_client.create_instance_profile(InstanceProfileName='unit-test-ssm-instance-profile')
+    iam_client.add_role_to_instance_profile(InstanceProfileName='unit-test-ssm-instance-profile', RoleName='unit-test-ssm-instance-role')
+
+    preflight_errors = trigger_build_function.run_preflight_checks(CONST_SOE_TYPE, CONST_REGION, 'BuildDoc', trigger_build_function.build_command_documents,
+                                                                   'ami-12345678', 'm5.large')
+
+    assert preflight_errors == ["SSM document 'DeletedDoc' does not exist in '%s'" % CONST_REGION]
+    passed_checks = trigger_build_function.get_ssm_record(CONST_REGION, trigger_build_function.get_preflight_param(CONST_SOE_TYPE))
+    assert sorted(passed_checks) == [
+        'document:%s:BuildDoc' % CONST_REGION,
+        'document:%s:UpdateOSDoc' % CONST_REGION,
+        'instance-profile:unit-test-ssm-instance-profile',
+        'launch:%s:ami-12345678:m5.large:unit-test-ssm-instance-profile' % CONST_REGION,
+    ]
+
+    # Passed checks are not run again within the cache TTL, failed ones are
+    mock_check_document = MagicMock(return_value=None)
+    mock_check_launch = MagicMock(return_value=None)
+    monkeypatch.setattr('trigger_build.trigger_build_function.check_document', mock_check_document)
+    monkeypatch.setattr('trigger_build.trigger_build_function.check_launch', mock_check_launch)
+
+    assert trigger_build_function.run_preflight_checks(CONST_SOE_TYPE, CONST_REGION, 'BuildDoc', trigger_build_function.build_command_documents,
+                                                       'ami-12345678', 'm5.large') == []
+    mock_check_document.assert_called_once_with(CONST_REGION, 'DeletedDoc')
+    mock_check_launch.assert_not_called()
+
+    # A missing instance profile is reported
+    assert trigger_build_function.check_instance_profile('deleted-profile') == "Instance profile 'deleted-profile' does not exist"
+
+
+def test_check_launch(monkeypatch):
+    """Test trigger_build_function.check_launch reports launches that would fail"""
+
+    reload(trigger_build_function)
+    mock_client = MagicMock()
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_client', MagicMock(return_value=mock_client))
+
+    mock_client.run_instances.side_effect = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'DryRunOperation', 'Message': 'Request would have succeeded, but DryRun flag is set.'}}, 'RunInstances')
+    assert trigger_build_function.check_launch(CONST_REGION, 'ami-12345678', 'm5.large', '') is None
+    assert 'IamInstanceProfile' not in mock_client.run_instances.call_args[1]
+
+    mock_client.run_instances.side_effect = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'OptInRequired', 'Message': 'You must first accept terms and subscribe.'}}, 'RunInstances')
+    assert trigger_build_function.check_launch(CONST_REGION, 'ami-12345678', 'm5.large', 'profile') == (
+        "Launching 'ami-12345678' on 'm5.large' in '%s' would fail: You must first accept terms and subscribe." % CONST_REGION)
+    assert mock_client.run_instances.call_args[1]['IamInstanceProfile'] == {'Name': 'profile'}
+
+    mock_client.run_instances.side_effect = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'InvalidAMIID.NotFound', 'Message': "The image id '[ami-12345678]' does not exist"}}, 'RunInstances')
+    assert trigger_build_function.check_launch(CONST_REGION, 'ami-12345678', 'm5.large', '') == (
+        "Launching 'ami-12345678' on 'm5.large' in '%s' would fail: The image id '[ami-12345678]' does not exist" % CONST_REGION)
+
+    # Not a launch failure, the check itself failed
+    for error_code in ['RequestLimitExceeded', 'UnauthorizedOperation']:
+        mock_client.run_instances.side_effect = botocore.exceptions.ClientError({'Error': {'Code': error_code, 'Message': error_code}}, 'RunInstances')
+        with pytest.raises(botocore.exceptions.ClientError):
+            trigger_build_function.check_launch(CONST_REGION, 'ami-12345678', 'm5.large', '')
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_failed_preflight(monkeypatch):
+    """Test trigger_build_function.lambda_handler fails the build without launching it when a pre-flight check fails"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("PreflightChecks", 'true')
+    reload(trigger_build_function)
+
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', MagicMock(return_value=MOCK_FINGERPRINT))
+    mock_run_preflight_checks = MagicMock(return_value=["SSM document 'SSMDocument' does not exist in '%s'" % CONST_REGION])
+    monkeypatch.setattr('trigger_build.trigger_build_function.run_preflight_checks', mock_run_preflight_checks)
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    output_event = trigger_build_function.lambda_handler({}, ContextMock())
+
+    assert output_event['BuildStatus'] == 'failed'
+    assert output_event['CheckType'] == 'preflight'
+    assert output_event['PreflightErrors'] == ["SSM document 'SSMDocument' does not exist in '%s'" % CONST_REGION]
+    mock_run_preflight_checks.assert_called_once_with(CONST_SOE_TYPE, CONST_REGION, 'SSMDocument', [], 'ami-12345678', 'm5.large')
+    mock_trigger_ssm.assert_not_called()
+
+
+@mock_ec2
+@mock_ssm
+def test_lambda_handler_with_build_variants(monkeypatch):
+    """Test trigger_build_function.lambda_handler starts the shared base build of the variants"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("OverrideAMI", '')
+    monkeypatch.setenv("BuildVariants", 'standard:codedeploy+corretto, minimal:')
+    monkeypatch.setenv("BaseSSMDocument", 'BaseSSMDocument')
+    monkeypatch.setenv("VariantSSMDocument", 'VariantSSMDocument')
+    reload(trigger_build_function)
+
+    monkeypatch.setattr('trigger_build.trigger_build_function.get_ami', MagicMock(return_value='ami-12345678'))
+    mock_compute_build_fingerprint = MagicMock(return_value=MOCK_FINGERPRINT)
+    monkeypatch.setattr('trigger_build.trigger_build_function.compute_build_fingerprint', mock_compute_build_fingerprint)
+    mock_trigger_ssm = MagicMock(return_value='mock_automation_execution_id')
+    monkeypatch.setattr('trigger_build.trigger_build_function.trigger_ssm', mock_trigger_ssm)
+
+    output_event = trigger_build_function.lambda_handler({}, ContextMock())
+
+    assert output_event['BuildStage'] == 'base'
+    assert output_event['BuildVariants'] == [
+        {'Name': 'standard', 'Components': ['codedeploy', 'corretto']},
+        {'Name': 'minimal', 'Components': []},
+    ]
+    assert output_event['VariantParameters'] == {'BaseAMIid': ['ami-12345678'], 'BuildFingerprint': [MOCK_FINGERPRINT],
+                                               'SolutionSOEType': [CONST_SOL_NAMING + '-' + CONST_SOE_TYPE]}
+    mock_compute_build_fingerprint.assert_called_with(
+        CONST_REGION, 'BaseSSMDocument', ['VariantSSMDocument'],
+        {'sourceAMIid': ['ami-12345678'], 'BuildVariants': ['standard:codedeploy+corretto, minimal:']}
+    )
+    mock_trigger_ssm.assert_called_with(
+        CONST_SOL_NAMING, CONST_REGION, 'BaseSSMDocument', CONST_SOE_TYPE,
+        {'sourceAMIid': ['ami-12345678'], 'BuildFingerprint': [MOCK_FINGERPRINT], 'SolutionSOEType': [CONST_SOL_NAMING + '-' + CONST_SOE_TYPE]}, None
+    )
+
+    # Variants finish from the base image in the local region only
+    monkeypatch.setattr('trigger_build.trigger_build_function.build_regions_setting', 'us-east-1:VirginiaSSMDocument')
+    with pytest.raises(ValueError) as excinfo:
+        trigger_build_function.lambda_handler({}, ContextMock())
+    assert "BuildVariants can not be combined with BuildRegions" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("build_variants_setting, exception_message", [
+    ('standard:codedeploy+tomcat', "must be 'name:component+component'"),
+    (':corretto', "must be 'name:component+component'"),
+    ('java:corretto,java:corretto+codedeploy', "'java' is defined more than once"),
+])
+def test_get_build_variants_with_invalid_setting(build_variants_setting, exception_message):
+    """Test trigger_build_function.get_build_variants rejects invalid variants"""
+
+    with pytest.raises(ValueError) as excinfo:
+        trigger_build_function.get_build_variants(build_variants_setting)
+    assert exception_message in str(excinfo.value)
@@ -5,6 +5,7 @@ import copy
 from importlib import reload
 from test import ContextMock
 
+import pytest
 from mock import call, patch
 
 from trigger_test import trigger_test_function
@@ -78,3 +79,59 @@ def test_lambda_handler(mock_boto_client, monkeypatch):
         })
     ]
     assert mock_boto_client.call_args_list == expected
+
+
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_execution(mock_boto_client, monkeypatch):
+    """Test trigger_test_function.lambda_handler launches the test idempotently for the execution"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    reload(trigger_test_function)
+    mock_boto_client.side_effect = mock_ssm_client
+
+    event = {
+        'BuildAutomationExecutionId': 'mock_build_automation_execution_id',
+        'InstanceID': 'i-12341234',
+        'Execution': {'Id': 'arn:aws:states:ap-southeast-2:123456789012:execution:ami-baking-unit-build-sf-sm:mock'}
+    }
+
+    # Replay the step as a Step Functions retry would
+    trigger_test_function.lambda_handler(copy.deepcopy(event), ContextMock())
+    trigger_test_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    start_calls = [args for args in mock_boto_client.call_args_list if args[0][0] == 'StartAutomationExecution']
+    assert len(start_calls) == 2
+    assert start_calls[0][0][1]['ClientToken'] == start_calls[1][0][1]['ClientToken']
+    assert len(start_calls[0][0][1]['ClientToken']) == 36
+
+
+@pytest.mark.parametrize("use_spot_test, event_capacity, expected_document, expected_capacity", [
+    ('true', None, 'SpotSSMDocument', 'spot'),
+    ('true', 'on-demand', 'SSMDocument', 'on-demand'),
+    ('false', None, 'SSMDocument', 'on-demand'),
+])
+@patch('botocore.client.BaseClient._make_api_call')
+def test_lambda_handler_with_spot(mock_boto_client, monkeypatch, use_spot_test, event_capacity, expected_document, expected_capacity):
+    """Test trigger_test_function.lambda_handler launches the test on spot capacity with an on-demand fallback"""
+
+    monkeypatch.setenv("SSMDocument", 'SSMDocument')
+    monkeypatch.setenv("SpotSSMDocument", 'SpotSSMDocument')
+    monkeypatch.setenv("UseSpotTest", use_spot_test)
+    reload(trigger_test_function)
+    mock_boto_client.side_effect = mock_ssm_client
+
+    event = {
+        'BuildAutomationExecutionId': 'mock_build_automation_execution_id',
+        'InstanceID': 'i-12341234',
+        'TestInstanceType': 'c5.large'
+    }
+    if event_capacity:
+        event['TestCapacity'] = event_capacity
+
+    output_event = trigger_test_function.lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert output_event['TestCapacity'] == expected_capacity
+    mock_boto_client.assert_called_with('StartAutomationExecution', {
+        'DocumentName': expected_document,
+        'Parameters': {'sourceAMIid': [MOCK_AMI_ID], 'InstanceType': ['c5.large']}
+    })
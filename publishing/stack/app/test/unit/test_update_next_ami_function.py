@@ -2,6 +2,7 @@
 Test get_accounts_function
 """
 import copy
+import json
 from test import CONST_NEXT_AMI_PARAM, CONST_REGION, ContextMock
 
 import boto3
@@ -109,3 +110,107 @@ def test_lambda_handler_with_valid_instance_id():
     param_value = get_ssm_param(CONST_REGION, param)
     assert param_value != original_param_value
     assert param_value == instance_id
+
+
+@mock_ssm
+def test_lambda_handler_with_catalog_soe():
+    """Test update_next_ami_function.lambda_handler updates the SOE Type params from the catalog"""
+
+    # Test Lambda handler
+    next_ami_param = '/ami-baking-unit/lnx-rhel/nextAmi'
+    next_ami_id = "ami-12345678"
+    instance_id = 'i-87654321'
+    event = {"AMI": next_ami_id, "BuildInstanceID": instance_id,
+             "SOE": {"SOEType": "lnx-rhel", "NextAMIParam": next_ami_param}}
+    context = ContextMock()
+    output_event = lambda_handler(copy.deepcopy(event), context)
+
+    # Verify the SOE Type params are updated rather than the stack defaults
+    assert output_event["SsmParam"] == next_ami_param
+    assert get_ssm_param(CONST_REGION, next_ami_param) == next_ami_id
+    assert get_ssm_param(CONST_REGION, '/ami-baking-unit/lnx-rhel/instanceId') == instance_id
+    assert get_ssm_param(CONST_REGION, CONST_NEXT_AMI_PARAM) == ""
+
+
+@mock_ssm
+def test_lambda_handler_with_stack_soe():
+    """Test update_next_ami_function.lambda_handler keeps the published instanceId param for the stack SOE Type"""
+
+    event = {"AMI": "ami-12345678", "BuildInstanceID": 'i-87654321',
+             "SOE": {"SOEType": "lnx-amzn", "Architecture": "x86_64", "NextAMIParam": CONST_NEXT_AMI_PARAM}}
+    lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert get_ssm_param(CONST_REGION, CONST_NEXT_AMI_PARAM) == "ami-12345678"
+    assert get_ssm_param(CONST_REGION, '/ami-baking-lnx-amzn-soe/lnx-amzn/instanceId') == 'i-87654321'
+
+
+@mock_ssm
+def test_lambda_handler_with_build_variants():
+    """Test update_next_ami_function.lambda_handler records the other variant images next to the SOE Type"""
+
+    next_ami_param = '/ami-baking-unit/lnx-amzn/nextAmi'
+    event = {"AMI": "ami-11111111", "BuildInstanceID": 'i-87654321',
+             "SOE": {"SOEType": "lnx-amzn", "NextAMIParam": next_ami_param},
+             "BuildVariants": [{"Name": "standard", "Components": ["codedeploy", "corretto"]},
+                               {"Name": "minimal", "Components": []}],
+             "VariantAMIs": {"standard": "ami-11111111", "minimal": "ami-22222222"}}
+    lambda_handler(copy.deepcopy(event), ContextMock())
+
+    assert get_ssm_param(CONST_REGION, next_ami_param) == "ami-11111111"
+    assert get_ssm_param(CONST_REGION, '/ami-baking-unit/lnx-amzn-minimal/nextAmi') == "ami-22222222"
+    assert get_ssm_param(CONST_REGION, '/ami-baking-unit/lnx-amzn-standard/nextAmi') == ""
+
+@mock_ssm
+def test_lambda_handler_with_instance_types(monkeypatch):
+    """Test update_next_ami_function.lambda_handler records the build and test wall times"""
+
+    benchmarks_param = '/ami-baking-unit/lnx-rhel/instanceBenchmarks'
+    client = boto3.client('ssm', region_name=CONST_REGION)
+    client.put_parameter(
+        Name=benchmarks_param,
+        Value=json.dumps({'build': {'c5.large': {'Runs': 10, 'Seconds': 1000}}}),
+        Type='String'
+    )
+    execution_seconds = {'build-execution-id': 1100, 'test-execution-id': 600}
+    monkeypatch.setattr('update_next.update_next_ami_function.get_execution_seconds',
+                        lambda region, execution_id: execution_seconds[execution_id])
+
+    event = {
+        "AMI": "ami-12345678", "BuildInstanceID": 'i-87654321',
+        "SOE": {"SOEType": "lnx-rhel", "NextAMIParam": '/ami-baking-unit/lnx-rhel/nextAmi'},
+        "BuildInstanceType": 'c5.large', "BuildAutomationExecutionId": 'build-execution-id',
+        "TestInstanceType": 'm5.large', "TestAutomationExecutionId": 'test-execution-id',
+    }
+    lambda_handler(copy.deepcopy(event), ContextMock())
+
+    # Verify the running averages are capped to the last runs
+    assert json.loads(get_ssm_param(CONST_REGION, benchmarks_param)) == {
+        'build': {'c5.large': {'Runs': 10, 'Seconds': 1010}},
+        'test': {'m5.large': {'Runs': 1, 'Seconds': 600}},
+    }
+
+
+@mock_ssm
+def test_lambda_handler_with_step_seconds():
+    """Test update_next_ami_function.lambda_handler records the step durations of the build and test automations"""
+
+    step_durations_param = '/ami-baking-unit/lnx-rhel/stepDurations'
+    client = boto3.client('ssm', region_name=CONST_REGION)
+    client.put_parameter(
+        Name=step_durations_param,
+        Value=json.dumps({'BuildDoc': {'Runs': 10, 'Steps': {'updateOS': 400, 'createImage': 300}}}),
+        Type='String'
+    )
+
+    event = {
+        "AMI": "ami-12345678", "BuildInstanceID": 'i-87654321',
+        "SOE": {"SOEType": "lnx-rhel", "NextAMIParam": '/ami-baking-unit/lnx-rhel/nextAmi'},
+        "StepSeconds": {'BuildDoc': {'updateOS': 500, 'installCorrettoJava': 60}, 'TestDoc': {'runInSpecLinux': 240}},
+    }
+    lambda_handler(copy.deepcopy(event), ContextMock())
+
+    # Verify the running averages are capped to the last runs
+    assert json.loads(get_ssm_param(CONST_REGION, step_durations_param)) == {
+        'BuildDoc': {'Runs': 10, 'Steps': {'updateOS': 410, 'createImage': 300, 'installCorrettoJava': 60}},
+        'TestDoc': {'Runs': 1, 'Steps': {'runInSpecLinux': 240}},
+    }